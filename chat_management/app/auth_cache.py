@@ -0,0 +1,78 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Verified claims are reused for this long, so a revoked token is seen up to the TTL late
+_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL", "30"))
+_MAX_ENTRIES = 50_000
+
+# token digest -> (expires_at, verified claims); only successful verifications are stored
+_cache: Dict[bytes, Tuple[float, Dict[str, Any]]] = {}
+# token digest -> verification in progress, so a burst of requests with a new token verifies it once
+_inflight: Dict[bytes, asyncio.Task] = {}
+
+
+async def _verify_and_cache(
+    key: bytes,
+    token: str,
+    verify: Callable[[str], Awaitable[Dict[str, Any]]]
+) -> Dict[str, Any]:
+    try:
+        claims = await verify(token)
+    finally:
+        _inflight.pop(key, None)
+
+    # Never cache past the token's own expiry
+    now = time.time()
+    expires_at = min(now + _TTL_SECONDS, claims.get('exp', now))
+    if expires_at > now:
+        if len(_cache) >= _MAX_ENTRIES:
+            # Dicts keep insertion order, so this drops the oldest entry
+            _cache.pop(next(iter(_cache)), None)
+        _cache[key] = (expires_at, claims)
+    return claims
+
+
+def _consume_exception(task: asyncio.Task) -> None:
+    # Waiters re-raise the error; retrieve it here too so a failure whose waiters
+    # were all cancelled is not logged as unhandled
+    if not task.cancelled():
+        task.exception()
+
+
+async def get_verified_claims(
+    token: str,
+    verify: Callable[[str], Awaitable[Dict[str, Any]]]
+) -> Dict[str, Any]:
+    """
+    Return the claims for a token, calling verify only on a cache miss.
+
+    Concurrent misses for the same token share a single verify call, run in its own
+    task so that cancelling any caller, including the first, leaves it running for
+    the others. Errors are propagated to every waiter and never cached.
+
+    Args:
+        token: Raw bearer token
+        verify: Coroutine function that verifies the token and returns its claims
+
+    Returns:
+        The verified claims. The dict is shared between callers and must not be mutated.
+    """
+    # Keyed by a digest so the cache never holds raw tokens
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    entry = _cache.get(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_verify_and_cache(key, token, verify))
+        task.add_done_callback(_consume_exception)
+        _inflight[key] = task
+    # shield: one cancelled waiter must not cancel the verification for the others
+    return await asyncio.shield(task)
@@ -1,7 +1,8 @@
-import json
 import logging
 
 import boto3
+import orjson
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from .config import settings
@@ -12,7 +13,15 @@ class SQSClient:
     def __init__(self, **kwargs):
         """
         Initialize SQS client with proper configuration.
+
+        The app shares one instance (app.aws.sqs_client) across threads, so the connection
+        pool is sized for concurrent sends and throttling is retried adaptively. Pass
+        config= to override.
         """
+        kwargs.setdefault('config', Config(
+            max_pool_connections=settings.aws_sqs_max_pool_connections,
+            retries={'max_attempts': 3, 'mode': 'adaptive'}
+        ))
         self.sqs = boto3.client(
             'sqs',
             region_name=settings.aws_region,
@@ -29,7 +38,7 @@ class SQSClient:
         try:
             # Convert dict to JSON string if necessary
             if isinstance(message_body, dict):
-                message_body = json.dumps(message_body)
+                message_body = orjson.dumps(message_body).decode()
 
             params = {
                 'QueueUrl': queue_url,
@@ -53,6 +62,28 @@ class SQSClient:
             logger.error(f"Unexpected error sending message to SQS: {e}")
             raise
 
+    def send_message_batch(self, queue_url, entries):
+        """
+        Send up to 10 messages to an SQS queue in a single request.
+
+        Each entry needs a batch-unique 'Id' and a 'MessageBody'. Per-entry failures
+        are reported in the response's 'Failed' list rather than raised.
+        """
+        try:
+            logger.debug(f"Sending batch of {len(entries)} messages to SQS queue: {queue_url}")
+            response = self.sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+            failed = response.get('Failed', [])
+            if failed:
+                logger.error(f"{len(failed)} of {len(entries)} messages failed in SQS batch: {failed}")
+            return response
+
+        except ClientError as e:
+            logger.error(f"Error sending message batch to SQS: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error sending message batch to SQS: {e}")
+            raise
+
     def receive_messages(self, queue_url, max_number=10, wait_time_seconds=20, visibility_timeout=30):
         """
         Receive messages from an SQS queue.
@@ -19,6 +19,9 @@ class AWSConfig(BaseSettings):
     aws_sqs_queue_url: str = os.environ.get('SQS_URL', 'http://localhost:9324/queue/zalo-phake-notifications')
     aws_sqs_message_group_id: str = os.environ.get('SQS_MESSAGE_GROUP_ID', 'zalo-phake')
     aws_sqs_max_message_size: int = int(os.environ.get('SQS_MAX_MESSAGE_SIZE', '256000'))  # 256KB
+    # HTTP connections the shared SQS client keeps open; sized above the number of sends that
+    # can run at once on worker threads so none has to reconnect (botocore defaults to 10)
+    aws_sqs_max_pool_connections: int = int(os.environ.get('SQS_MAX_POOL_CONNECTIONS', '64'))
 
     # S3 Configuration
     aws_s3_bucket_name: str = os.environ.get('S3_BUCKET_NAME', 'zalo-phake-test')
@@ -1,14 +1,58 @@
-import json
+import asyncio
+import functools
 import logging
+import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+import orjson
 
 from ..aws import sqs_client
 from ..aws.config import settings
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# SQS SendMessageBatch accepts at most 10 entries per call
+SQS_MAX_BATCH_SIZE = 10
+
+# Single sends are coalesced by a background flusher: it waits at most this long for a
+# batch to fill before sending what it has
+SQS_BATCH_LINGER_SECONDS = float(os.getenv("SQS_BATCH_LINGER_MS", "50")) / 1000
+SQS_OUTBOUND_QUEUE_SIZE = 10_000
+# Batches in flight at once, so one slow SendMessageBatch does not stall the others
+SQS_MAX_INFLIGHT_BATCHES = 8
+
+# (batch entry without 'Id', future resolved with whether SQS accepted it)
+_outbound: Optional[asyncio.Queue] = None
+_flusher: Optional[asyncio.Task] = None
+
+# Blocking SQS calls get their own threads, one per pooled client connection, so they do not
+# queue behind other to_thread work in the event loop's default pool
+_sqs_executor = ThreadPoolExecutor(
+  max_workers=settings.aws_sqs_max_pool_connections,
+  thread_name_prefix="sqs"
+)
+
+async def _sqs_run(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+  """
+  Run a blocking SQS client call on the dedicated SQS thread pool.
+
+  Args:
+      fn: Callable to run, e.g. sqs_client.send_message_batch
+      *args, **kwargs: Arguments passed through to fn
+
+  Returns:
+      Whatever fn returns
+  """
+  loop = asyncio.get_running_loop()
+  if kwargs:
+    fn = functools.partial(fn, **kwargs)
+  return await loop.run_in_executor(_sqs_executor, fn, *args)
+
 def serialize_datetime(obj: Any) -> Any:
   """
   Helper function to serialize datetime objects to ISO format strings.
@@ -46,42 +90,25 @@ async def send_to_sqs(
     return False
 
   try:
-    # Add event type to payload
-    message_data = payload.copy()
-    message_data['event'] = event_type
-
-    # Add timestamp if not present
-    if 'timestamp' not in message_data:
-      message_data['timestamp'] = datetime.utcnow().isoformat()
-
-    # Add unique message ID if not present
-    if 'messageId' not in message_data:
-      message_data['messageId'] = str(uuid.uuid4())
-
-    # Prepare message attributes if needed
-    message_attributes = None
-    if message_group_id or settings.aws_sqs_message_group_id:
-      # This suggests we're using a FIFO queue, so add appropriate attributes
-      message_group_id = message_group_id or settings.aws_sqs_message_group_id
-      message_attributes = {
-        'MessageGroupId': {
-          'DataType': 'String',
-          'StringValue': message_group_id
-        },
-        'MessageDeduplicationId': {
-          'DataType': 'String',
-          'StringValue': message_data['messageId']  # Use the message ID for deduplication
-        }
-      }
-
-    # Ensure payload size is within limits
-    json_payload = json.dumps(message_data, default=serialize_datetime)
-    if len(json_payload.encode('utf-8')) > settings.aws_sqs_max_message_size:
-      logger.error(f"Message payload exceeds SQS size limit of {settings.aws_sqs_max_message_size} bytes")
+    json_payload, message_attributes = _prepare_message(event_type, payload, message_group_id)
+    if json_payload is None:
       return False
 
-    # Send message to SQS
-    response = sqs_client.send_message(
+    if _outbound is not None:
+      # Ride along in the flusher's next SendMessageBatch
+      entry = {'MessageBody': json_payload, 'DelaySeconds': delay_seconds}
+      if message_attributes:
+        entry['MessageAttributes'] = message_attributes
+      future = asyncio.get_running_loop().create_future()
+      _outbound.put_nowait((entry, future))
+      sent = await future
+      if sent:
+        logger.info(f"Successfully sent {event_type} message to SQS")
+      return sent
+
+    # Flusher not running (e.g. outside the app lifecycle): send on its own, off the event loop
+    response = await _sqs_run(
+        sqs_client.send_message,
         queue_url=settings.aws_sqs_queue_url,
         message_body=json_payload,
         delay_seconds=delay_seconds,
@@ -95,6 +122,207 @@ async def send_to_sqs(
     logger.error(f"Error sending message to SQS: {str(e)}")
     return False
 
+async def _send_batch_with_retry(entries: List[Dict[str, Any]]) -> Set[str]:
+  """
+  Send one SendMessageBatch (at most 10 entries) and return the Ids SQS accepted.
+
+  Entries that failed through no fault of the request (throttling, SQS internal errors)
+  are retried once, together in a single follow-up batch; sender faults are not retried.
+  """
+  response = await _sqs_run(sqs_client.send_message_batch, settings.aws_sqs_queue_url, entries)
+  successful = {result['Id'] for result in response.get('Successful', [])}
+  retryable = {failure['Id'] for failure in response.get('Failed', []) if not failure.get('SenderFault')}
+  if retryable:
+    try:
+      response = await _sqs_run(
+        sqs_client.send_message_batch,
+        settings.aws_sqs_queue_url,
+        [entry for entry in entries if entry['Id'] in retryable]
+      )
+      successful.update(result['Id'] for result in response.get('Successful', []))
+    except Exception as e:
+      logger.error(f"Error retrying {len(retryable)} failed SQS batch entries: {str(e)}")
+  return successful
+
+async def _send_coalesced_batch(batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+  """
+  Send one flusher batch and resolve each caller's future with whether SQS accepted its entry.
+  """
+  entries = [dict(entry, Id=str(i)) for i, (entry, _) in enumerate(batch)]
+  try:
+    successful = await _send_batch_with_retry(entries)
+  except Exception as e:
+    logger.error(f"Error sending coalesced batch of {len(entries)} message(s) to SQS: {str(e)}")
+    successful = set()
+
+  for i, (_, future) in enumerate(batch):
+    if not future.done():
+      future.set_result(str(i) in successful)
+
+async def _flush_loop(queue: asyncio.Queue) -> None:
+  loop = asyncio.get_running_loop()
+  inflight = asyncio.Semaphore(SQS_MAX_INFLIGHT_BATCHES)
+  pending = set()
+  # Messages taken off the queue but not yet handed to a send task
+  batch: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+  try:
+    while True:
+      batch = [await queue.get()]
+      deadline = loop.time() + SQS_BATCH_LINGER_SECONDS
+      while len(batch) < SQS_MAX_BATCH_SIZE:
+        if not queue.empty():
+          batch.append(queue.get_nowait())
+          continue
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+          break
+
+      await inflight.acquire()
+      task = asyncio.create_task(_send_coalesced_batch(batch))
+      batch = []
+      pending.add(task)
+      task.add_done_callback(pending.discard)
+      task.add_done_callback(lambda _: inflight.release())
+  finally:
+    # Stopped while filling a batch: its callers get False instead of waiting forever
+    for _, future in batch:
+      if not future.done():
+        future.set_result(False)
+    # Batches already handed off resolve their own callers; let them finish
+    if pending:
+      await asyncio.gather(*pending, return_exceptions=True)
+
+def start_sqs_flusher() -> None:
+  """
+  Start the background task that coalesces send_to_sqs calls into SendMessageBatch requests.
+  Must be called from the running event loop (application startup).
+  """
+  global _outbound, _flusher
+  if _flusher is not None or not is_sqs_available():
+    return
+  _outbound = asyncio.Queue(maxsize=SQS_OUTBOUND_QUEUE_SIZE)
+  _flusher = asyncio.create_task(_flush_loop(_outbound))
+  logger.info(f"Started SQS batch flusher (linger {SQS_BATCH_LINGER_SECONDS * 1000:.0f} ms)")
+
+async def stop_sqs_flusher() -> None:
+  """Stop the flusher after its in-flight batches finish; callers still waiting on unsent messages get False."""
+  global _outbound, _flusher
+  if _flusher is None:
+    return
+  queue = _outbound
+  _outbound = None
+  _flusher.cancel()
+  await asyncio.gather(_flusher, return_exceptions=True)
+  _flusher = None
+  while not queue.empty():
+    _, future = queue.get_nowait()
+    if not future.done():
+      future.set_result(False)
+
+def _prepare_message(
+    event_type: str,
+    payload: Dict[str, Any],
+    message_group_id: Optional[str] = None
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+  """
+  Build the JSON body and message attributes for an SQS event.
+
+  Returns:
+      (json_payload, message_attributes); json_payload is None if the message is too large
+  """
+  # Add event type to payload
+  message_data = payload.copy()
+  message_data['event'] = event_type
+
+  # Add timestamp if not present
+  if 'timestamp' not in message_data:
+    message_data['timestamp'] = datetime.utcnow().isoformat()
+
+  # Add unique message ID if not present
+  if 'messageId' not in message_data:
+    message_data['messageId'] = str(uuid.uuid4())
+
+  # Prepare message attributes if needed
+  message_attributes = None
+  if message_group_id or settings.aws_sqs_message_group_id:
+    # This suggests we're using a FIFO queue, so add appropriate attributes
+    message_group_id = message_group_id or settings.aws_sqs_message_group_id
+    message_attributes = {
+      'MessageGroupId': {
+        'DataType': 'String',
+        'StringValue': message_group_id
+      },
+      'MessageDeduplicationId': {
+        'DataType': 'String',
+        'StringValue': message_data['messageId']  # Use the message ID for deduplication
+      }
+    }
+
+  # Ensure payload size is within limits; orjson emits UTF-8 bytes (datetimes natively),
+  # so the size check needs no separate encode
+  payload_bytes = orjson.dumps(message_data, default=serialize_datetime)
+  if len(payload_bytes) > settings.aws_sqs_max_message_size:
+    logger.error(f"Message payload exceeds SQS size limit of {settings.aws_sqs_max_message_size} bytes")
+    return None, None
+
+  return payload_bytes.decode(), message_attributes
+
+async def send_batch_to_sqs(
+    event_type: str,
+    payloads: List[Dict[str, Any]],
+    delay_seconds: int = 0
+) -> int:
+  """
+  Send many events of the same type using SendMessageBatch.
+
+  Payloads are grouped into batches of up to 10, and the batches are sent concurrently.
+
+  Args:
+      event_type: Type of event shared by every payload
+      payloads: List of event payload dictionaries
+      delay_seconds: Delay before messages become visible (0-900 seconds)
+
+  Returns:
+      int: Number of messages SQS accepted
+  """
+  if not sqs_client:
+    logger.warning("SQS client not initialized, messages not sent")
+    return 0
+
+  entries = []
+  for payload in payloads:
+    json_payload, message_attributes = _prepare_message(event_type, payload)
+    if json_payload is None:
+      continue
+    entry = {
+      'Id': str(len(entries) % SQS_MAX_BATCH_SIZE),
+      'MessageBody': json_payload,
+      'DelaySeconds': delay_seconds
+    }
+    if message_attributes:
+      entry['MessageAttributes'] = message_attributes
+    entries.append(entry)
+
+  chunks = [entries[i:i + SQS_MAX_BATCH_SIZE] for i in range(0, len(entries), SQS_MAX_BATCH_SIZE)]
+  results = await asyncio.gather(
+    *[_send_batch_with_retry(chunk) for chunk in chunks],
+    return_exceptions=True
+  )
+
+  sent = 0
+  for result in results:
+    if isinstance(result, Exception):
+      logger.error(f"Error sending {event_type} batch to SQS: {str(result)}")
+      continue
+    sent += len(result)
+
+  logger.info(f"Sent {sent}/{len(payloads)} {event_type} messages to SQS in {len(chunks)} batch(es)")
+  return sent
+
 async def send_chat_message_notification(
     chat_id: str,
     message_id: str,
@@ -163,6 +391,41 @@ async def send_group_invitation_notification(
 
   return await send_to_sqs('group_invitation', payload, delay_seconds)
 
+async def send_group_invitation_notifications(
+    group_id: str,
+    group_name: str,
+    sender_id: str,
+    invitee_ids: List[str],
+    delay_seconds: int = 0
+) -> int:
+  """
+  Send group invitation notifications for several invitees in SQS batches.
+
+  Args:
+      group_id: The conversation ID
+      group_name: The name of the group/conversation
+      sender_id: The ID of the user sending the invitations
+      invitee_ids: IDs of the invited users
+      delay_seconds: Delay before messages become visible
+
+  Returns:
+      int: Number of invitations SQS accepted
+  """
+  timestamp = datetime.utcnow().isoformat()
+  payloads = [
+    {
+      'conversationId': group_id,
+      'groupId': group_id,
+      'groupName': group_name,
+      'senderId': sender_id,
+      'inviteeId': invitee_id,
+      'timestamp': timestamp
+    }
+    for invitee_id in invitee_ids
+  ]
+
+  return await send_batch_to_sqs('group_invitation', payloads, delay_seconds)
+
 async def send_friend_request_notification(
     sender_id: str,
     recipient_id: str,
@@ -187,11 +450,17 @@ async def send_friend_request_notification(
 
   return await send_to_sqs('friend_request', payload, delay_seconds)
 
+# The client and queue URL are fixed once app.aws is imported, so availability is
+# computed a single time instead of on every check
+_SQS_AVAILABLE = sqs_client is not None and settings.aws_sqs_queue_url != ''
+
 def is_sqs_available() -> bool:
   """
   Check if SQS functionality is available.
 
+  This is a constant-time check; it does not probe the queue over the network.
+
   Returns:
       bool: True if SQS client is initialized and ready, False otherwise
   """
-  return sqs_client is not None and settings.aws_sqs_queue_url != ''
\ No newline at end of file
+  return _SQS_AVAILABLE
\ No newline at end of file
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from pydantic_settings import BaseSettings
 
 
@@ -7,6 +9,8 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
+# settings is fixed after import, so each version's prefix is computed once
+@lru_cache(maxsize=4)
 def get_prefix(api_version: str) -> str:
     path_prefix = settings.path_prefix
     if not path_prefix.startswith('/'):
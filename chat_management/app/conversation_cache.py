@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from app.firebase import get_firestore_async_client
+
+logger = logging.getLogger(__name__)
+
+# Short TTL: permission fields (participants, admins) change rarely, but other workers
+# cannot invalidate this process's copy, so staleness is bounded by the TTL alone
+_TTL_SECONDS = float(os.getenv("CONVERSATION_CACHE_TTL", "3"))
+_MAX_ENTRIES = 10_000
+
+
+class CachedConversation(NamedTuple):
+    """Conversation data plus membership sets built once per cache fill"""
+    data: Dict[str, Any]
+    participants: frozenset
+    admins: frozenset
+
+
+# conversation_id -> (expires_at, cached conversation or None if it does not exist)
+_cache: Dict[str, Tuple[float, Optional[CachedConversation]]] = {}
+# Per-key locks so concurrent misses for the same conversation share one Firestore read
+_locks: Dict[str, asyncio.Lock] = {}
+# Callers holding or waiting on each lock; the lock is dropped when the last one leaves,
+# so a waiter that has been woken but not yet re-acquired it still shares it
+_lock_refs: Dict[str, int] = {}
+
+
+def _lookup(conversation_id: str) -> Tuple[bool, Optional[CachedConversation]]:
+    entry = _cache.get(conversation_id)
+    if entry is not None and entry[0] > time.monotonic():
+        return True, entry[1]
+    return False, None
+
+
+async def get_cached_conversation(conversation_id: str) -> Optional[CachedConversation]:
+    """
+    Return the conversation with precomputed participant/admin sets, served from a
+    short-lived in-process cache when possible.
+
+    The returned data dict is shared between callers and must not be mutated.
+
+    Args:
+        conversation_id: ID of the conversation to load
+
+    Returns:
+        The cached conversation, or None if the conversation does not exist
+    """
+    hit, cached = _lookup(conversation_id)
+    if hit:
+        return cached
+
+    lock = _locks.get(conversation_id)
+    if lock is None:
+        lock = _locks[conversation_id] = asyncio.Lock()
+    _lock_refs[conversation_id] = _lock_refs.get(conversation_id, 0) + 1
+    try:
+        async with lock:
+            # Another request may have filled the entry while we waited
+            hit, cached = _lookup(conversation_id)
+            if hit:
+                return cached
+
+            snapshot = await get_firestore_async_client().collection('conversations') \
+                .document(conversation_id).get()
+            cached = None
+            if snapshot.exists:
+                data = snapshot.to_dict()
+                cached = CachedConversation(
+                    data=data,
+                    participants=frozenset(data.get('participants') or ()),
+                    admins=frozenset(data.get('admins') or ())
+                )
+
+            # Re-insert rather than overwrite an expired entry, so insertion order stays
+            # oldest first and the eviction below drops the oldest entry
+            _cache.pop(conversation_id, None)
+            if len(_cache) >= _MAX_ENTRIES:
+                _cache.pop(next(iter(_cache)), None)
+            _cache[conversation_id] = (time.monotonic() + _TTL_SECONDS, cached)
+            return cached
+    finally:
+        _lock_refs[conversation_id] -= 1
+        if not _lock_refs[conversation_id]:
+            del _lock_refs[conversation_id]
+            del _locks[conversation_id]
+
+
+def invalidate_conversation(conversation_id: str) -> None:
+    """Drop the cached copy of a conversation after this process writes to it."""
+    _cache.pop(conversation_id, None)
@@ -1,23 +1,25 @@
+import asyncio
 import logging
-import uuid
+import secrets
 from datetime import datetime, timezone
 from typing import Annotated, Optional
 
 from fastapi import APIRouter
 from fastapi import Depends, HTTPException, Query
-from firebase_admin import firestore
+from firebase_admin import firestore, firestore_async
 from firebase_admin.firestore import FieldFilter
 import traceback
 
 from .schemas import Conversation, ConversationType, MessagePreview, ConversationResponse, \
     ConversationCreate, ConversationDetail, ConversationMetadataUpdate
-from ..aws.sqs_utils import is_sqs_available, send_to_sqs
-from ..dependencies import AuthenticatedUser, get_current_active_user, verify_conversation_participant
+from ..aws.sqs_utils import is_sqs_available, send_group_invitation_notifications, send_to_sqs
+from ..conversation_cache import invalidate_conversation
+from ..dependencies import CurrentUser
 from ..dependencies import decode_token
-from ..firebase import firestore_db
+from ..firebase import get_firestore_async_client
+from ..notifications.service import NotificationService
 from ..pagination import common_pagination_parameters, PaginationParams, PaginatedResponse
-from ..time_utils import convert_timestamps
-from ..users.users_db import get_user_info
+from ..users.users_db import get_user_info, get_users_info
 from ..phone_utils import is_phone_number, format_phone_number
 
 logger = logging.getLogger(__name__)
@@ -28,9 +30,48 @@ router = APIRouter(
 )
 tags = ["Conversations"]
 
-def get_conversation_metadata(conversation_data, user_phone_num):
+notification_service = NotificationService()
+
+# Timestamp sentinel is immutable, so alias it once per process
+_SERVER_TS = firestore.SERVER_TIMESTAMP
+# Firestore rejects a WriteBatch with more writes than this
+_MAX_BATCH_WRITES = 500
+
+def _profile_lookup_id(conversation_data, user_phone_num):
+    """
+    Return the participant whose profile names an unnamed direct conversation, or None.
+    """
+    if conversation_data.get('type') != 'direct' or conversation_data.get('name'):
+        return None
+    return next((p for p in conversation_data.get('participants', []) if p != user_phone_num), None)
+
+
+async def _get_unread_counts(client, conversation_ids, user_phone_num):
+    """
+    Fetch the user's unread count in each conversation with one batched get_all read.
+
+    Returns:
+        dict: Conversation ID to unread count; conversations without stats are left out
+    """
+    if not conversation_ids:
+        return {}
+    conversations_ref = client.collection('conversations')
+    stats_refs = [conversations_ref.document(conversation_id).collection('user_stats').document(user_phone_num)
+                  for conversation_id in conversation_ids]
+    unread_counts = {}
+    async for snapshot in client.get_all(stats_refs):
+        if snapshot.exists:
+            # user_stats/{user} lives under conversations/{id}
+            unread_counts[snapshot.reference.parent.parent.id] = snapshot.to_dict().get('unreadCount', 0)
+    return unread_counts
+
+
+async def get_conversation_metadata(conversation_data, user_phone_num, profiles=None):
     """
     Helper function to get the conversation name based on the type and participants.
+
+    profiles, when given, maps user IDs to profiles already fetched with get_users_info,
+    so listing many conversations does not read them one at a time.
     """
     match conversation_data.get('type'):
         case 'group':
@@ -43,7 +84,11 @@ def get_conversation_metadata(conversation_data, user_phone_num):
             avatar_url = conversation_data.get('avatar_url', '')
             if not name:
                 name = other_participants[0] # Fallback to ID if no name is found
-                other_participant_info = get_user_info(other_participants[0])
+                if profiles is not None:
+                    other_participant_info = profiles.get(other_participants[0])
+                else:
+                    # Realtime Database reads are blocking; keep them off the event loop
+                    other_participant_info = await asyncio.to_thread(get_user_info, other_participants[0])
                 if other_participant_info:
                     other_participant_name = other_participant_info.get('name', '')
                     avatar_url = other_participant_info.get('profile_pic', '')
@@ -58,7 +103,7 @@ def get_conversation_metadata(conversation_data, user_phone_num):
 
 @router.get('/conversations', response_model=PaginatedResponse[Conversation], tags=tags)
 async def get_conversations(
-        current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)],
+        current_user: CurrentUser,
         pagination: Annotated[PaginationParams, Depends(common_pagination_parameters)],
         type: Optional[str] = Query(None, description="Filter by conversation type (direct/group)"),
         unread_only: bool = Query(False, description="Filter to only show conversations with unread messages")
@@ -73,8 +118,12 @@ async def get_conversations(
     try:
         user_phone_num = current_user.phoneNumber
 
-        # Query conversations where the user is a participant
-        conversations_ref = firestore_db.collection('conversations')
+        # Query conversations where the user is a participant. Keep the filter order
+        # (participants array_contains [, type ==], lastMessageTime desc) in line with the
+        # composite indexes declared in firestore.indexes.json
+        # One pooled client per request; refs, batches and transactions below share it
+        client = get_firestore_async_client()
+        conversations_ref = client.collection('conversations')
         query = conversations_ref.where(
             filter=FieldFilter('participants', 'array_contains', user_phone_num)
         ).order_by('lastMessageTime', direction='DESCENDING')
@@ -85,38 +134,40 @@ async def get_conversations(
             query = query.where('type', '==', conversation_type)
 
         # Get total count for pagination
-        total_docs = query.get()
+        total_docs = await query.get()
         total_conversations = len(total_docs)
 
         # Apply pagination
-        paginated_conversations = query.offset(
+        paginated_conversations = await query.offset(
             (pagination.page - 1) * pagination.size
         ).limit(pagination.size).get()
 
+        # Firestore already returns timestamps as tz-aware datetimes
+        page = [(conv, conv.to_dict()) for conv in paginated_conversations]
+
+        # Resolve the profiles that name this page's direct conversations and the user's unread
+        # counts as two batched reads, concurrently, instead of per-conversation round trips
+        profiles, unread_counts = await asyncio.gather(
+            get_users_info(
+                filter(None, (_profile_lookup_id(conv_data, user_phone_num) for _, conv_data in page))
+            ),
+            _get_unread_counts(client, [conv.id for conv, _ in page], user_phone_num)
+        )
+
         # Convert to response model
         conversations = []
-        for conv in paginated_conversations:
-            conv_data = conv.to_dict()
-            conv_data = convert_timestamps(conv_data)
+        for conv, conv_data in page:
+            unread_count = unread_counts.get(conv.id, 0)
 
             # Skip if unread_only is True and this conversation has no unread messages
-            if unread_only:
-                # Get unread count from user_conversations subcollection
-                unread_doc = firestore_db.collection('conversations').document(conv.id).collection(
-                    'user_stats').document(user_phone_num).get()
-
-                if unread_doc.exists:
-                    unread_count = unread_doc.to_dict().get('unreadCount', 0)
-                    if unread_count == 0:
-                        continue
-                else:
-                    continue
+            if unread_only and unread_count == 0:
+                continue
 
             # Determine conversation type
             conv_type = ConversationType.GROUP if conv_data.get('type') == 'group' else ConversationType.DIRECT
 
             # For direct chats, set the name to the other participant's name/number
-            name, avatar_url = get_conversation_metadata(conv_data, user_phone_num)
+            name, avatar_url = await get_conversation_metadata(conv_data, user_phone_num, profiles)
 
             # Get last message preview
             last_message = None
@@ -124,23 +175,16 @@ async def get_conversations(
                 # Try to get sender info if available
                 sender_id = conv_data.get('lastMessageSenderId', '')
 
-                last_message = MessagePreview(
+                last_message = MessagePreview.model_construct(
                     content=conv_data.get('lastMessagePreview', ''),
                     sender_id=sender_id,
                     timestamp=conv_data.get('lastMessageTime'),
                     type=conv_data.get('lastMessageType', 'text')
                 )
 
-            # Get unread count
-            unread_count = 0
-            unread_doc = firestore_db.collection('conversations').document(conv.id).collection(
-                'user_stats').document(user_phone_num).get()
-
-            if unread_doc.exists:
-                unread_count = unread_doc.to_dict().get('unreadCount', 0)
-
-            # Build the conversation object
-            conversation = Conversation(
+            # Build the conversation object; the data comes from our own Firestore documents,
+            # so response models are built with model_construct() to skip re-validation
+            conversation = Conversation.model_construct(
                 id=conv.id,
                 name=name,
                 type=conv_type,
@@ -172,7 +216,7 @@ async def get_conversations(
 @router.post('/conversations', response_model=ConversationResponse, tags=tags)
 async def create_conversation(
         body: ConversationCreate,
-        current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)]
+        current_user: CurrentUser
 ):
     """
     Create a new conversation (direct or group).
@@ -183,7 +227,8 @@ async def create_conversation(
     Returns the newly created conversation or the existing one if a direct conversation
     between the same participants already exists.
     """
-    logger.debug(f"Create conversation request: {body}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Create conversation request: %s", body)
     user_id = current_user.phoneNumber
 
     # Validate participants
@@ -215,27 +260,26 @@ async def create_conversation(
         sorted_participants = [format_phone_number(p) for p in sorted(body.participants)]
 
         # Check if a direct conversation already exists between these participants
-        conversations_ref = firestore_db.collection('conversations')
+        conversations_ref = get_firestore_async_client().collection('conversations')
         query = conversations_ref.where('type', '==', 'direct').where('participants', '==', sorted_participants)
-        existing_conversations = list(query.stream())
+        existing_conversations = await query.get()
 
         if existing_conversations:
             # Return existing conversation
             existing_conv = existing_conversations[0]
             existing_data = existing_conv.to_dict()
-            existing_data = convert_timestamps(existing_data)
 
             # Create the last message preview if available
             last_message = None
             if 'lastMessagePreview' in existing_data and 'lastMessageTime' in existing_data:
-                last_message = MessagePreview(
+                last_message = MessagePreview.model_construct(
                     content=existing_data.get('lastMessagePreview', ''),
                     sender_id=existing_data.get('lastMessageSenderId', ''),
                     timestamp=existing_data.get('lastMessageTime'),
                     type=existing_data.get('lastMessageType', 'text')
                 )
 
-            return ConversationResponse(
+            return ConversationResponse.model_construct(
                 id=existing_conv.id,
                 type=ConversationType.DIRECT,
                 participants=existing_data.get('participants', []),
@@ -248,9 +292,10 @@ async def create_conversation(
         sorted_participants = body.participants
 
     # Create a new conversation
-    conversation_id = str(uuid.uuid4())
+    # URL-safe random ID with the same 128 bits of entropy as a UUID4
+    conversation_id = secrets.token_urlsafe(16)
     now = datetime.now(timezone.utc)
-    server_timestamp = firestore.SERVER_TIMESTAMP
+    server_timestamp = _SERVER_TS
 
     conversation_data = {
         "type": body.type.value,
@@ -267,7 +312,7 @@ async def create_conversation(
 
     # Add initial message if provided
     if body.initial_message:
-        message_id = str(uuid.uuid4())
+        message_id = secrets.token_hex(16)
         conversation_data["lastMessagePreview"] = body.initial_message
         conversation_data["lastMessageType"] = "text"
         conversation_data["lastMessageSenderId"] = user_id
@@ -282,32 +327,42 @@ async def create_conversation(
         }
 
     try:
-        # Store conversation in Firestore
-        conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-        conversation_ref.set(conversation_data)
+        # Store the conversation and everything created with it through WriteBatches rather
+        # than one awaited write per participant
+        client = get_firestore_async_client()
+        conversation_ref = client.collection('conversations').document(conversation_id)
+        writes = [(conversation_ref, conversation_data)]
+
+        # Groups also keep one members/{phone} doc per participant so a membership or role
+        # check is a single point read instead of shipping the whole participants array
+        if body.type == ConversationType.GROUP:
+            members_ref = conversation_ref.collection('members')
+            for participant in sorted_participants:
+                writes.append((members_ref.document(participant), {
+                    "role": "admin" if participant == user_id else "member",
+                    "addedAt": server_timestamp
+                }))
 
-        # Add initial message if provided
+        # Add initial message if provided, with user stats documents for all participants
         if body.initial_message:
-            message_ref = conversation_ref.collection('messages').document(message_id)
-            message_ref.set(message_data)
-
-            # Create user stats documents for all participants
+            writes.append((conversation_ref.collection('messages').document(message_id), message_data))
+            user_stats_ref = conversation_ref.collection('user_stats')
             for participant in sorted_participants:
-                unread_count = 0 if participant == user_id else 1
-                user_stats = {
-                    "unreadCount": unread_count,
+                writes.append((user_stats_ref.document(participant), {
+                    "unreadCount": 0 if participant == user_id else 1,
                     "lastReadMessageId": message_id if participant == user_id else None
-                }
-                user_stats_ref = conversation_ref.collection('user_stats').document(participant)
-                user_stats_ref.set(user_stats)
+                }))
+
+        # One batch in the common case; very large groups are split at the per-batch limit
+        for start in range(0, len(writes), _MAX_BATCH_WRITES):
+            batch = client.batch()
+            for ref, data in writes[start:start + _MAX_BATCH_WRITES]:
+                batch.set(ref, data)
+            await batch.commit()
     except Exception as e:
         logger.error(f"Error creating conversation: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to create conversation")
 
-    # Get the created conversation
-    conversation = conversation_ref.get().to_dict()
-    conversation = convert_timestamps(conversation)
-
     # Send notifications to participants (except the creator)
     if body.type == ConversationType.GROUP:
         event_type = "group_conversation_created"
@@ -333,10 +388,28 @@ async def create_conversation(
         except Exception as e:
             logger.error(f"Failed to send notification: {str(e)}")
 
+        # Invite every other member with batched SQS sends instead of one call per member.
+        # Best effort: the conversation is already committed, so a failure here is only logged
+        if body.type == ConversationType.GROUP:
+            invitees = [p for p in sorted_participants if p != user_id]
+            if invitees:
+                try:
+                    await send_group_invitation_notifications(conversation_id, body.name, user_id, invitees)
+                except Exception as e:
+                    logger.error(f"Failed to send group invitations: {str(e)}")
+    elif body.type == ConversationType.GROUP:
+        # Without SQS, store the invitations directly so members still see them in-app
+        invitees = [p for p in sorted_participants if p != user_id]
+        if invitees:
+            try:
+                await notification_service.store_group_invitations(conversation_id, body.name, user_id, invitees)
+            except Exception as e:
+                logger.error(f"Failed to store group invitations: {str(e)}")
+
     # Create the last message preview if available
     last_message = None
     if body.initial_message:
-        last_message = MessagePreview(
+        last_message = MessagePreview.model_construct(
             content=body.initial_message,
             sender_id=user_id,
             timestamp=now,
@@ -345,7 +418,7 @@ async def create_conversation(
         )
 
     # Return the created conversation
-    return ConversationResponse(
+    return ConversationResponse.model_construct(
         id=conversation_id,
         type=body.type,
         name=body.name if body.type == ConversationType.GROUP else None,
@@ -358,11 +431,10 @@ async def create_conversation(
 
 @router.get('/conversations/{conversation_id}',
             response_model=ConversationDetail,
-            tags=tags,
-            dependencies=[Depends(verify_conversation_participant)])
+            tags=tags)
 async def get_conversation(
     conversation_id: str,
-    current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)]
+    current_user: CurrentUser
 ):
     """
     Get details of a specific conversation (direct or group).
@@ -380,13 +452,23 @@ async def get_conversation(
     try:
         user_phone_num = current_user.phoneNumber
         
-        # Get the conversation from Firestore
-        conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-        conversation = conversation_ref.get()
+        # The conversation and the caller's unread stats are independent reads, so fetch them concurrently
+        conversation_ref = get_firestore_async_client().collection('conversations').document(conversation_id)
+        conversation, unread_doc = await asyncio.gather(
+            conversation_ref.get(),
+            conversation_ref.collection('user_stats').document(user_phone_num).get()
+        )
+        
+        if not conversation.exists:
+            raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # Convert to dict and handle timestamps
+        # Timestamps come back as tz-aware datetimes, so the dict needs no conversion pass
         conversation_data = conversation.to_dict()
-        conversation_data = convert_timestamps(conversation_data)
+        # Pull repeatedly used fields into locals once
+        participants = conversation_data.get('participants') or []
+        if user_phone_num not in participants:
+            raise HTTPException(status_code=403, detail="User is not a participant in this conversation")
+        created_time = conversation_data.get('createdTime')
 
         # Determine conversation type
         conv_type = ConversationType.GROUP if conversation_data.get('type') == 'group' else ConversationType.DIRECT
@@ -394,7 +476,6 @@ async def get_conversation(
         # For direct chats, set the name to the other participant's name/number
         name = conversation_data.get('name', '')
         if conv_type == ConversationType.DIRECT:
-            participants = conversation_data.get('participants', [])
             # Filter out current user to get the other participant
             other_participants = [p for p in participants if p != user_phone_num]
             if other_participants:
@@ -406,7 +487,7 @@ async def get_conversation(
             # Try to get sender info if available
             sender_id = conversation_data.get('lastMessageSenderId', '')
             
-            last_message = MessagePreview(
+            last_message = MessagePreview.model_construct(
                 content=conversation_data.get('lastMessagePreview', ''),
                 sender_id=sender_id,
                 timestamp=conversation_data.get('lastMessageTime'),
@@ -415,8 +496,6 @@ async def get_conversation(
         
         # Get unread count for the current user
         unread_count = 0
-        unread_doc = conversation_ref.collection('user_stats').document(user_phone_num).get()
-        
         if unread_doc.exists:
             unread_count = unread_doc.to_dict().get('unreadCount', 0)
         
@@ -431,14 +510,14 @@ async def get_conversation(
         is_muted = user_phone_num in conversation_data.get('mutedBy', [])
         
         # Build the detailed conversation object
-        detailed_conversation = ConversationDetail(
+        detailed_conversation = ConversationDetail.model_construct(
             id=conversation_id,
             name=name,
             type=conv_type,
             description=description,
-            created_at=conversation_data.get('createdTime'),
-            updated_at=conversation_data.get('lastMessageTime', conversation_data.get('createdTime')),
-            participants=conversation_data.get('participants', []),
+            created_at=created_time,
+            updated_at=conversation_data.get('lastMessageTime', created_time),
+            participants=participants,
             admins=admins,
             last_message=last_message,
             unread_count=unread_count,
@@ -459,13 +538,11 @@ async def get_conversation(
 
 @router.put('/conversations/{conversation_id}',
             response_model=ConversationDetail,
-            tags=tags,
-            dependencies=[Depends(verify_conversation_participant)]
-            )
+            tags=tags)
 async def update_conversation_metadata(
     conversation_id: str,
     body: ConversationMetadataUpdate,
-    current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)]
+    current_user: CurrentUser
 ):
     """
     Update metadata for a group conversation (name, description, avatar_url).
@@ -483,21 +560,8 @@ async def update_conversation_metadata(
     try:
         user_phone_num = current_user.phoneNumber
         
-        # Get the conversation from Firestore
-        conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-        conversation = conversation_ref.get()
-        
-
-        # Convert to dict and handle timestamps
-        conversation_data = conversation.to_dict()
-        
-        # Check if the conversation is a group
-        if conversation_data.get('type') != 'group':
-            raise HTTPException(status_code=403, detail="This operation is only applicable for group conversations")
-        
-        # Check if the user is an admin
-        if user_phone_num not in conversation_data.get('admins', []):
-            raise HTTPException(status_code=403, detail="Only admins can update group metadata")
+        client = get_firestore_async_client()
+        conversation_ref = client.collection('conversations').document(conversation_id)
         
         # Prepare update data with only the fields that need changing
         update_data = {}
@@ -511,30 +575,57 @@ async def update_conversation_metadata(
         if body.avatar_url is not None:
             update_data['avatarUrl'] = body.avatar_url
         
-        # Only update if there's something to update
         if update_data:
             # Update lastMessageTime to track the modification
-            update_data['lastMessageTime'] = firestore.SERVER_TIMESTAMP
+            update_data['lastMessageTime'] = _SERVER_TS
+        
+        # Permission checks and the write run in one transaction, so the update cannot
+        # land on a conversation whose admins changed after they were read
+        @firestore_async.async_transactional
+        async def apply_update(transaction):
+            conversation = await conversation_ref.get(transaction=transaction)
+            if not conversation.exists:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            
+            conversation_data = conversation.to_dict()
+            if user_phone_num not in (conversation_data.get('participants') or []):
+                raise HTTPException(status_code=403, detail="User is not a participant in this conversation")
             
-            # Update the conversation
-            conversation_ref.update(update_data)
+            # Check if the conversation is a group
+            if conversation_data.get('type') != 'group':
+                raise HTTPException(status_code=403, detail="This operation is only applicable for group conversations")
+            
+            # Check if the user is an admin
+            if user_phone_num not in (conversation_data.get('admins') or []):
+                raise HTTPException(status_code=403, detail="Only admins can update group metadata")
+            
+            # Only update if there's something to update
+            if update_data:
+                transaction.update(conversation_ref, update_data)
+            return conversation_data
+        
+        conversation_data = await apply_update(client.transaction())
+        if update_data:
+            invalidate_conversation(conversation_id)
         
-        # Get the updated conversation
-        updated_conversation = conversation_ref.get()
-        updated_data = updated_conversation.to_dict()
-        updated_data = convert_timestamps(updated_data)
+        # Merge the update over the data we already have instead of reading it back;
+        # the local clock stands in for the server-resolved timestamp in the response
+        updated_data = {**conversation_data, **update_data}
+        if 'lastMessageTime' in update_data:
+            updated_data['lastMessageTime'] = datetime.now(timezone.utc)
+        created_time = updated_data.get('createdTime')
         
         # Build and return the detailed conversation object
-        return ConversationDetail(
+        return ConversationDetail.model_construct(
             id=conversation_id,
             name=updated_data.get('name'),
             type=ConversationType.GROUP,
             description=updated_data.get('description', ''),
-            created_at=updated_data.get('createdTime'),
-            updated_at=updated_data.get('lastMessageTime', updated_data.get('createdTime')),
+            created_at=created_time,
+            updated_at=updated_data.get('lastMessageTime', created_time),
             participants=updated_data.get('participants', []),
             admins=updated_data.get('admins', []),
-            last_message=MessagePreview(
+            last_message=MessagePreview.model_construct(
                 content=updated_data.get('lastMessagePreview', ''),
                 sender_id=updated_data.get('lastMessageSenderId', ''),
                 timestamp=updated_data.get('lastMessageTime'),
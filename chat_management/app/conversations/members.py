@@ -1,12 +1,12 @@
 import logging
-from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException
 from firebase_admin import firestore
 
 from .schemas import AddMemberRequest
-from ..dependencies import AuthenticatedUser, get_current_active_user, decode_token, verify_conversation_participant
-from ..firebase import firestore_db
+from ..conversation_cache import invalidate_conversation
+from ..dependencies import CurrentUser, decode_token
+from ..firebase import conversations_collection, firestore_db, fs_run
 
 logger = logging.getLogger(__name__)
 
@@ -17,46 +17,105 @@ router = APIRouter(
     dependencies=[Depends(decode_token)],
 )
 
-@router.post('/conversations/{conversation_id}/members', status_code=200, tags=tags,
-             dependencies=[Depends(verify_conversation_participant)])
+# The timestamp sentinel is immutable, so build it once per process
+_SERVER_TS = firestore.SERVER_TIMESTAMP
+
+# Fixed (status_code, detail) error responses; a new HTTPException is raised each time
+_ERR_CONVERSATION_NOT_FOUND = (404, "Conversation not found")
+_ERR_NOT_PARTICIPANT = (403, "User is not a participant in this conversation")
+_ERR_NOT_GROUP = (403, "This operation is only allowed for group conversations")
+_ERR_NOT_ADMIN = (403, "Only conversation admins can add members")
+_ERR_ALREADY_MEMBER = (400, "User is already a member of this conversation")
+_ERR_USER_NOT_FOUND = (404, "User not found")
+_ERR_ADD_MEMBER = (500, "An error occurred while adding member to conversation")
+
+@router.post('/conversations/{conversation_id}/members', status_code=200, tags=tags)
 async def add_conversation_member(
     conversation_id: str,
     body: AddMemberRequest,
-    current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)]
+    current_user: CurrentUser
 ):
     """
     Add a new member to a group conversation.
     Only conversation admins can add members.
     """
-    # Get the conversation document
+    # Check permissions and add the member in one transaction so concurrent admin
+    # actions cannot act on a stale admins/participants list
     try:
-        conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-        conversation = conversation_ref.get()
-        
-        conversation_data = conversation.to_dict()
-        
-        # Verify this is a group conversation
-        if conversation_data.get('type') != 'group':
-            raise HTTPException(status_code=403, detail="This operation is only allowed for group conversations")
-        
-        # Verify current user is an admin of the conversation
-        if current_user.phoneNumber not in conversation_data.get('admins', []):
-            raise HTTPException(status_code=403, detail="Only conversation admins can add members")
-        
-        # Verify the new user is not already a member
-        if body.user_id in conversation_data.get('participants', []):
-            raise HTTPException(status_code=400, detail="User is already a member of this conversation")
-        
-        # Optional: Verify the user_id exists in the users collection
-        user_ref = firestore_db.collection('users').document(body.user_id).get()
-        if not user_ref.exists:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        # Add the user to the conversation participants
-        conversation_ref.update({
-            'participants': firestore.ArrayUnion([body.user_id]),
-            'lastUpdateTime': firestore.SERVER_TIMESTAMP
-        })
+        conversation_ref = conversations_collection.document(conversation_id)
+        members_ref = conversation_ref.collection('members')
+        caller_member_ref = members_ref.document(current_user.phoneNumber)
+        new_member_ref = members_ref.document(body.user_id)
+        user_ref = firestore_db.collection('users').document(body.user_id)
+
+        @firestore.transactional
+        def add_member(transaction):
+            # The caller's and the new user's members/{phone} docs and the user doc in one
+            # point read of the small role field, however large the group is
+            docs = {
+                doc.reference.path: doc
+                for doc in firestore_db.get_all(
+                    [caller_member_ref, new_member_ref, user_ref],
+                    field_paths=['role'],
+                    transaction=transaction
+                )
+            }
+            caller_member = docs.get(caller_member_ref.path)
+
+            if caller_member is not None and caller_member.exists:
+                # Only group participants have a members doc
+                if (caller_member.to_dict() or {}).get('role') != 'admin':
+                    raise HTTPException(*_ERR_NOT_ADMIN)
+                already_member = docs[new_member_ref.path].exists
+            else:
+                # No members doc for the caller: a non-participant, a direct conversation or
+                # a group created before the subcollection, so check against the arrays
+                conversation = conversation_ref.get(
+                    field_paths=['type', 'admins', 'participants'],
+                    transaction=transaction
+                )
+
+                if not conversation.exists:
+                    raise HTTPException(*_ERR_CONVERSATION_NOT_FOUND)
+
+                conversation_data = conversation.to_dict()
+                admins = conversation_data.get('admins') or ()
+                participants = frozenset(conversation_data.get('participants') or ())
+
+                # Participation is checked here rather than in a separate dependency read
+                if current_user.phoneNumber not in participants:
+                    raise HTTPException(*_ERR_NOT_PARTICIPANT)
+
+                # Verify this is a group conversation
+                if conversation_data.get('type') != 'group':
+                    raise HTTPException(*_ERR_NOT_GROUP)
+
+                # Verify current user is an admin of the conversation
+                if current_user.phoneNumber not in admins:
+                    raise HTTPException(*_ERR_NOT_ADMIN)
+
+                already_member = body.user_id in participants
+
+            # Verify the new user is not already a member
+            if already_member:
+                raise HTTPException(*_ERR_ALREADY_MEMBER)
+
+            # Optional: Verify the user_id exists in the users collection
+            if not docs[user_ref.path].exists:
+                raise HTTPException(*_ERR_USER_NOT_FOUND)
+
+            # Add the user to the conversation participants
+            transaction.update(conversation_ref, {
+                'participants': firestore.ArrayUnion([body.user_id]),
+                'lastUpdateTime': _SERVER_TS
+            })
+            transaction.set(new_member_ref, {
+                'role': 'member',
+                'addedAt': _SERVER_TS
+            })
+
+        await fs_run(add_member, firestore_db.transaction())
+        invalidate_conversation(conversation_id)
         
         return {"success": True}
     
@@ -66,5 +125,5 @@ async def add_conversation_member(
     except Exception as e:
         # Log any other errors and return a 500 error
         logger.error(f"Error adding member to conversation: {str(e)}")
-        raise HTTPException(status_code=500, detail="An error occurred while adding member to conversation")
+        raise HTTPException(*_ERR_ADD_MEMBER) from None
 
@@ -1,19 +1,20 @@
 import asyncio
 import logging
 import traceback
-from typing import Annotated
+from datetime import datetime
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from google.cloud.firestore_v1.base_query import BaseQuery
 
-from .schemas import Message, MessageType, FileInfo
+from .schemas import FILE_MESSAGE_TYPES, Message, MessageType, FileInfo
 from ..aws.config import settings
 from ..aws.s3_utils import s3_client
 from ..dependencies import decode_token, verify_conversation_participant
-from ..firebase import firestore_db
+from ..firebase import conversations_collection, fs_run
 from ..notifications.service import NotificationService
-from ..pagination import PaginatedResponse, PaginationParams, common_pagination_parameters
-from ..time_utils import convert_timestamps
+from ..pagination import PaginatedResponse, PaginationParams, common_pagination_parameters, decode_cursor, \
+    encode_cursor
 from ..ws.router import get_connection_manager
 
 logger = logging.getLogger(__name__)
@@ -28,13 +29,17 @@ connection_manager = get_connection_manager()
 tags = ["Messages"]
 
 
+
 @router.get('/conversations/{conversation_id}/messages',
             response_model=PaginatedResponse[Message],
             tags=tags,
             dependencies=[Depends(verify_conversation_participant)])
 async def get_conversation_messages(
         conversation_id: str,
-        pagination: Annotated[PaginationParams, Depends(common_pagination_parameters)]
+        pagination: Annotated[PaginationParams, Depends(common_pagination_parameters)],
+        cursor: Annotated[Optional[str], Query(
+            description="next_cursor from the previous page; continues after it instead of using page"
+        )] = None
 ):
     """
     Get paginated messages for a specific conversation
@@ -43,35 +48,49 @@ async def get_conversation_messages(
         conversation_id: The ID of the conversation to retrieve messages from
         current_user: The authenticated user making the request
         pagination: Pagination parameters (page, size)
+        cursor: Optional next_cursor returned with the previous page. Firestore bills every
+            document an offset skips, so clients scrolling back should follow the cursor
         
     Returns:
-        PaginatedResponse: A paginated list of messages
+        PaginatedResponse: A paginated list of messages, with next_cursor set while more remain
         
     Raises:
+        400: If the cursor is malformed
         404: If the conversation doesn't exist
         403: If the user is not a participant in the conversation
     """
-    # Query messages for this conversation
-    messages_ref = firestore_db.collection('conversations').document(conversation_id).collection('messages')
-    query = messages_ref.order_by('timestamp', direction=BaseQuery.DESCENDING)
+    # Query messages for this conversation; the document ID breaks timestamp ties so the
+    # (timestamp, id) pair in a cursor identifies a unique position
+    messages_ref = conversations_collection.document(conversation_id).collection('messages')
+    query = messages_ref.order_by('timestamp', direction=BaseQuery.DESCENDING) \
+        .order_by('__name__', direction=BaseQuery.DESCENDING)
 
-    # Get total count for pagination
-    try:
-        total_docs = await asyncio.to_thread(query.get)
-        total_messages = len(total_docs)
-    except Exception as e:
-        logger.error(f"Error fetching message count: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
-            detail="Failed to retrieve messages"
-        )
+    if cursor:
+        # Keyset pagination: resume from the sort key itself, no document read or skipped reads
+        try:
+            position = decode_cursor(cursor)
+            page_query = query.start_after({
+                'timestamp': datetime.fromisoformat(position['t']),
+                '__name__': position['id']
+            })
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+    else:
+        page_query = query.offset((pagination.page - 1) * pagination.size)
 
-    # Apply pagination
+    # Count server-side with an aggregation query instead of downloading every message,
+    # and fetch the page concurrently
     try:
-        offset = (pagination.page - 1) * pagination.size
-        paginated_msgs = await asyncio.to_thread(query.offset(offset).limit(pagination.size).get)
+        count_result, paginated_msgs = await asyncio.gather(
+            fs_run(query.count(alias='total').get),
+            fs_run(page_query.limit(pagination.size).get)
+        )
+        total_messages = int(count_result[0][0].value)
     except Exception as e:
-        logger.error(f"Error applying pagination: {str(e)}")
+        logger.error(f"Error fetching messages: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail="Failed to retrieve messages"
@@ -81,19 +100,19 @@ async def get_conversation_messages(
     messages = []
     for msg in paginated_msgs:
         try:
+            # Firestore already returns timestamps as tz-aware datetimes
             msg_data = msg.to_dict()
-            # Convert Firestore timestamps to datetime objects
-            msg_data = convert_timestamps(msg_data)
             # Get file info if this is a file-based message
             file_info = None
             file_url = None
-            message_type = msg_data.get('messageType', MessageType.TEXT)
+            # The one field that still needs checking: an unknown type skips the message
+            message_type = MessageType(msg_data.get('messageType', MessageType.TEXT))
             
             # Generate pre-signed URL for file-based messages
-            if message_type in [MessageType.IMAGE, MessageType.VIDEO, MessageType.AUDIO, MessageType.FILE]:
+            if message_type.value in FILE_MESSAGE_TYPES:
                 file_info_data = msg_data.get('file_info')
                 if file_info_data:
-                    file_info = FileInfo(
+                    file_info = FileInfo.model_construct(
                         filename=file_info_data.get('filename', ''),
                         size=file_info_data.get('size', 0),
                         mime_type=file_info_data.get('mime_type', 'application/octet-stream'),
@@ -108,8 +127,9 @@ async def get_conversation_messages(
                             logger.error(f"Error generating presigned URL for {file_info.s3_key}: {str(e)}")
                             # Continue without URL - client can request it separately if needed
             
-            # Create Message object
-            messages.append(Message(
+            # Create Message object; the fields come from our own message documents, so
+            # model_construct() skips re-validating each one
+            messages.append(Message.model_construct(
                 messageId=msg.id,
                 senderId=msg_data.get('senderId'),
                 content=msg_data.get('content', ''),
@@ -125,12 +145,21 @@ async def get_conversation_messages(
             print(traceback.format_exc())
             # Continue to next message instead of failing the entire request
 
+    # A full page may have more after it; point the next request at its last message
+    next_cursor = None
+    if len(paginated_msgs) == pagination.size:
+        last = paginated_msgs[-1]
+        last_timestamp = last.get('timestamp')
+        if last_timestamp is not None:
+            next_cursor = encode_cursor({'t': last_timestamp.isoformat(), 'id': last.id})
+
     # Create the paginated response
     return PaginatedResponse.create(
         items=messages,
         total=total_messages,
         page=pagination.page,
-        size=pagination.size
+        size=pagination.size,
+        next_cursor=next_cursor
     )
 
 
@@ -165,10 +194,10 @@ async def get_message_file_url(
         )
         
     # Get the message from Firestore
-    message_ref = firestore_db.collection('conversations').document(conversation_id).collection('messages').document(message_id)
+    message_ref = conversations_collection.document(conversation_id).collection('messages').document(message_id)
     
     try:
-        message = await asyncio.to_thread(message_ref.get)
+        message = await fs_run(message_ref.get)
         if not message.exists:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -1,5 +1,3 @@
-import asyncio
-import json
 import logging
 import os
 import socket
@@ -10,7 +8,8 @@ from firebase_admin import firestore
 
 from .schemas import MessageReactionRequest, MessageReactionResponse
 from ..dependencies import decode_token, AuthenticatedUser, get_current_active_user, verify_conversation_participant
-from ..firebase import firestore_db
+from ..firebase import conversations_collection, fs_run
+from ..redis.channels import publish_conversation_event
 from ..redis.connection import get_redis_connection
 from ..ws.router import get_connection_manager
 
@@ -24,6 +23,7 @@ router = APIRouter(
 connection_manager = get_connection_manager()
 tags = ["Messages"]
 
+
 @router.post('/conversations/{conversation_id}/messages/{message_id}/reactions',
              response_model=MessageReactionResponse,
              tags=tags,
@@ -52,12 +52,12 @@ async def add_message_reaction(
         500: If there's a database or other error
     """
     # Get the message reference
-    message_ref = firestore_db.collection('conversations').document(conversation_id) \
+    message_ref = conversations_collection.document(conversation_id) \
                    .collection('messages').document(message_id)
     
     try:
         # Get the message
-        message = await asyncio.to_thread(message_ref.get)
+        message = await fs_run(message_ref.get)
         if not message.exists:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -68,38 +68,32 @@ async def add_message_reaction(
         reaction = reaction_data.reaction
         user_id = current_user.phoneNumber
         
+        # Copy of the current reactions; the local change is applied to it below so the
+        # response does not need a second read of the message
+        reactions = dict(message.to_dict().get('reactions') or {})
+        
         # Update the message's reactions field
         if reaction and reaction.strip():
             # Add or update reaction
             update_data = {
                 f'reactions.{user_id}': reaction.strip()
             }
-            await asyncio.to_thread(message_ref.update, update_data)
+            await fs_run(message_ref.update, update_data)
+            reactions[user_id] = reaction.strip()
             logger.info(f"User {user_id} added reaction '{reaction}' to message {message_id}")
         else:
             # Remove reaction if it exists
-            message_data = message.to_dict()
-            reactions = message_data.get('reactions', {})
-            
             if user_id in reactions:
                 # Use FieldValue.delete() to remove the specific field
-                await asyncio.to_thread(
+                await fs_run(
                     message_ref.update,
                     {f'reactions.{user_id}': firestore.DELETE_FIELD}
                 )
+                del reactions[user_id]
                 logger.info(f"User {user_id} removed reaction from message {message_id}")
             else:
                 logger.info(f"No reaction to remove for user {user_id} on message {message_id}")
         
-        # Get the updated message to return current reactions
-        updated_message = await asyncio.to_thread(message_ref.get)
-        updated_data = updated_message.to_dict()
-        reactions = updated_data.get('reactions', {})
-        
-        # If reactions is None, initialize as empty dict
-        if reactions is None:
-            reactions = {}
-        
         # Publish reaction event to Redis for real-time notifications
         try:
             redis_conn = await get_redis_connection()
@@ -114,14 +108,13 @@ async def add_message_reaction(
                 'instanceId': os.environ.get("INSTANCE_ID", socket.gethostname())
             }
             
-            # Publish to Redis channel for this conversation
-            channel = f"conversation:{conversation_id}"
-            pub_result = await redis_conn.publish(channel, json.dumps(reaction_event))
+            # Publish to the participants' Redis shard channels
+            pub_result = await publish_conversation_event(redis_conn, conversation_id, reaction_event)
             
             if pub_result:
-                logger.info(f"Reaction event published to Redis channel {channel} with {pub_result} receivers")
+                logger.info(f"Reaction event published for conversation {conversation_id} with {pub_result} receivers")
             else:
-                logger.warning(f"Published to Redis channel {channel} but found no subscribers")
+                logger.warning(f"Published for conversation {conversation_id} but found no subscribers")
                 # Try direct WebSocket broadcast as fallback
                 try:
                     await connection_manager.broadcast_to_conversation(
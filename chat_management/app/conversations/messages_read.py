@@ -1,5 +1,3 @@
-import asyncio
-import json
 import logging
 import os
 import socket
@@ -9,8 +7,9 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from firebase_admin import firestore
 
 from ..dependencies import decode_token, AuthenticatedUser, get_current_active_user, verify_conversation_participant
-from ..firebase import firestore_db
+from ..firebase import conversations_collection, firestore_db, fs_run
 from ..notifications.service import NotificationService
+from ..redis.channels import publish_conversation_event
 from ..redis.connection import get_redis_connection
 from ..ws.router import get_connection_manager
 
@@ -25,6 +24,9 @@ notification_service = NotificationService()
 connection_manager = get_connection_manager()
 tags = ["Messages"]
 
+# Firestore rejects a WriteBatch with more writes than this
+_MAX_BATCH_WRITES = 500
+
 @router.post('/conversations/{conversation_id}/messages/{message_id}/read',
              tags=tags,
              dependencies=[Depends(verify_conversation_participant)])
@@ -53,33 +55,38 @@ async def mark_message_as_read(
 
     # Get the message and update read status using transaction
     try:
-        # Get the message reference
-        message_ref = firestore_db.collection('conversations').document(conversation_id).collection('messages').document(message_id)
-        
-        # Use transaction to update read status
-        transaction = firestore_db.transaction()
+        # Get the message and unread counter references
+        message_ref = conversations_collection.document(conversation_id).collection('messages').document(message_id)
+        user_stats_ref = conversations_collection.document(conversation_id) \
+                        .collection('user_stats').document(user_id)
         
         @firestore.transactional
-        def update_read_status(transaction, message_ref, user_id):
-            message = message_ref.get(transaction=transaction)
+        def update_read_status(transaction, message_ref, user_stats_ref, user_id):
+            # Both documents come back from a single get_all round trip
+            snapshots = {snap.reference.path: snap
+                         for snap in transaction.get_all([message_ref, user_stats_ref])}
+            message = snapshots[message_ref.path]
             
             if not message.exists:
                 return False, "Message not found"
                 
-            message_data = message.to_dict()
-            read_by = message_data.get('readBy', [])
+            # Message was already read by this user
+            if user_id in message.to_dict().get('readBy', []):
+                return False, None
             
-            # Only update if the user hasn't already read the message
-            if user_id not in read_by:
-                read_by.append(user_id)
-                transaction.update(message_ref, {'readBy': read_by})
-                return True, None
+            # ArrayUnion appends server-side instead of rewriting the whole list
+            transaction.update(message_ref, {'readBy': firestore.ArrayUnion([user_id])})
             
-            # Message was already read by this user
-            return False, None
-        
-        # Execute the transaction
-        updated, error_message = update_read_status(transaction, message_ref, user_id)
+            # Decrement the unread count in the same commit, never going below zero
+            user_stats = snapshots[user_stats_ref.path]
+            if user_stats.exists and user_stats.to_dict().get('unreadCount', 0) > 0:
+                transaction.update(user_stats_ref, {'unreadCount': firestore.Increment(-1)})
+            return True, None
+        
+        # Execute the transaction off the event loop
+        updated, error_message = await fs_run(
+            update_read_status, firestore_db.transaction(), message_ref, user_stats_ref, user_id
+        )
         
         if error_message:
             raise HTTPException(
@@ -89,22 +96,6 @@ async def mark_message_as_read(
             
         if updated:
             logger.info(f"Message {message_id} marked as read by user {user_id}")
-            
-            # Update the unread count for the user in this conversation
-            try:
-                user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
-                                .collection('user_stats').document(user_id)
-                
-                # Get current unread count
-                user_stats = await asyncio.to_thread(user_stats_ref.get)
-                if user_stats.exists:
-                    unread_count = user_stats.to_dict().get('unreadCount', 0)
-                    if unread_count > 0:  # Ensure we don't go below zero
-                        await asyncio.to_thread(user_stats_ref.update, {'unreadCount': unread_count - 1})
-                        logger.info(f"Decremented unread count for user {user_id} in conversation {conversation_id} to {unread_count - 1}")
-            except Exception as e:
-                logger.error(f"Error updating unread count: {str(e)}")
-                # Don't fail the overall request if updating unread count fails
         else:
             logger.info(f"Message {message_id} was already read by user {user_id}")
             
@@ -132,14 +123,13 @@ async def mark_message_as_read(
             'instanceId': os.environ.get("INSTANCE_ID", socket.gethostname())
         }
         
-        # Publish to Redis channel
-        channel = f"conversation:{conversation_id}"
-        pub_result = await redis_conn.publish(channel, json.dumps(read_event))
+        # Publish to the participants' Redis shard channels
+        pub_result = await publish_conversation_event(redis_conn, conversation_id, read_event)
         
         if pub_result:
-            logger.info(f"Read receipt published to Redis channel {channel} with {pub_result} receivers")
+            logger.info(f"Read receipt published for conversation {conversation_id} with {pub_result} receivers")
         else:
-            logger.info(f"Published read receipt to Redis channel {channel} but found no subscribers")
+            logger.info(f"Published read receipt for conversation {conversation_id} but found no subscribers")
     except Exception as e:
         logger.error(f"Error publishing read receipt to Redis: {str(e)}")
         # Fallback to direct WebSocket broadcast if Redis is not available
@@ -186,11 +176,9 @@ async def mark_all_messages_as_read(
     # Get all messages that the user hasn't read yet
     try:
         # Query messages that don't have the user in readBy array
-        messages_ref = firestore_db.collection('conversations').document(conversation_id).collection('messages')
+        messages_ref = conversations_collection.document(conversation_id).collection('messages')
         query = messages_ref.where('readBy', 'array_contains', user_id).limit(1)
         
-        # Use a Firestore batch to update all messages at once
-        batch = firestore_db.batch()
         message_updates = 0
         
         # Get all unread messages
@@ -200,7 +188,7 @@ async def mark_all_messages_as_read(
         async def get_unread_messages():
             nonlocal unread_messages
             # This array query has to be inverted - we need to get all messages and filter
-            all_messages = await asyncio.to_thread(messages_ref.get)
+            all_messages = await fs_run(messages_ref.get)
             
             for msg in all_messages:
                 msg_data = msg.to_dict()
@@ -213,27 +201,28 @@ async def mark_all_messages_as_read(
         # No unread messages
         if not unread_messages:
             # Reset unread count to ensure consistency
-            user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
+            user_stats_ref = conversations_collection.document(conversation_id) \
                             .collection('user_stats').document(user_id)
-            await asyncio.to_thread(user_stats_ref.update, {'unreadCount': 0})
+            await fs_run(user_stats_ref.update, {'unreadCount': 0})
             return {'status': 'success', 'messagesRead': 0}
         
-        # Update all unread messages
-        for msg_id, msg_data in unread_messages:
-            msg_ref = messages_ref.document(msg_id)
-            read_by = msg_data.get('readBy', [])
-            read_by.append(user_id)
-            batch.update(msg_ref, {'readBy': read_by})
-            message_updates += 1
-        
-        # Commit the batch
-        await asyncio.to_thread(batch.commit)
+        # Update all unread messages in WriteBatches of at most _MAX_BATCH_WRITES. They are
+        # committed one after another: a failed batch stops the rest, and the unread count is
+        # only reset once all of them succeeded. ArrayUnion keeps readers that marked a message
+        # after it was fetched above (which writing back the fetched list would drop), and makes
+        # a retried request safe to re-apply
+        for start in range(0, len(unread_messages), _MAX_BATCH_WRITES):
+            batch = firestore_db.batch()
+            for msg_id, _ in unread_messages[start:start + _MAX_BATCH_WRITES]:
+                batch.update(messages_ref.document(msg_id), {'readBy': firestore.ArrayUnion([user_id])})
+                message_updates += 1
+            await fs_run(batch.commit)
         logger.info(f"Marked {message_updates} messages as read for user {user_id} in conversation {conversation_id}")
         
         # Update unread count to zero
-        user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
+        user_stats_ref = conversations_collection.document(conversation_id) \
                         .collection('user_stats').document(user_id)
-        await asyncio.to_thread(user_stats_ref.update, {'unreadCount': 0})
+        await fs_run(user_stats_ref.update, {'unreadCount': 0})
         logger.info(f"Reset unread count to 0 for user {user_id} in conversation {conversation_id}")
         
         # Notify other participants
@@ -249,9 +238,8 @@ async def mark_all_messages_as_read(
                 'instanceId': os.environ.get("INSTANCE_ID", socket.gethostname())
             }
             
-            # Publish to Redis channel
-            channel = f"conversation:{conversation_id}"
-            await redis_conn.publish(channel, json.dumps(read_event))
+            # Publish to the participants' Redis shard channels
+            await publish_conversation_event(redis_conn, conversation_id, read_event)
         except Exception as e:
             logger.error(f"Error publishing bulk read receipt to Redis: {str(e)}")
         
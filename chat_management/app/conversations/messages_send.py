@@ -1,23 +1,23 @@
-import asyncio
 import io
-import json
 import logging
 import os
 import socket
 import uuid
 from datetime import datetime, timezone
-from typing import Annotated, List, Optional
+from typing import Annotated, Iterable, List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
 from firebase_admin import firestore
 
-from .schemas import MessageType, MessageCreate, FileInfo
+from .schemas import FILE_MESSAGE_TYPE_LIST, FILE_MESSAGE_TYPES, MessageCreate, FileInfo
 from ..aws.config import settings
 from ..aws.s3_utils import s3_client
 from ..aws.sqs_utils import is_sqs_available
-from ..dependencies import decode_token, AuthenticatedUser, get_current_active_user, verify_conversation_participant
-from ..firebase import firestore_db
+from ..dependencies import decode_token, AuthenticatedUser, ConversationCtx, get_current_active_user
+from ..firebase import get_firestore_async_client
+from ..notifications.queue import enqueue_notification
 from ..notifications.service import NotificationService
+from ..redis.channels import publish_conversation_event
 from ..redis.connection import get_redis_connection
 from ..ws.router import get_connection_manager
 
@@ -32,13 +32,56 @@ notification_service = NotificationService()
 connection_manager = get_connection_manager()
 tags = ["Messages"]
 
+# Firestore rejects a WriteBatch with more writes than this
+_MAX_BATCH_WRITES = 500
+
+
+def _preview(content: str, limit: int = 50) -> str:
+    """Truncate content for lastMessagePreview; short content is returned as-is, without a copy."""
+    return content if len(content) <= limit else content[:limit] + '...'
+
+
+async def _commit_new_message(client, conversation_ref, message_ref, message_data: dict,
+                              conversation_update: dict, participants: Iterable[str],
+                              sender_id: str) -> None:
+    """
+    Save a message, update the conversation metadata and bump every other participant's
+    unread count in one WriteBatch commit.
+
+    The counts are server-side increments merged into user_stats, which also creates a
+    missing user_stats doc with a count of 1, so no participant's stats are read first.
+    In groups too large for one batch, the remaining increments follow in further
+    batches once the message is saved; a failure there is logged, not raised.
+    """
+    user_stats_ref = conversation_ref.collection('user_stats')
+    stats_refs = [user_stats_ref.document(participant) for participant in participants
+                  if participant != sender_id]  # The sender has already read the message
+
+    write_batch = client.batch()
+    write_batch.set(message_ref, message_data)
+    write_batch.update(conversation_ref, conversation_update)
+    in_first_batch = _MAX_BATCH_WRITES - 2
+    for ref in stats_refs[:in_first_batch]:
+        write_batch.set(ref, {'unreadCount': firestore.Increment(1)}, merge=True)
+    await write_batch.commit()
+
+    try:
+        for start in range(in_first_batch, len(stats_refs), _MAX_BATCH_WRITES):
+            batch = client.batch()
+            for ref in stats_refs[start:start + _MAX_BATCH_WRITES]:
+                batch.set(ref, {'unreadCount': firestore.Increment(1)}, merge=True)
+            await batch.commit()
+    except Exception as e:
+        logger.error(f"Error updating unread counts: {str(e)}")
+
+
 @router.post('/conversations/{conversation_id}/messages',
-             tags=tags,
-             dependencies=[Depends(verify_conversation_participant)])
+             tags=tags)
 async def send_conversation_message(
         conversation_id: str,
         message: MessageCreate,
-        current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)]
+        current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)],
+        conversation: ConversationCtx
 ):
     """
     Send a message to a specific conversation using the new message flow architecture
@@ -47,40 +90,32 @@ async def send_conversation_message(
         conversation_id: The ID of the conversation to send the message to
         message: The message creation data (content and type)
         current_user: The authenticated user making the request
+        conversation: The conversation, loaded and participation-checked by the dependency
 
     Returns:
         dict: Message ID, timestamp, and status
 
     Raises:
-        400: If content is missing or message type is invalid
+        422: If content is missing or message type is invalid
         403: If the user is not a participant in the conversation
         404: If the conversation doesn't exist
         500: If there's a database or other error
     """
-    # Validate request data
+    # Content and type are already validated by the MessageCreate model
     content = message.content
-    message_type = message.messageType
+    message_type = message.messageType.value
 
-    if not content:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Content is required"
-        )
-
-    # Validate message type
-    if message_type not in [m.value for m in MessageType]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid message type. Must be one of: {[m.value for m in MessageType]}"
-        )
-
-    conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-    conversation = await asyncio.to_thread(conversation_ref.get)
-    conversation_data = conversation.to_dict()
+    # Native async client: every write below is awaited on the event loop, no thread hop
+    client = get_firestore_async_client()
+    conversation_ref = client.collection('conversations').document(conversation_id)
+    # Loaded by the ConversationCtx dependency (shared with the cache), read-only here
+    conversation_data = conversation.data
 
     # Create message
     message_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc)
+    # Formatted once; shared by the Redis event, the fallback broadcast and the response
+    now_iso = now.isoformat()
     message_data = {
         'content': content,
         'messageType': message_type,
@@ -89,72 +124,33 @@ async def send_conversation_message(
         'readBy': [current_user.phoneNumber]  # Sender has read their own message
     }
 
-    # Step 1: Save message to Firestore
-    try:
-        message_ref = firestore_db.collection('conversations').document(conversation_id).collection(
-            'messages').document(message_id)
-        await asyncio.to_thread(message_ref.set, message_data)
-        logger.info(f"Message {message_id} saved to Firestore for conversation {conversation_id}")
-    except Exception as e:
-        logger.error(f"Error storing message in Firestore: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to save message"
-        )
-
-    # Step 2: Update conversation metadata
+    # Steps 1-2: Save the message, update conversation metadata and the other participants'
+    # unread counts in one atomic commit
     try:
+        message_ref = conversation_ref.collection('messages').document(message_id)
         # Create a preview (truncate if longer than 50 chars)
-        preview = content[:50] + ('...' if len(content) > 50 else '')
-        await asyncio.to_thread(
-            conversation_ref.update,
+        preview = _preview(content)
+        await _commit_new_message(
+            client,
+            conversation_ref,
+            message_ref,
+            message_data,
             {
                 'lastMessageTime': firestore.SERVER_TIMESTAMP,
                 'lastMessagePreview': preview,
                 'lastMessageType': message_type,
                 'lastMessageSenderId': current_user.phoneNumber
-            }
+            },
+            conversation_data.get('participants', []),
+            current_user.phoneNumber
         )
-        logger.info(f"Conversation {conversation_id} metadata updated")
-    except Exception as e:
-        logger.error(f"Error updating conversation metadata: {str(e)}")
-        # Continue processing even if metadata update fails
-
-    # Step 2.5: Update unread counts for all participants except the sender
-    try:
-        participants = conversation_data.get('participants', [])
-        sender_id = current_user.phoneNumber
-        batch = firestore_db.batch()
-
-        # Create a batch to update all participants' unread counts atomically
-        for participant in participants:
-            if participant == sender_id:
-                continue  # Skip sender, they've already read the message
-
-            # Get user stats reference
-            user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
-                             .collection('user_stats').document(participant)
-
-            # Check if user stats exist first
-            user_stats = await asyncio.to_thread(user_stats_ref.get)
-
-            if user_stats.exists:
-                # Increment existing unread count
-                current_count = user_stats.to_dict().get('unreadCount', 0)
-                batch.update(user_stats_ref, {'unreadCount': current_count + 1})
-            else:
-                # Create new user stats with unread count of 1
-                batch.set(user_stats_ref, {
-                    'unreadCount': 1,
-                    'lastReadMessageId': None
-                })
-
-        # Commit all the unread count updates
-        await asyncio.to_thread(batch.commit)
-        logger.info(f"Updated unread counts for participants in conversation {conversation_id}")
+        logger.info(f"Message {message_id} saved to Firestore for conversation {conversation_id}")
     except Exception as e:
-        logger.error(f"Error updating unread counts: {str(e)}")
-        # Continue processing even if unread count updates fail
+        logger.error(f"Error storing message in Firestore: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to save message"
+        )
 
     # Step 3: Publish to Redis Pub/Sub for real-time notifications
     try:
@@ -169,26 +165,26 @@ async def send_conversation_message(
             'senderId': current_user.phoneNumber,
             'content': content,
             'messageType': message_type,
-            'timestamp': now.isoformat(),
+            'timestamp': now_iso,
             'instanceId': os.environ.get("INSTANCE_ID", socket.gethostname()),
             'participants': conversation_data.get('participants', [])
         }
 
-        # Publish to Redis channel for this conversation
-        channel = f"conversation:{conversation_id}"
-        pub_result = await redis_conn.publish(channel, json.dumps(message_event))
+        # Publish to the participants' Redis shard channels
+        pub_result = await publish_conversation_event(redis_conn, conversation_id, message_event, participants=conversation.participants)
 
         if pub_result:
-            logger.info(f"Message event published to Redis channel {channel} with {pub_result} receivers")
+            logger.info(f"Message event published for conversation {conversation_id} with {pub_result} receivers")
         else:
-            logger.warning(f"Published to Redis channel {channel} but found no subscribers")
+            logger.warning(f"Published for conversation {conversation_id} but found no subscribers")
             # This is not an error - just means no online users are listening on the given channel
             # We'll still process offline notifications below
     except Exception as e:
         logger.error(f"Error with Redis Pub/Sub: {str(e)}")
         # Fallback to direct WebSocket broadcast if Redis is not available
         try:
-            await broadcast_message(conversation_id, message_id, current_user.phoneNumber, content, message_type)
+            await broadcast_message(conversation_id, message_id, current_user.phoneNumber, content, message_type,
+                                    participants=conversation.participants, timestamp=now_iso)
             logger.info(f"Used direct WebSocket broadcast as Redis fallback for message {message_id}")
         except Exception as ws_error:
             logger.error(f"Error broadcasting message via WebSocket fallback: {str(ws_error)}")
@@ -196,34 +192,33 @@ async def send_conversation_message(
 
     # Step 4: Send offline push notifications via SQS/Notification Consumer
     participants = conversation_data.get('participants', [])
-    # Run this in a background task to not block the API response
-    asyncio.create_task(
-        process_offline_notifications(
-            conversation_id=conversation_id,
-            message_id=message_id,
-            sender_id=current_user.phoneNumber,
-            content=content,
-            message_type=message_type,
-            timestamp=now,
-            participants=participants
-        )
+    # Hand off to the bounded notification workers to not block the API response
+    enqueue_notification(
+        process_offline_notifications,
+        conversation_id=conversation_id,
+        message_id=message_id,
+        sender_id=current_user.phoneNumber,
+        content=content,
+        message_type=message_type,
+        timestamp=now,
+        participants=participants
     )
 
     # Return success response
     return {
         'messageId': message_id,
-        'timestamp': now.isoformat(),
+        'timestamp': now_iso,
         'status': 'sent'
     }
 
 @router.post('/conversations/{conversation_id}/files',
-             tags=tags,
-             dependencies=[Depends(verify_conversation_participant)])
+             tags=tags)
 async def upload_conversation_file(
         conversation_id: str,
         messageType: Annotated[str, Form()],
         file: Annotated[UploadFile, File()],
         current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)],
+        conversation: ConversationCtx,
         description: Annotated[Optional[str], Form()] = None,
 ):
     """
@@ -235,6 +230,7 @@ async def upload_conversation_file(
         file: The file to upload
         description: Optional description of the file
         current_user: The authenticated user making the request
+        conversation: The conversation, loaded and participation-checked by the dependency
 
     Returns:
         dict: Message ID, file URL, and status
@@ -246,11 +242,10 @@ async def upload_conversation_file(
         500: If there's a database, S3, or other error
     """
     # Validate message type for file uploads
-    if messageType not in [MessageType.IMAGE.value, MessageType.VIDEO.value,
-                         MessageType.AUDIO.value, MessageType.FILE.value]:
+    if messageType not in FILE_MESSAGE_TYPES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid file message type. Must be one of: {[MessageType.IMAGE.value, MessageType.VIDEO.value, MessageType.AUDIO.value, MessageType.FILE.value]}"
+            detail=f"Invalid file message type. Must be one of: {FILE_MESSAGE_TYPE_LIST}"
         )
 
     # Validate file exists
@@ -290,9 +285,10 @@ async def upload_conversation_file(
         )
 
     # Get conversation data
-    conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-    conversation = await asyncio.to_thread(conversation_ref.get)
-    conversation_data = conversation.to_dict()
+    client = get_firestore_async_client()
+    conversation_ref = client.collection('conversations').document(conversation_id)
+    # Loaded by the ConversationCtx dependency (shared with the cache), read-only here
+    conversation_data = conversation.data
 
     # Generate a unique S3 key for the file
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -326,6 +322,7 @@ async def upload_conversation_file(
         # Create message with file info
         message_id = str(uuid.uuid4())
         now = datetime.now(timezone.utc)
+        now_iso = now.isoformat()
 
         # Use description as content if provided, otherwise use filename
         content = description if description else file.filename
@@ -344,59 +341,25 @@ async def upload_conversation_file(
             }
         }
 
-        # Save message to Firestore
-        message_ref = firestore_db.collection('conversations').document(conversation_id).collection(
-            'messages').document(message_id)
-        await asyncio.to_thread(message_ref.set, message_data)
-        logger.info(f"File message {message_id} saved to Firestore for conversation {conversation_id}")
-
-        # Update conversation metadata
+        # Save message, update conversation metadata and the other participants' unread
+        # counts in one atomic commit
+        message_ref = conversation_ref.collection('messages').document(message_id)
         preview = f"{messageType.capitalize()}: {file.filename}"
-        await asyncio.to_thread(
-            conversation_ref.update,
+        await _commit_new_message(
+            client,
+            conversation_ref,
+            message_ref,
+            message_data,
             {
                 'lastMessageTime': firestore.SERVER_TIMESTAMP,
                 'lastMessagePreview': preview,
                 'lastMessageType': messageType,
                 'lastMessageSenderId': current_user.phoneNumber
-            }
+            },
+            conversation_data.get('participants', []),
+            current_user.phoneNumber
         )
-
-        # Update unread counts for all participants except the sender
-        try:
-            participants = conversation_data.get('participants', [])
-            sender_id = current_user.phoneNumber
-            batch = firestore_db.batch()
-
-            # Create a batch to update all participants' unread counts atomically
-            for participant in participants:
-                if participant == sender_id:
-                    continue  # Skip sender, they've already read the message
-
-                # Get user stats reference
-                user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
-                                 .collection('user_stats').document(participant)
-
-                # Check if user stats exist first
-                user_stats = await asyncio.to_thread(user_stats_ref.get)
-
-                if user_stats.exists:
-                    # Increment existing unread count
-                    current_count = user_stats.to_dict().get('unreadCount', 0)
-                    batch.update(user_stats_ref, {'unreadCount': current_count + 1})
-                else:
-                    # Create new user stats with unread count of 1
-                    batch.set(user_stats_ref, {
-                        'unreadCount': 1,
-                        'lastReadMessageId': None
-                    })
-
-            # Commit all the unread count updates
-            await asyncio.to_thread(batch.commit)
-            logger.info(f"Updated unread counts for participants in conversation {conversation_id}")
-        except Exception as e:
-            logger.error(f"Error updating unread counts: {str(e)}")
-            # Continue processing even if unread count updates fail
+        logger.info(f"File message {message_id} saved to Firestore for conversation {conversation_id}")
 
         # Publish to Redis for real-time notifications
         try:
@@ -409,49 +372,48 @@ async def upload_conversation_file(
                 'senderId': current_user.phoneNumber,
                 'content': content,
                 'messageType': messageType,
-                'timestamp': now.isoformat(),
+                'timestamp': now_iso,
                 'instanceId': os.environ.get("INSTANCE_ID", socket.gethostname()),
                 'participants': conversation_data.get('participants', []),
                 'file_url': file_url,  # Include the file URL for clients
                 'file_info': file_info.dict()  # Include file metadata
             }
 
-            channel = f"conversation:{conversation_id}"
-            pub_result = await redis_conn.publish(channel, json.dumps(message_event))
+            pub_result = await publish_conversation_event(redis_conn, conversation_id, message_event, participants=conversation.participants)
 
             if pub_result:
-                logger.info(f"File message event published to Redis channel {channel}")
+                logger.info(f"File message event published for conversation {conversation_id}")
             else:
-                logger.warning(f"Published to Redis channel {channel} but found no subscribers")
+                logger.warning(f"Published for conversation {conversation_id} but found no subscribers")
         except Exception as e:
             logger.error(f"Error with Redis Pub/Sub: {str(e)}")
             # Fallback to direct WebSocket broadcast
             try:
                 # Add file info to the message for WebSocket broadcast
                 await broadcast_file_message(conversation_id, message_id, current_user.phoneNumber,
-                                       content, messageType, file_url, file_info.dict())
+                                       content, messageType, file_url, file_info.dict(),
+                                       participants=conversation.participants, timestamp=now_iso)
             except Exception as ws_error:
                 logger.error(f"Error broadcasting file message via WebSocket: {str(ws_error)}")
 
         # Process offline notifications in background
         participants = conversation_data.get('participants', [])
-        asyncio.create_task(
-            process_offline_notifications(
-                conversation_id=conversation_id,
-                message_id=message_id,
-                sender_id=current_user.phoneNumber,
-                content=content,
-                message_type=messageType,
-                timestamp=now,
-                participants=participants
-            )
+        enqueue_notification(
+            process_offline_notifications,
+            conversation_id=conversation_id,
+            message_id=message_id,
+            sender_id=current_user.phoneNumber,
+            content=content,
+            message_type=messageType,
+            timestamp=now,
+            participants=participants
         )
 
         # Return success response with file URL
         return {
             'messageId': message_id,
             'file_url': file_url,
-            'timestamp': now.isoformat(),
+            'timestamp': now_iso,
             'status': 'sent'
         }
 
@@ -464,7 +426,8 @@ async def upload_conversation_file(
 
 
 async def broadcast_file_message(conversation_id: str, message_id: str, sender_id: str, 
-                           content: str, message_type: str, file_url: str, file_info: dict):
+                           content: str, message_type: str, file_url: str, file_info: dict,
+                           participants: Optional[Iterable[str]] = None, timestamp: Optional[str] = None):
     """
     Broadcast a file message to all participants in a conversation using WebSocket
     This is a fallback method used when Redis PubSub is not available
@@ -477,6 +440,8 @@ async def broadcast_file_message(conversation_id: str, message_id: str, sender_i
         message_type: The message type
         file_url: The presigned URL to access the file
         file_info: File metadata
+        participants: Participant IDs, if the caller already has them
+        timestamp: ISO timestamp of the stored message; defaults to now
     """
     # Prepare the event data
     message_event = {
@@ -486,16 +451,18 @@ async def broadcast_file_message(conversation_id: str, message_id: str, sender_i
         'senderId': sender_id,
         'content': content,
         'messageType': message_type,
-        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'timestamp': timestamp or datetime.now(timezone.utc).isoformat(),
         'file_url': file_url,
         'file_info': file_info
     }
 
     # Use the connection manager to broadcast the message
-    await connection_manager.broadcast_to_conversation(message_event, conversation_id, skip_user_id=sender_id)
+    await connection_manager.broadcast_to_conversation(message_event, conversation_id, skip_user_id=sender_id,
+                                                      participants=participants)
     logger.debug(f"Directly broadcast file message {message_id} to conversation {conversation_id} via WebSocket")
 
-async def broadcast_message(conversation_id: str, message_id: str, sender_id: str, content: str, message_type: str):
+async def broadcast_message(conversation_id: str, message_id: str, sender_id: str, content: str, message_type: str,
+                            participants: Optional[Iterable[str]] = None, timestamp: Optional[str] = None):
     """
     Broadcast a message to all participants in a conversation using WebSocket
     This is a fallback method used when Redis PubSub is not available
@@ -506,6 +473,8 @@ async def broadcast_message(conversation_id: str, message_id: str, sender_id: st
         sender_id: The ID of the sender
         content: The message content
         message_type: The message type
+        participants: Participant IDs, if the caller already has them
+        timestamp: ISO timestamp of the stored message; defaults to now
     """
     # Prepare the event data
     message_event = {
@@ -515,11 +484,12 @@ async def broadcast_message(conversation_id: str, message_id: str, sender_id: st
         'senderId': sender_id,
         'content': content,
         'messageType': message_type,
-        'timestamp': datetime.now(timezone.utc).isoformat()
+        'timestamp': timestamp or datetime.now(timezone.utc).isoformat()
     }
 
     # Use the connection manager to broadcast the message
-    await connection_manager.broadcast_to_conversation(message_event, conversation_id, skip_user_id=sender_id)
+    await connection_manager.broadcast_to_conversation(message_event, conversation_id, skip_user_id=sender_id,
+                                                      participants=participants)
     logger.debug(f"Directly broadcast message {message_id} to conversation {conversation_id} via WebSocket")
     
 
@@ -545,20 +515,17 @@ async def process_offline_notifications(conversation_id: str, message_id: str, s
         # First check Redis to see which users have active connections
         try:
             redis_conn = await get_redis_connection()
-            online_users = []
+            # Skip sender, they don't need a notification
+            recipients = [p for p in participants if p != sender_id]
             
-            # Check each participant to see if they have active connections
-            for participant in participants:
-                if participant == sender_id:
-                    continue  # Skip sender, they don't need a notification
-                    
-                # Check if user has any active connections in Redis
-                conn_count = await redis_conn.hlen(f"connections:{participant}")
-                if conn_count > 0:
-                    online_users.append(participant)
+            # Check every recipient's active connections in one pipelined round trip
+            async with redis_conn.pipeline(transaction=False) as pipe:
+                for participant in recipients:
+                    pipe.hlen(f"connections:{participant}")
+                conn_counts = await pipe.execute()
             
             # Remove online users from notification list
-            offline_participants = [p for p in participants if p != sender_id and p not in online_users]
+            offline_participants = [p for p, conn_count in zip(recipients, conn_counts) if conn_count == 0]
             
             if not offline_participants:
                 logger.info(f"All participants for message {message_id} are online, no offline notifications needed")
@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import socket
@@ -8,6 +7,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 
 from ..dependencies import decode_token, AuthenticatedUser, get_current_active_user, verify_conversation_participant
 from ..notifications.service import NotificationService
+from ..redis.channels import publish_conversation_event
 from ..redis.connection import get_redis_connection
 from ..ws.router import get_connection_manager
 
@@ -59,14 +59,13 @@ async def send_typing_notification(
             'instanceId': os.environ.get("INSTANCE_ID", socket.gethostname())
         }
         
-        # Publish to Redis channel
-        channel = f"conversation:{conversation_id}"
-        pub_result = await redis_conn.publish(channel, json.dumps(typing_event))
+        # Publish to the participants' Redis shard channels
+        pub_result = await publish_conversation_event(redis_conn, conversation_id, typing_event)
         
         if pub_result:
-            logger.debug(f"Typing notification published to Redis channel {channel} with {pub_result} receivers")
+            logger.debug(f"Typing notification published for conversation {conversation_id} with {pub_result} receivers")
         else:
-            logger.debug(f"Published typing notification to Redis channel {channel} but found no subscribers")
+            logger.debug(f"Published typing notification for conversation {conversation_id} but found no subscribers")
         
         return {'status': 'success'}
     except Exception as e:
@@ -116,10 +116,20 @@ class MessageType(str, Enum):
     FILE = "file"  # Generic file type for other documents
 
 
+# Plain string values, so the error messages built from the list show "image" rather
+# than "MessageType.IMAGE"; str-Enum members compare equal to their values either way
+FILE_MESSAGE_TYPES = frozenset({
+    MessageType.IMAGE.value, MessageType.VIDEO.value, MessageType.AUDIO.value, MessageType.FILE.value
+})
+# Sorted once for error messages
+FILE_MESSAGE_TYPE_LIST = sorted(FILE_MESSAGE_TYPES)
+
+
 class MessageCreate(BaseModel):
     """Request body for creating a new message"""
-    content: str
-    messageType: str = "text"
+    # Validated by pydantic-core: empty content and unknown types are rejected with 422
+    content: str = Field(min_length=1)
+    messageType: MessageType = MessageType.TEXT
     
 
 class FileInfo(BaseModel):
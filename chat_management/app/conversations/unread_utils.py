@@ -1,13 +1,14 @@
-import asyncio
 import logging
 from typing import Dict, List, Optional
 
 from fastapi import HTTPException, status
 
-from ..firebase import firestore_db
+from ..conversation_cache import get_cached_conversation
+from ..firebase import conversations_collection, fs_run
 
 logger = logging.getLogger(__name__)
 
+
 async def recompute_unread_count(conversation_id: str, user_id: str) -> int:
     """
     Recompute the unread count for a user in a conversation
@@ -24,8 +25,8 @@ async def recompute_unread_count(conversation_id: str, user_id: str) -> int:
         Exception: If there's an error accessing Firestore
     """
     try:
-        messages_ref = firestore_db.collection('conversations').document(conversation_id).collection('messages')
-        all_messages = await asyncio.to_thread(messages_ref.get)
+        messages_ref = conversations_collection.document(conversation_id).collection('messages')
+        all_messages = await fs_run(messages_ref.get)
         
         # Count messages that don't have the user in readBy array
         unread_count = 0
@@ -36,20 +37,20 @@ async def recompute_unread_count(conversation_id: str, user_id: str) -> int:
                 unread_count += 1
         
         # Update the unread count in user_stats
-        user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
+        user_stats_ref = conversations_collection.document(conversation_id) \
                         .collection('user_stats').document(user_id)
         
-        user_stats = await asyncio.to_thread(user_stats_ref.get)
+        user_stats = await fs_run(user_stats_ref.get)
         
         if user_stats.exists:
             stored_count = user_stats.to_dict().get('unreadCount', 0)
             # Only update if counts don't match
             if stored_count != unread_count:
-                await asyncio.to_thread(user_stats_ref.update, {'unreadCount': unread_count})
+                await fs_run(user_stats_ref.update, {'unreadCount': unread_count})
                 logger.info(f"Fixed unread count for user {user_id} in conversation {conversation_id} from {stored_count} to {unread_count}")
         else:
             # Create new user stats document
-            await asyncio.to_thread(user_stats_ref.set, {
+            await fs_run(user_stats_ref.set, {
                 'unreadCount': unread_count,
                 'lastReadMessageId': None
             })
@@ -82,19 +83,18 @@ async def recompute_all_user_unread_counts(user_id: str, specific_conversation_i
     
     try:
         if specific_conversation_id:
-            # Verify the conversation exists
-            conversation_ref = firestore_db.collection('conversations').document(specific_conversation_id)
-            conversation = await asyncio.to_thread(conversation_ref.get)
+            # Verify the conversation exists (served from the short-lived conversation cache)
+            conversation_ref = conversations_collection.document(specific_conversation_id)
+            conversation = await get_cached_conversation(specific_conversation_id)
             
-            if not conversation.exists:
+            if conversation is None:
                 raise HTTPException(
                     status_code=status.HTTP_404_NOT_FOUND,
                     detail="Conversation not found"
                 )
             
             # Verify the user is a participant
-            conversation_data = conversation.to_dict()
-            if user_id not in conversation_data.get('participants', []):
+            if user_id not in conversation.participants:
                 raise HTTPException(
                     status_code=status.HTTP_403_FORBIDDEN,
                     detail="User is not a participant in this conversation"
@@ -103,7 +103,7 @@ async def recompute_all_user_unread_counts(user_id: str, specific_conversation_i
             # Recompute unread count for this conversation
             old_count = 0
             user_stats_ref = conversation_ref.collection('user_stats').document(user_id)
-            user_stats = await asyncio.to_thread(user_stats_ref.get)
+            user_stats = await fs_run(user_stats_ref.get)
             
             if user_stats.exists:
                 old_count = user_stats.to_dict().get('unreadCount', 0)
@@ -122,9 +122,9 @@ async def recompute_all_user_unread_counts(user_id: str, specific_conversation_i
             })
         else:
             # Get all conversations for the user
-            conversations_ref = firestore_db.collection('conversations')
+            conversations_ref = conversations_collection
             query = conversations_ref.where('participants', 'array_contains', user_id)
-            conversations = await asyncio.to_thread(query.get)
+            conversations = await fs_run(query.get)
             
             # Process each conversation
             for conversation in conversations:
@@ -132,9 +132,9 @@ async def recompute_all_user_unread_counts(user_id: str, specific_conversation_i
                 try:
                     # Get current unread count
                     old_count = 0
-                    user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
+                    user_stats_ref = conversations_collection.document(conversation_id) \
                                     .collection('user_stats').document(user_id)
-                    user_stats = await asyncio.to_thread(user_stats_ref.get)
+                    user_stats = await fs_run(user_stats_ref.get)
                     
                     if user_stats.exists:
                         old_count = user_stats.to_dict().get('unreadCount', 0)
@@ -183,8 +183,8 @@ async def find_inconsistent_unread_counts() -> List[Dict]:
     
     try:
         # Get all conversations
-        conversations_ref = firestore_db.collection('conversations')
-        conversations = await asyncio.to_thread(conversations_ref.get)
+        conversations_ref = conversations_collection
+        conversations = await fs_run(conversations_ref.get)
         
         for conversation in conversations:
             conversation_id = conversation.id
@@ -195,9 +195,9 @@ async def find_inconsistent_unread_counts() -> List[Dict]:
             for user_id in participants:
                 try:
                     # Get stored unread count
-                    user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
+                    user_stats_ref = conversations_collection.document(conversation_id) \
                                    .collection('user_stats').document(user_id)
-                    user_stats = await asyncio.to_thread(user_stats_ref.get)
+                    user_stats = await fs_run(user_stats_ref.get)
                     
                     if not user_stats.exists:
                         # User stats don't exist, this is an inconsistency
@@ -213,9 +213,9 @@ async def find_inconsistent_unread_counts() -> List[Dict]:
                     stored_count = user_stats.to_dict().get('unreadCount', 0)
                     
                     # Count actual unread messages
-                    messages_ref = firestore_db.collection('conversations').document(conversation_id) \
+                    messages_ref = conversations_collection.document(conversation_id) \
                                  .collection('messages')
-                    all_messages = await asyncio.to_thread(messages_ref.get)
+                    all_messages = await fs_run(messages_ref.get)
                     
                     actual_unread_count = 0
                     for msg in all_messages:
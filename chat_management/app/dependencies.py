@@ -1,68 +1,114 @@
 import asyncio
+import functools
 import logging
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import Annotated, Any, Dict
 
-from app.firebase import firestore_db
+from app.auth_cache import get_verified_claims
+from app.conversation_cache import get_cached_conversation
 from app.phone_utils import is_phone_number, format_phone_number
 from app.service_env import Environment
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Path, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from firebase_admin import auth
 from pydantic import BaseModel
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler()]
-)
-
 logger = logging.getLogger(__name__)
 
 security = HTTPBearer(scheme_name='Authorization')
 
+# Dedicated pool for blocking Firebase token verification so it neither stalls the
+# event loop nor competes with FastAPI's default threadpool (run_in_threadpool)
+_verify_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="verify-id-token")
+
+# Built once at import instead of per signature so FastAPI reuses the same Depends object
+_SECURITY_DEP = Depends(security)
+
+# Maps token verification errors to (status_code, detail)
+_ERR_MAP = {
+    ValueError: (401, "Invalid token format"),
+    auth.ExpiredIdTokenError: (401, "Token has expired"),
+    auth.RevokedIdTokenError: (401, "Token has been revoked"),
+    auth.InvalidIdTokenError: (401, "Invalid ID token"),
+    auth.CertificateFetchError: (500, "Error fetching certificates"),
+    auth.UserDisabledError: (403, "User account is disabled"),
+}
+_DEFAULT_ERR = (500, "Authentication error")
+
+# Fixed (status_code, detail) errors. A fresh HTTPException is raised each time: a shared
+# instance would carry one request's traceback and exception context into the next
+_ERR_CONVERSATION_NOT_FOUND = (status.HTTP_404_NOT_FOUND, "Conversation not found")
+_ERR_NOT_PARTICIPANT = (status.HTTP_403_FORBIDDEN, "User is not a participant in this conversation")
+_ERR_PARTICIPATION_CHECK = (status.HTTP_500_INTERNAL_SERVER_ERROR, "Error verifying conversation participation")
+
 class AuthenticatedUser(BaseModel):
     phoneNumber: str
     isDisabled: bool = False
 
-async def decode_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict[str, Any]:
+async def _verify_id_token(token: str) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _verify_pool,
+        functools.partial(auth.verify_id_token, token, check_revoked=True)
+    )
+
+async def verify_firebase_token(token: str) -> Dict[str, Any]:
+    """
+    Verify a Firebase ID token off the event loop, reusing recently verified claims.
+
+    Shared by the HTTP dependencies and the WebSocket handshake so both get the same
+    verifier pool and token cache.
+
+    Raises:
+        The firebase_admin.auth verification errors, unchanged.
+    """
+    return await get_verified_claims(token, _verify_id_token)
+
+def claims_to_user(claims: Dict[str, Any]) -> AuthenticatedUser:
+    # Firebase claims carry phone_number in E.164 form, so no need to format it again
+    return AuthenticatedUser(
+        phoneNumber=claims["phone_number"],
+        isDisabled=claims.get("is_disabled", False)
+    )
+
+async def decode_token(
+    credentials: HTTPAuthorizationCredentials = _SECURITY_DEP
+) -> AuthenticatedUser | dict[str, Any]:
     token = credentials.credentials
         
     if Environment.is_dev_environment():
-        logger.info(f"Token: {token}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Token prefix: %s…", token[:8])
         if not is_phone_number(token):
             raise HTTPException(status_code=401, detail="Not a valid Vietnamese phone number")
-        return dict(phone_number=format_phone_number(token), is_disabled=False)
+        return AuthenticatedUser(phoneNumber=format_phone_number(token))
     
     try:
-        return auth.verify_id_token(token, check_revoked=True)
-    except ValueError:
-        raise HTTPException(status_code=401, detail="Invalid token format")
-    except auth.ExpiredIdTokenError:
-        raise HTTPException(status_code=401, detail="Token has expired")
-    except auth.RevokedIdTokenError:
-        raise HTTPException(status_code=401, detail="Token has been revoked")
-    except auth.InvalidIdTokenError:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
-    except auth.CertificateFetchError:
-        raise HTTPException(status_code=500, detail="Error fetching certificates")
-    except auth.UserDisabledError:
-        raise HTTPException(status_code=403, detail="User account is disabled")
+        return await verify_firebase_token(token)
     except Exception as e:
-        logger.error(f"Token verification error: {str(e)}")
-        raise HTTPException(status_code=500, detail="Authentication error")
+        # Most specific class wins: walk the MRO so subclasses map like their parents
+        mapped = next((_ERR_MAP[cls] for cls in type(e).__mro__ if cls in _ERR_MAP), None)
+        if mapped is None:
+            logger.error(f"Token verification error: {str(e)}")
+            mapped = _DEFAULT_ERR
+        status_code, detail = mapped
+        raise HTTPException(status_code=status_code, detail=detail)
     
 async def get_current_active_user(
-    decoded_token: Annotated[AuthenticatedUser, Depends(decode_token)],
+    decoded_token: Annotated[AuthenticatedUser | dict[str, Any], Depends(decode_token)],
 ) -> AuthenticatedUser:
-    return AuthenticatedUser(
-        phoneNumber=format_phone_number(decoded_token["phone_number"]),
-        isDiasbled=False
-    )
+    # Dev mode already hands back a normalized user; only prod claims need converting
+    if isinstance(decoded_token, AuthenticatedUser):
+        return decoded_token
+    return claims_to_user(decoded_token)
+
+# Shared annotated dependency for endpoints that need the authenticated user
+CurrentUser = Annotated[AuthenticatedUser, Depends(get_current_active_user)]
 
 async def verify_conversation_participant(
     conversation_id: Annotated[str, Path(description="The ID of the conversation to check participation.")],
-    current_user: Annotated[AuthenticatedUser, Depends(get_current_active_user)]
+    current_user: CurrentUser
 ) -> Dict[str, Any]:
     """
     Dependency that verifies if the current user is a participant
@@ -73,41 +119,90 @@ async def verify_conversation_participant(
         HTTPException(403): If the current user is not a participant.
 
     Returns:
-        The conversation data dictionary if the user is a participant.
+        The (shared, read-only) conversation data dictionary if the user is a participant.
     """
     user_id = current_user.phoneNumber
     try:
-        conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-        # Use asyncio.to_thread for sync Firestore client potentially blocking calls
-        conversation = await asyncio.to_thread(conversation_ref.get)
+        # Served from the short-lived conversation cache on hot conversations
+        conversation = await get_cached_conversation(conversation_id)
 
-        if not conversation.exists:
+        if conversation is None:
             logger.warning(f"Conversation {conversation_id} not found. User: {user_id}")
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Conversation not found"
-            )
-
-        conversation_data = conversation.to_dict()
-        participants = conversation_data.get('participants', [])
+            raise HTTPException(*_ERR_CONVERSATION_NOT_FOUND)
 
-        if user_id not in participants:
+        # O(1) check against the participant set built when the cache was filled
+        if user_id not in conversation.participants:
             logger.warning(f"User {user_id} is not a participant in conversation {conversation_id}.")
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="User is not a participant in this conversation"
-            )
+            raise HTTPException(*_ERR_NOT_PARTICIPANT)
 
         logger.debug(f"User {user_id} verified as participant in conversation {conversation_id}.")
         # Return conversation data to potentially avoid fetching it again in the endpoint
-        return conversation_data
+        return conversation.data
 
     except HTTPException:
          # Re-raise HTTP exceptions directly
          raise
     except Exception as e:
         logger.error(f"Error verifying participation for user {user_id} in conv {conversation_id}: {e}", exc_info=True)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error verifying conversation participation"
-        )
\ No newline at end of file
+        raise HTTPException(*_ERR_PARTICIPATION_CHECK) from None
+
+
+@dataclass(frozen=True)
+class ConversationContext:
+    """Conversation document loaded once per request, with precomputed membership sets"""
+    id: str
+    data: Dict[str, Any]
+    participants: frozenset
+    admins: frozenset
+
+
+async def get_conversation_context(
+    conversation_id: Annotated[str, Path(description="The ID of the conversation to load.")],
+    request: Request,
+    current_user: CurrentUser
+) -> ConversationContext:
+    """
+    Dependency that loads the full conversation document once per request,
+    verifies the current user is a participant and caches the result on
+    request.state so later dependencies and the endpoint can reuse it.
+
+    Raises:
+        HTTPException(404): If the conversation is not found.
+        HTTPException(403): If the current user is not a participant.
+
+    Returns:
+        The ConversationContext for the conversation.
+    """
+    cached = getattr(request.state, 'conversation_ctx', None)
+    if cached is not None and cached.id == conversation_id:
+        return cached
+
+    user_id = current_user.phoneNumber
+    try:
+        conversation = await get_cached_conversation(conversation_id)
+
+        if conversation is None:
+            logger.warning(f"Conversation {conversation_id} not found. User: {user_id}")
+            raise HTTPException(*_ERR_CONVERSATION_NOT_FOUND)
+
+        if user_id not in conversation.participants:
+            logger.warning(f"User {user_id} is not a participant in conversation {conversation_id}.")
+            raise HTTPException(*_ERR_NOT_PARTICIPANT)
+
+        ctx = ConversationContext(
+            id=conversation_id,
+            data=conversation.data,
+            participants=conversation.participants,
+            admins=conversation.admins
+        )
+        request.state.conversation_ctx = ctx
+        return ctx
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error loading conversation {conversation_id} for user {user_id}: {e}", exc_info=True)
+        raise HTTPException(*_ERR_PARTICIPATION_CHECK) from None
+
+
+ConversationCtx = Annotated[ConversationContext, Depends(get_conversation_context)]
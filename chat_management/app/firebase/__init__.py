@@ -2,8 +2,14 @@ import firebase_admin
 import google.cloud.firestore
 from firebase_admin import db
 
-from .firebase import FirebaseDB
+from .firebase import FirebaseDB, fs_run, get_firebase_db, get_firestore_async_client
 
-firebase_db = FirebaseDB()
+__all__ = ["FirebaseDB", "fs_run", "get_firebase_db", "get_firestore_async_client", "firebase_db", "realtime_db", "firestore_db", "firestore_async_db", "conversations_collection"]
+
+firebase_db: FirebaseDB = get_firebase_db()
 realtime_db: firebase_admin.db = firebase_db.get_realtime_db()
 firestore_db: google.cloud.firestore.Client = firebase_db.get_firestore_db()
+firestore_async_db: google.cloud.firestore.AsyncClient = firebase_db.get_firestore_async_db()
+
+# Built once at import and shared by every module; collection references are immutable
+conversations_collection: google.cloud.firestore.CollectionReference = firestore_db.collection('conversations')
@@ -1,34 +1,64 @@
-import json
+import asyncio
+import functools
+import itertools
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
 
 import firebase_admin
 import google.cloud.firestore
-from firebase_admin import credentials, db, firestore
+import orjson
+from firebase_admin import credentials, db, firestore, firestore_async
 
 logger = logging.getLogger(__name__)
 
-class FirebaseDB:
-    _instance = None
+T = TypeVar("T")
+
+# Blocking Firestore calls get their own threads so they do not compete with
+# request-body parsing and other sync work for the event loop's default pool
+firestore_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FIRESTORE_THREADS", "64")),
+    thread_name_prefix="fs"
+)
+
+
+async def fs_run(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a blocking (sync client) Firestore call on the dedicated Firestore thread pool.
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(FirebaseDB, cls).__new__(cls)
-            cls._instance.initialized = False
-        return cls._instance
+    Args:
+        fn: Callable to run, e.g. doc_ref.get or batch.commit
+        *args, **kwargs: Arguments passed through to fn
 
+    Returns:
+        Whatever fn returns
+    """
+    loop = asyncio.get_running_loop()
+    if kwargs:
+        fn = functools.partial(fn, **kwargs)
+    return await loop.run_in_executor(firestore_executor, fn, *args)
+
+class FirebaseDB:
     def __init__(self):
-        if self.initialized:
-            return
         logger.info("FirebaseDB.__init__() called")
         # Dir to key
         # should fix this to use GOOGLE_APPLICATION_CREDENTIALS env https://firebase.google.com/docs/admin/setup#initialize_the_sdk_in_non-google_environments
         self.db_url = os.getenv("FIREBASE_DB_URL", "https://zalophake-bf746-default-rtdb.firebaseio.com/")
+        # Bound HTTP calls made by the Admin SDK (cert fetches, RTDB) so a slow Google
+        # endpoint cannot pin a token-verification thread for the 120s SDK default
+        self.http_timeout = float(os.getenv("FIREBASE_HTTP_TIMEOUT", "10"))
         self.app = None
         self.db = None
         self.firestore_db = None
+        self.firestore_async_db = None
+        # Each AsyncClient owns a gRPC channel; spreading requests over several avoids
+        # queueing behind one channel's concurrent-stream limit
+        self.async_pool_size = max(1, int(os.getenv("FIRESTORE_ASYNC_POOL_SIZE", "4")))
+        self.firestore_async_pool = []
+        self._async_pool_cycle = None
         self.connect()
-        self.initialized = True
         return
 
     def get_realtime_db(self) -> db:
@@ -39,11 +69,33 @@ class FirebaseDB:
         # Return a reference to the Firebase client
         return self.firestore_db
 
+    def get_firestore_async_db(self) -> google.cloud.firestore.AsyncClient:
+        # Async client sharing the same app/credentials, for handlers that fan out reads
+        return self.firestore_async_db
+
+    def next_firestore_async_client(self) -> google.cloud.firestore.AsyncClient:
+        # Round-robin over the pool; only called from the event loop thread
+        return next(self._async_pool_cycle)
+
+    def _build_async_pool(self) -> None:
+        # firestore_async.client() caches a single client per app, so the extra
+        # clients are built directly from the app's project and credentials
+        self.firestore_async_db = firestore_async.client(self.app)
+        pool = [self.firestore_async_db]
+        for _ in range(self.async_pool_size - 1):
+            pool.append(google.cloud.firestore.AsyncClient(
+                project=self.firestore_async_db.project,
+                credentials=self.app.credential.get_credential()
+            ))
+        self.firestore_async_pool = pool
+        self._async_pool_cycle = itertools.cycle(pool)
+
     def connect(self) -> None:
         try:
             # Try to get the existing default app
             self.app = firebase_admin.get_app()
             self.firestore_db = firestore.client(self.app)
+            self._build_async_pool()
             self.db = db
             logger.info("Retrieved existing Firebase app")
         except ValueError:
@@ -51,17 +103,41 @@ class FirebaseDB:
             cert_json = os.getenv("FIREBASE_SECRET")
             if not cert_json:
                 raise ValueError("Environment variable FIREBASE_SECRET is not set")
-            cert_dict = json.loads(cert_json)
+            cert_dict = orjson.loads(cert_json)
+            # The secret is sometimes stored double-encoded as a JSON string
             if isinstance(cert_dict, str):
-                cert_dict = json.loads(cert_dict)
+                cert_dict = orjson.loads(cert_dict)
             cred = credentials.Certificate(cert_dict)
 
             self.app = firebase_admin.initialize_app(
                 credential=cred,
-                options={"databaseURL": self.db_url},
+                options={"databaseURL": self.db_url, "httpTimeout": self.http_timeout},
             )
             self.firestore_db = firestore.client(self.app)
+            self._build_async_pool()
             self.db = db
             logger.info(f"Connected to Firebase Realtime Database. App name: {self.app.name}")
         return
 
+
+_instance: Optional[FirebaseDB] = None
+_instance_lock = threading.Lock()
+
+
+def get_firebase_db() -> FirebaseDB:
+    """
+    Return the process-wide FirebaseDB, creating it on first use.
+
+    The lock keeps concurrent cold starts from racing on firebase_admin.initialize_app.
+    """
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            if _instance is None:
+                _instance = FirebaseDB()
+    return _instance
+
+
+def get_firestore_async_client() -> google.cloud.firestore.AsyncClient:
+    """Return the next Firestore AsyncClient from the process-wide pool."""
+    return get_firebase_db().next_firestore_async_client()
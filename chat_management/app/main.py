@@ -1,19 +1,30 @@
 import asyncio
 import logging
 import os
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Depends
+import anyio.to_thread
+from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from fastapi.utils import is_body_allowed_for_status_code
 from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.responses import Response
 
+from .aws.sqs_utils import start_sqs_flusher, stop_sqs_flusher
 from .config import get_prefix
 from .conversations import all_router as conversations_routers
 from .dependencies import decode_token
-from .firebase import firestore_db
+from .firebase import firestore_db, fs_run, get_firebase_db
+from .notifications.queue import start_notification_workers, stop_notification_workers
 from .notifications.router import router as notifications_router
 from .redis.pubsub import start_pubsub_listener
+from .service_env import Environment
 from .ws.api_endpoints import router as ws_api_router
 from .ws.router import router as ws_router
+from .ws.websocket_manager import get_connection_manager
 
 # import all you need from fastapi-pagination
 
@@ -31,26 +42,114 @@ origins = [
     "http://127.0.0.1:3000"
 ]
 
-# Print all environment variables
-for key, value in os.environ.items():
-    print(f"{key}: {value}")
-
 logger = logging.getLogger(__name__)
 
+ANYIO_THREAD_TOKENS = int(os.getenv("ANYIO_THREAD_TOKENS", "128"))
+
+# Opt-in only, as one record with variable names; values may hold secrets
+if os.getenv("DEBUG_ENV_DUMP") == "1" and Environment.is_dev_environment():
+    logger.debug("Environment variables: %s", sorted(os.environ))
+
 
 API_VERSION = '/api/v1'
 PREFIX = get_prefix(API_VERSION)
 
 logger.info(f"Start HTTP server with prefix: {PREFIX}")
 
-app = FastAPI(root_path=PREFIX, title="Chat Management API", version="1.0.0")
+
+async def init_health_document():
+    """Create the Firestore health check document if it doesn't exist, in a single write."""
+    health_ref = firestore_db.collection('system').document('health')
+    try:
+        # create() fails if the document exists, so no separate existence read is needed
+        await fs_run(health_ref.create, {
+            'status': 'healthy',
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        logger.info("Initialized health check document in Firestore")
+    except AlreadyExists:
+        pass
+    except Exception as e:
+        logger.error(f"Failed to initialize health check document: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Initialize background tasks and services before serving, and stop them on shutdown
+    """
+    # Start Redis PubSub listener for WebSocket message distribution across instances
+    asyncio.create_task(start_pubsub_listener())
+    logger.info("Started Redis PubSub listener for WebSocket message distribution")
+
+    # Fixed pool of workers for background notification fan-out
+    start_notification_workers()
+
+    # Coalesce SQS sends into SendMessageBatch requests
+    start_sqs_flusher()
+
+    # Close WebSocket connections whose disconnect was never observed
+    idle_sweeper = asyncio.create_task(get_connection_manager().sweep_idle_connections())
+
+    # Sync dependencies and file uploads run on anyio's thread limiter (40 by default);
+    # Firestore calls have their own executor (fs_run), so this only covers the rest
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ANYIO_THREAD_TOKENS
+    
+    # Initialize the health check document in the background so startup does not wait on it;
+    # the reference keeps the task alive for the lifetime of the app
+    health_init = asyncio.create_task(init_health_document())
+
+    # Open every pooled async client's gRPC channel now, so the first requests
+    # do not pay connection setup
+    warmup = await asyncio.gather(
+        *[client.collection('system').document('health').get()
+          for client in get_firebase_db().firestore_async_pool],
+        return_exceptions=True
+    )
+    failed = [r for r in warmup if isinstance(r, Exception)]
+    if failed:
+        logger.warning(f"Firestore async warm-up failed for {len(failed)} client(s): {failed[0]}")
+    
+    # Log instance information
+    instance_id = os.environ.get("INSTANCE_ID", "local")
+    logger.info(f"Server instance {instance_id} started successfully")
+
+    yield
+
+    health_init.cancel()
+    idle_sweeper.cancel()
+    await stop_notification_workers()
+    await stop_sqs_flusher()
+
+
+# orjson serializes responses (including datetimes) much faster than the stdlib json encoder
+app = FastAPI(
+    root_path=PREFIX,
+    title="Chat Management API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+# default_response_class does not apply to FastAPI's built-in HTTPException handler,
+# so auth/permission errors (the most common non-2xx responses) are rendered with orjson here
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException) -> Response:
+    headers = getattr(exc, "headers", None)
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    # Header strings are precomputed by Starlette; a set makes the per-request origin check O(1)
+    allow_origins=frozenset(origins),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let browsers cache preflight results for a day instead of re-sending OPTIONS before
+    # each cross-origin request (browsers may clamp this to their own maximum)
+    max_age=86400,
 )
 
 @app.get("/whoami", tags=["Dev test"])
@@ -66,27 +165,3 @@ for router in conversations_routers:
 app.include_router(notifications_router)
 app.include_router(ws_router)
 app.include_router(ws_api_router)
-
-
-@app.on_event("startup")
-async def startup_event():
-    """
-    Run on application startup to initialize background tasks and services
-    """
-    # Start Redis PubSub listener for WebSocket message distribution across instances
-    asyncio.create_task(start_pubsub_listener())
-    logger.info("Started Redis PubSub listener for WebSocket message distribution")
-    
-    # Initialize health check document in Firestore if it doesn't exist
-
-    health_ref = firestore_db.collection('system').document('health')
-    if not health_ref.get().exists:
-        health_ref.set({
-            'status': 'healthy',
-            'created_at': firestore.SERVER_TIMESTAMP
-        })
-        logger.info("Initialized health check document in Firestore")
-    
-    # Log instance information
-    instance_id = os.environ.get("INSTANCE_ID", "local")
-    logger.info(f"Server instance {instance_id} started successfully")
\ No newline at end of file
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bounded so a burst of messages applies backpressure instead of spawning unbounded tasks
+QUEUE_MAXSIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", "1024"))
+WORKER_COUNT = int(os.getenv("NOTIFICATION_WORKERS", "8"))
+
+Job = Tuple[Callable[..., Awaitable[Any]], dict]
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+
+
+async def _notification_worker(queue: asyncio.Queue) -> None:
+    while True:
+        func, kwargs = await queue.get()
+        try:
+            await func(**kwargs)
+        except Exception as e:
+            logger.error(f"Notification job {getattr(func, '__name__', func)} failed: {str(e)}")
+        finally:
+            queue.task_done()
+
+
+def start_notification_workers(worker_count: int = WORKER_COUNT) -> None:
+    """
+    Create the notification queue and its fixed pool of worker tasks.
+    Must be called from the running event loop (application startup).
+    """
+    global _queue
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+    for _ in range(worker_count):
+        _workers.append(asyncio.create_task(_notification_worker(_queue)))
+    logger.info(f"Started {worker_count} notification workers (queue size {QUEUE_MAXSIZE})")
+
+
+async def stop_notification_workers() -> None:
+    """Cancel the notification workers; queued jobs that have not started are dropped."""
+    global _queue
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queue = None
+
+
+def enqueue_notification(func: Callable[..., Awaitable[Any]], **kwargs: Any) -> bool:
+    """
+    Schedule func(**kwargs) on the notification workers without waiting for it.
+
+    Returns:
+        bool: True if the job was queued (or started), False if it was dropped because the queue is full
+    """
+    if _queue is None:
+        # Workers not started (e.g. outside the app lifecycle): keep the previous fire-and-forget behaviour
+        asyncio.create_task(func(**kwargs))
+        return True
+    try:
+        _queue.put_nowait((func, kwargs))
+        return True
+    except asyncio.QueueFull:
+        logger.warning(f"Notification queue full, dropping {getattr(func, '__name__', func)} job")
+        return False
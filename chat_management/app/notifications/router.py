@@ -8,7 +8,7 @@ from firebase_admin import firestore
 from .schemas import Notification, NotificationPreference, DeviceToken
 from .service import NotificationService
 from ..dependencies import get_current_active_user, AuthenticatedUser
-from ..firebase import firestore_db
+from ..firebase import firestore_db, fs_run
 from ..pagination import common_pagination_parameters, PaginatedResponse, PaginationParams
 
 logger = logging.getLogger(__name__)
@@ -37,11 +37,11 @@ async def get_notifications(
         query = query.where('isRead', '==', False)
 
     # Get total count for pagination
-    total_docs = query.get()
+    total_docs = await fs_run(query.get)
     total_notifications = len(total_docs)
 
     # Apply pagination
-    paginated_notifs = query.offset((pagination.page - 1) * pagination.size).limit(pagination.size).get()
+    paginated_notifs = await fs_run(query.offset((pagination.page - 1) * pagination.size).limit(pagination.size).get)
 
     notifications = []
     for notif in paginated_notifs:
@@ -72,7 +72,7 @@ async def mark_notification_as_read(
 
     # Get the notification
     notif_ref = firestore_db.collection('notifications').document(notification_id)
-    notif = notif_ref.get()
+    notif = await fs_run(notif_ref.get)
 
     if not notif.exists:
         raise HTTPException(status_code=404, detail="Notification not found")
@@ -88,17 +88,17 @@ async def mark_notification_as_read(
         return {'status': 'success'}
 
     # Mark as read
-    notif_ref.update({'isRead': True})
+    await fs_run(notif_ref.update, {'isRead': True})
 
     # Update user's unread count
     user_ref = firestore_db.collection('users').document(user_id)
-    user = user_ref.get()
+    user = await fs_run(user_ref.get)
 
     if user.exists:
         user_data = user.to_dict()
         unread_count = user_data.get('unreadNotifications', 0)
         if unread_count > 0:
-            user_ref.update({'unreadNotifications': unread_count - 1})
+            await fs_run(user_ref.update, {'unreadNotifications': unread_count - 1})
 
     return {'status': 'success'}
 
@@ -113,7 +113,7 @@ async def mark_all_notifications_as_read(
 
     # Get unread notifications
     notifications_ref = firestore_db.collection('notifications')
-    unread_notifs = notifications_ref.where('userId', '==', user_id).where('isRead', '==', False).stream()
+    unread_notifs = await fs_run(notifications_ref.where('userId', '==', user_id).where('isRead', '==', False).get)
 
     # Update each notification
     batch = firestore_db.batch()
@@ -121,11 +121,11 @@ async def mark_all_notifications_as_read(
         batch.update(notif.reference, {'isRead': True})
 
     # Execute batch update
-    batch.commit()
+    await fs_run(batch.commit)
 
     # Reset unread count
     user_ref = firestore_db.collection('users').document(user_id)
-    user_ref.update({'unreadNotifications': 0})
+    await fs_run(user_ref.update, {'unreadNotifications': 0})
 
     return {'status': 'success'}
 
@@ -140,12 +140,12 @@ async def get_notification_preferences(
 
     # Get preferences from Firestore
     pref_ref = firestore_db.collection('notification_preferences').document(user_id)
-    pref = pref_ref.get()
+    pref = await fs_run(pref_ref.get)
 
     # If preferences don't exist, create default
     if not pref.exists:
         default_prefs = NotificationPreference(userId=user_id)
-        pref_ref.set(default_prefs.dict())
+        await fs_run(pref_ref.set, default_prefs.dict())
         return default_prefs
 
     pref_data = pref.to_dict()
@@ -172,7 +172,7 @@ async def update_notification_preferences(
 
     # Update preferences in Firestore
     pref_ref = firestore_db.collection('notification_preferences').document(user_id)
-    pref_ref.set(preferences.dict())
+    await fs_run(pref_ref.set, preferences.dict())
 
     return preferences
 
@@ -193,12 +193,12 @@ async def register_device_token(
     # Check if token already exists
     tokens_ref = firestore_db.collection('device_tokens')
     query = tokens_ref.where('userId', '==', user_id).where('token', '==', device_token.token).limit(1)
-    existing_tokens = list(query.stream())
+    existing_tokens = await fs_run(query.get)
 
     if existing_tokens:
         # Update existing token
         token_doc = existing_tokens[0]
-        token_doc.reference.update({
+        await fs_run(token_doc.reference.update, {
             'deviceType': device_token.deviceType,
             'lastUpdated': datetime.now(timezone.utc)
         })
@@ -206,7 +206,7 @@ async def register_device_token(
     else:
         # Create new token entry
         device_token.lastUpdated = datetime.now(timezone.utc)
-        tokens_ref.add(device_token.dict())
+        await fs_run(tokens_ref.add, device_token.dict())
 
     return device_token
 
@@ -223,12 +223,12 @@ async def delete_device_token(
     # Find token document
     tokens_ref = firestore_db.collection('device_tokens')
     query = tokens_ref.where('userId', '==', user_id).where('token', '==', token).limit(1)
-    tokens = list(query.stream())
+    tokens = await fs_run(query.get)
 
     if not tokens:
         raise HTTPException(status_code=404, detail="Device token not found")
 
     # Delete token
-    tokens[0].reference.delete()
+    await fs_run(tokens[0].reference.delete)
 
     return {'status': 'success'}
\ No newline at end of file
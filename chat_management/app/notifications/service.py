@@ -4,13 +4,19 @@ import uuid
 from datetime import datetime, timezone
 from typing import Dict, List, Optional, Any
 
+from firebase_admin import firestore
+
 from .schemas import NotificationEvent, NotificationRecipient, DeliveryChannel
 from ..aws import sqs_utils
-from ..firebase import firestore_db
+from ..firebase import conversations_collection, firestore_db, fs_run
 
 logger = logging.getLogger(__name__)
 
 
+# Firestore's limit on writes per batch commit
+_MAX_BATCH_WRITES = 500
+
+
 class NotificationService:
     def __init__(self):
         """
@@ -42,16 +48,18 @@ class NotificationService:
             if 'eventId' not in payload:
                 payload['eventId'] = event_id
 
-            # Format recipients according to the standardized schema
+            # Format recipients according to the standardized schema. Every field is generated
+            # here, so the models are built with model_construct() rather than validating one
+            # recipient model per group member on every event
             recipient_objects = [
-                NotificationRecipient(
+                NotificationRecipient.model_construct(
                     userId=user_id,
                     deliveryChannels=delivery_channels
                 ) for user_id in recipients
             ]
 
             # Create standardized notification event
-            notification_event = NotificationEvent(
+            notification_event = NotificationEvent.model_construct(
                 eventId=event_id,
                 eventType=event_type,
                 timestamp=datetime.now(timezone.utc),
@@ -101,17 +109,21 @@ class NotificationService:
                 logger.error(f"Invalid message data: {message_data}")
                 return False
 
-            # Get conversation details for notification
-            conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-            conversation = conversation_ref.get()
+            # Get conversation details for notification and the sender, concurrently
+            # and off the event loop
+            conversation_ref = conversations_collection.document(conversation_id)
+            sender_ref = firestore_db.collection('users').document(sender_id)
+            # Only existence matters for the conversation; project a single small field
+            conversation, sender = await asyncio.gather(
+                fs_run(conversation_ref.get, field_paths=['type']),
+                fs_run(sender_ref.get)
+            )
 
             if not conversation.exists:
                 logger.error(f"Conversation {conversation_id} not found")
                 return False
 
             # Get sender name
-            sender_ref = firestore_db.collection('users').document(sender_id)
-            sender = sender_ref.get()
             sender_name = sender_id
             if sender.exists:
                 sender_data = sender.to_dict()
@@ -141,24 +153,21 @@ class NotificationService:
                 recipients=recipients
             )
 
-            # Store notifications in Firestore for each recipient
-            storage_tasks = []
-            for recipient_id in recipients:
-                storage_tasks.append(self._store_notification(
-                    recipient_id,
-                    'message',
-                    sender_name,
-                    content[:100] + ('...' if len(content) > 100 else ''),
-                    {
-                        'conversationId': conversation_id,
-                        'messageId': message_id,
-                        'senderId': sender_id
-                    }
-                ))
-
-            # Wait for all storage tasks to complete
-            for task in storage_tasks:
-                await task
+            # Store notifications in Firestore for every recipient in WriteBatch commits,
+            # instead of three sequential round trips per recipient
+            preview = content[:100] + ('...' if len(content) > 100 else '')
+            await fs_run(
+                self._write_notifications,
+                recipients,
+                'message',
+                sender_name,
+                preview,
+                {
+                    'conversationId': conversation_id,
+                    'messageId': message_id,
+                    'senderId': sender_id
+                }
+            )
 
             return event_sent
 
@@ -189,7 +198,7 @@ class NotificationService:
 
             # Get sender name
             sender_ref = firestore_db.collection('users').document(sender_id)
-            sender = sender_ref.get()
+            sender = await fs_run(sender_ref.get)
             sender_name = sender_id
             if sender.exists:
                 sender_data = sender.to_dict()
@@ -255,7 +264,7 @@ class NotificationService:
 
             # Get sender name
             sender_ref = firestore_db.collection('users').document(sender_id)
-            sender = sender_ref.get()
+            sender = await fs_run(sender_ref.get)
             sender_name = sender_id
             if sender.exists:
                 sender_data = sender.to_dict()
@@ -297,6 +306,73 @@ class NotificationService:
             logger.error(f"Error processing friend request notification: {str(e)}")
             return False
 
+    async def store_group_invitations(self, conversation_id: str, group_name: str,
+                                      sender_id: str, invitee_ids: List[str]) -> None:
+        """
+        Store group invitation notifications for several users directly in Firestore,
+        for when SQS is unavailable. The writes are committed in WriteBatches instead of
+        one round trip per invitee.
+
+        Args:
+            conversation_id: The group conversation ID
+            group_name: The name of the group
+            sender_id: The ID of the user who sent the invitations
+            invitee_ids: IDs of the invited users
+        """
+        await fs_run(
+            self._write_notifications,
+            invitee_ids,
+            'group_invitation',
+            sender_id,
+            f"invited you to join {group_name}",
+            {
+                'conversationId': conversation_id,
+                'senderId': sender_id,
+                'type': 'group_invitation'
+            }
+        )
+
+    def _write_notifications(self, user_ids: List[str], notification_type: str,
+                             title: str, body: str, data: Optional[Dict] = None) -> None:
+        """
+        Store the same notification for several users, in WriteBatch commits of at most
+        _MAX_BATCH_WRITES writes. Blocking; run it through fs_run.
+
+        Args:
+            user_ids: IDs of the users to store the notification for
+            notification_type: Type of notification (message, group_invitation, etc.)
+            title: Notification title
+            body: Notification body/content
+            data: Additional notification data
+        """
+        now = datetime.now(timezone.utc)
+        batch = firestore_db.batch()
+        writes = 0
+        for user_id in user_ids:
+            # Keep a user's notification and counter update in the same batch
+            if writes + 2 > _MAX_BATCH_WRITES:
+                batch.commit()
+                batch = firestore_db.batch()
+                writes = 0
+            notification_id = str(uuid.uuid4())
+            batch.create(firestore_db.collection('notifications').document(notification_id), {
+                'notificationId': notification_id,
+                'userId': user_id,
+                'type': notification_type,
+                'title': title,
+                'body': body,
+                'data': data,
+                'isRead': False,
+                'createdAt': now
+            })
+            # set(merge) rather than update, so an unknown user does not fail the whole batch
+            batch.set(firestore_db.collection('users').document(user_id),
+                      {'unreadNotifications': firestore.Increment(1)}, merge=True)
+            writes += 2
+        if writes:
+            batch.commit()
+        logger.info(f"Stored {notification_type} notifications for {len(user_ids)} users")
+
     async def _store_notification(self, user_id: str, notification_type: str,
                                   title: str, body: str, data: Optional[Dict] = None) -> str:
         """
@@ -329,16 +405,17 @@ class NotificationService:
 
             # Store in Firestore
             notif_ref = firestore_db.collection('notifications').document(notification_id)
-            notif_ref.set(notification_data)
+            user_ref = firestore_db.collection('users').document(user_id)
+
+            await fs_run(notif_ref.set, notification_data)
 
             # Update user's unread notification count
-            user_ref = firestore_db.collection('users').document(user_id)
-            user = user_ref.get()
+            user = await fs_run(user_ref.get)
 
             if user.exists:
                 user_data = user.to_dict()
                 unread_count = user_data.get('unreadNotifications', 0)
-                user_ref.update({'unreadNotifications': unread_count + 1})
+                await fs_run(user_ref.update, {'unreadNotifications': unread_count + 1})
 
             logger.info(f"Stored notification {notification_id} for user {user_id}")
             return notification_id
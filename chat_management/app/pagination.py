@@ -1,5 +1,7 @@
-from typing import Generic, TypeVar, List
+import base64
+from typing import Any, Dict, Generic, List, Optional, TypeVar
 
+import orjson
 from fastapi import Query
 from pydantic import BaseModel
 
@@ -26,9 +28,11 @@ class PaginatedResponse(BaseModel, Generic[T]):
         page (int): The current page number (1-indexed).
         size (int): The number of items per page.
         pages (int): The total number of pages.
+        next_cursor (Optional[str]): Opaque cursor for the following page, on endpoints that
+            support cursor pagination; None when there are no more items.
 
     Methods:
-        create(items: List[T], total: int, page: int, size: int) -> "PaginatedResponse":
+        create(items: List[T], total: int, page: int, size: int, next_cursor: Optional[str] = None) -> "PaginatedResponse":
             A static method to create a PaginatedResponse instance.
 
             Args:
@@ -36,6 +40,7 @@ class PaginatedResponse(BaseModel, Generic[T]):
                 total (int): The total number of items across all pages.
                 page (int): The current page number (1-indexed).
                 size (int): The number of items per page.
+                next_cursor (Optional[str]): Cursor for the following page, if any.
 
             Returns:
                 PaginatedResponse: An instance of PaginatedResponse with the calculated total pages.
@@ -55,9 +60,11 @@ class PaginatedResponse(BaseModel, Generic[T]):
     page: int
     size: int
     pages: int
+    next_cursor: Optional[str] = None
 
     @staticmethod
-    def create(items: List[T], total: int, page: int, size: int) -> "PaginatedResponse":
+    def create(items: List[T], total: int, page: int, size: int,
+               next_cursor: Optional[str] = None) -> "PaginatedResponse":
         pages = (total + size - 1) // size  # Calculate total pages
         return PaginatedResponse(
             items=items,
@@ -65,9 +72,31 @@ class PaginatedResponse(BaseModel, Generic[T]):
             page=page,
             size=size,
             pages=pages,
+            next_cursor=next_cursor,
         )
 
 
+def encode_cursor(values: Dict[str, Any]) -> str:
+    """Pack the sort key of the last item on a page into an opaque, URL-safe cursor."""
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """
+    Unpack a cursor produced by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Malformed cursor") from e
+    if not isinstance(values, dict):
+        raise ValueError("Malformed cursor")
+    return values
+
+
 def paginate(data: List[T], page: int, size: int) -> List[T]:
     start = (page - 1) * size
     end = start + size
@@ -1,13 +1,17 @@
 import logging
+from functools import lru_cache
 
 import phonenumbers
 
 logger = logging.getLogger(__name__)
 
+# Both helpers are pure and are hit with the same token on every dev-mode request,
+# so results are memoized instead of re-running the phonenumbers parser each time
+@lru_cache(maxsize=4096)
 def is_phone_number(number):
     try:
         parsed_phone = phonenumbers.parse(number, "VN")
-        print(parsed_phone)
+        logger.debug(f"Parsed phone number: {parsed_phone}")
         if not phonenumbers.is_valid_number(parsed_phone):
             logger.error(f"Invalid phone number: {number}")
             return False
@@ -17,6 +21,7 @@ def is_phone_number(number):
         return False
 
 
+@lru_cache(maxsize=4096)
 def format_phone_number(number):
     parsed_phone = phonenumbers.parse(number, "VN")
     return phonenumbers.format_number(parsed_phone, phonenumbers.PhoneNumberFormat.E164)
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import zlib
+from typing import Any, Dict, Iterable, Optional, Set
+
+import orjson
+
+from ..conversation_cache import get_cached_conversation
+
+logger = logging.getLogger(__name__)
+
+# Events are published to the shard channels of the users who should receive them, and each
+# instance subscribes only to the shards of its locally connected users. Every instance must
+# use the same shard count.
+PUBSUB_SHARDS = int(os.getenv("PUBSUB_SHARDS", "32"))
+SHARD_CHANNEL_PREFIX = "ws:shard:"
+
+# shard -> number of locally connected users in that shard
+_shard_users: Dict[int, int] = {}
+# Shards the active pubsub connection is currently subscribed to
+_subscribed: Set[int] = set()
+# Serializes subscribe/unsubscribe so a quick disconnect/reconnect cannot reorder them
+_subscription_lock = asyncio.Lock()
+_pubsub = None
+
+
+def user_shard(user_id: str) -> int:
+    # crc32 rather than hash(): the result must agree across processes
+    return zlib.crc32(user_id.encode()) % PUBSUB_SHARDS
+
+
+def shard_channel(shard: int) -> str:
+    return f"{SHARD_CHANNEL_PREFIX}{shard}"
+
+
+def channel_shard(channel: str) -> Optional[int]:
+    """Return the shard of a shard channel name, or None for any other channel."""
+    if channel.startswith(SHARD_CHANNEL_PREFIX):
+        return int(channel[len(SHARD_CHANNEL_PREFIX):])
+    return None
+
+
+async def publish_to_users(redis_conn, event: Dict[str, Any], user_ids: Iterable[str]) -> int:
+    """
+    Publish an event to the shard channels of the given users.
+
+    The payload is serialized once and sent with one pipelined round trip, at most one
+    PUBLISH per distinct shard.
+
+    Returns:
+        int: Total number of subscribers that received the event
+    """
+    channels = {shard_channel(user_shard(user_id)) for user_id in user_ids}
+    if not channels:
+        return 0
+
+    payload = orjson.dumps(event)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        for channel in channels:
+            pipe.publish(channel, payload)
+        results = await pipe.execute()
+    return sum(results)
+
+
+async def publish_conversation_event(
+    redis_conn,
+    conversation_id: str,
+    event: Dict[str, Any],
+    participants: Optional[Iterable[str]] = None
+) -> int:
+    """
+    Publish a conversation event to the shard channels of its participants.
+
+    Args:
+        redis_conn: Async Redis client
+        conversation_id: The conversation the event belongs to
+        event: The event payload
+        participants: Participant IDs; looked up from the conversation cache when omitted
+
+    Returns:
+        int: Total number of subscribers that received the event
+    """
+    if participants is None:
+        conversation = await get_cached_conversation(conversation_id)
+        if conversation is None:
+            logger.warning(f"Conversation {conversation_id} not found, event {event.get('event')} not published")
+            return 0
+        participants = conversation.participants
+
+    return await publish_to_users(redis_conn, event, participants)
+
+
+async def _sync_shard(shard: int) -> None:
+    # Reconcile the subscription with the current refcount, whatever order calls arrive in
+    async with _subscription_lock:
+        if _pubsub is None:
+            return
+        wanted = _shard_users.get(shard, 0) > 0
+        try:
+            if wanted and shard not in _subscribed:
+                await _pubsub.subscribe(shard_channel(shard))
+                _subscribed.add(shard)
+            elif not wanted and shard in _subscribed:
+                await _pubsub.unsubscribe(shard_channel(shard))
+                _subscribed.discard(shard)
+        except Exception as e:
+            # The listener resubscribes every wanted shard when it reconnects
+            logger.error(f"Error updating subscription for shard {shard}: {str(e)}")
+
+
+async def add_local_user(user_id: str) -> None:
+    """Count a newly connected local user, subscribing to their shard if it is the first one."""
+    shard = user_shard(user_id)
+    _shard_users[shard] = _shard_users.get(shard, 0) + 1
+    if _shard_users[shard] == 1:
+        await _sync_shard(shard)
+
+
+def remove_local_user(user_id: str) -> None:
+    """Release a local user whose last connection closed, unsubscribing from an emptied shard."""
+    shard = user_shard(user_id)
+    remaining = _shard_users.get(shard, 0) - 1
+    if remaining > 0:
+        _shard_users[shard] = remaining
+        return
+    _shard_users.pop(shard, None)
+    try:
+        asyncio.get_running_loop().create_task(_sync_shard(shard))
+    except RuntimeError:
+        # No running loop (e.g. interpreter shutdown); nothing to unsubscribe from
+        pass
+
+
+async def attach_pubsub(pubsub) -> int:
+    """
+    Make pubsub the active listener connection and subscribe it to every shard
+    that currently has local users.
+
+    Returns:
+        int: Number of shard channels subscribed
+    """
+    global _pubsub
+    async with _subscription_lock:
+        _pubsub = pubsub
+        _subscribed.clear()
+        shards = [shard for shard, count in _shard_users.items() if count > 0]
+        if shards:
+            await pubsub.subscribe(*[shard_channel(shard) for shard in shards])
+            _subscribed.update(shards)
+        return len(shards)
+
+
+def detach_pubsub() -> None:
+    """Forget the listener connection after it failed; attach_pubsub resubscribes on reconnect."""
+    global _pubsub
+    _pubsub = None
+    _subscribed.clear()
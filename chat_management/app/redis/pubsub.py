@@ -1,22 +1,33 @@
 import asyncio
-import json
 import logging
 import os
 import socket
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
+import orjson
+
+from ..redis.channels import attach_pubsub, channel_shard, detach_pubsub
 from ..redis.connection import get_redis_connection
 from ..ws.websocket_manager import get_connection_manager
 
 logger = logging.getLogger(__name__)
 
-async def handle_new_message(data: Dict[str, Any], connection_manager):
+# Received events are handled by a pool of workers so one slow broadcast does not hold up
+# every event behind it. Events of one conversation (or user) always go to the same worker,
+# which keeps their order.
+PUBSUB_WORKERS = int(os.getenv("PUBSUB_WORKERS", "4"))
+PUBSUB_WORKER_QUEUE_SIZE = 1000
+
+async def handle_new_message(data: Dict[str, Any], connection_manager, shard: Optional[int] = None,
+                             raw: Optional[str] = None):
     """
     Process new message events from Redis PubSub
     
     Args:
         data: Message data containing conversationId, message details
         connection_manager: WebSocket connection manager instance
+        shard: Shard the event arrived on; only local users in it receive the event
+        raw: The event as received, forwarded to clients verbatim instead of re-serializing data
     """
     try:
         conversation_id = data.get('conversationId')
@@ -26,20 +37,27 @@ async def handle_new_message(data: Dict[str, Any], connection_manager):
             logger.error(f"Missing required fields in new_message event: {data}")
             return
             
-        # Forward message to all local connections for this conversation
-        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=sender_id)
+        # Forward message to all local connections for this conversation; the publisher
+        # includes the participant list, so no conversation lookup is needed
+        await connection_manager.broadcast_to_conversation(
+            data, conversation_id, skip_user_id=sender_id, participants=data.get('participants'), shard=shard,
+            message_json=raw
+        )
         logger.debug(f"Forwarded new message in conversation {conversation_id} from user {sender_id}")
         
     except Exception as e:
         logger.error(f"Error handling new message event: {str(e)}")
 
-async def handle_typing(data: Dict[str, Any], connection_manager):
+async def handle_typing(data: Dict[str, Any], connection_manager, shard: Optional[int] = None,
+                        raw: Optional[str] = None):
     """
     Process typing indicator events from Redis PubSub
     
     Args:
         data: Typing data containing conversationId and userId
         connection_manager: WebSocket connection manager instance
+        shard: Shard the event arrived on; only local users in it receive the event
+        raw: The event as received, forwarded to clients verbatim instead of re-serializing data
     """
     try:
         conversation_id = data.get('conversationId')
@@ -50,19 +68,23 @@ async def handle_typing(data: Dict[str, Any], connection_manager):
             return
             
         # Forward typing indicator to all local connections for this conversation
-        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=user_id)
+        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=user_id, shard=shard,
+                                                           message_json=raw)
         logger.debug(f"Forwarded typing indicator in conversation {conversation_id} from user {user_id}")
         
     except Exception as e:
         logger.error(f"Error handling typing event: {str(e)}")
 
-async def handle_read_receipt(data: Dict[str, Any], connection_manager):
+async def handle_read_receipt(data: Dict[str, Any], connection_manager, shard: Optional[int] = None,
+                              raw: Optional[str] = None):
     """
     Process read receipt events from Redis PubSub
     
     Args:
         data: Read receipt data containing conversationId, messageId and userId
         connection_manager: WebSocket connection manager instance
+        shard: Shard the event arrived on; only local users in it receive the event
+        raw: The event as received, forwarded to clients verbatim instead of re-serializing data
     """
     try:
         conversation_id = data.get('conversationId')
@@ -74,19 +96,23 @@ async def handle_read_receipt(data: Dict[str, Any], connection_manager):
             return
             
         # Forward read receipt to all local connections for this conversation
-        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=user_id)
+        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=user_id, shard=shard,
+                                                           message_json=raw)
         logger.debug(f"Forwarded read receipt in conversation {conversation_id} for message {message_id} from user {user_id}")
         
     except Exception as e:
         logger.error(f"Error handling read receipt event: {str(e)}")
 
-async def handle_status_change(data: Dict[str, Any], connection_manager):
+async def handle_status_change(data: Dict[str, Any], connection_manager, shard: Optional[int] = None,
+                               raw: Optional[str] = None):
     """
     Process user status change events from Redis PubSub
     
     Args:
         data: Status data containing userId and status
         connection_manager: WebSocket connection manager instance
+        shard: Shard the event arrived on; only local users in it receive the event
+        raw: The event as received, forwarded to clients verbatim instead of re-serializing data
     """
     try:
         user_id = data.get('userId')
@@ -101,23 +127,27 @@ async def handle_status_change(data: Dict[str, Any], connection_manager):
         # For now, we'll forward to all local connections that need to know about this user
         if 'conversationId' in data:
             # If conversation ID is provided, broadcast to that conversation
-            await connection_manager.broadcast_to_conversation(data, data['conversationId'], skip_user_id=user_id)
+            await connection_manager.broadcast_to_conversation(data, data['conversationId'], skip_user_id=user_id, shard=shard,
+                                                               message_json=raw)
         else:
             # Otherwise, send to all relevant users (handled by ws manager)
-            await connection_manager.broadcast_user_status(user_id, status)
+            await connection_manager.broadcast_user_status(user_id, status, shard=shard)
             
         logger.debug(f"Forwarded status change for user {user_id} to status {status}")
         
     except Exception as e:
         logger.error(f"Error handling status change event: {str(e)}")
 
-async def handle_message_reaction(data: Dict[str, Any], connection_manager):
+async def handle_message_reaction(data: Dict[str, Any], connection_manager, shard: Optional[int] = None,
+                                  raw: Optional[str] = None):
     """
     Process message reaction events from Redis PubSub
     
     Args:
         data: Reaction data containing conversationId, messageId, userId, and reaction
         connection_manager: WebSocket connection manager instance
+        shard: Shard the event arrived on; only local users in it receive the event
+        raw: The event as received, forwarded to clients verbatim instead of re-serializing data
     """
     try:
         conversation_id = data.get('conversationId')
@@ -130,12 +160,21 @@ async def handle_message_reaction(data: Dict[str, Any], connection_manager):
             return
             
         # Forward reaction to all local connections for this conversation
-        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=user_id)
+        await connection_manager.broadcast_to_conversation(data, conversation_id, skip_user_id=user_id, shard=shard,
+                                                           message_json=raw)
         logger.debug(f"Forwarded message reaction in conversation {conversation_id} from user {user_id}")
         
     except Exception as e:
         logger.error(f"Error handling message reaction event: {str(e)}")
 
+async def _event_worker(queue: asyncio.Queue, connection_manager) -> None:
+    while True:
+        handler, data, shard, raw = await queue.get()
+        try:
+            await handler(data, connection_manager, shard, raw)
+        except Exception as e:
+            logger.error(f"Error handling {data.get('event')} event: {str(e)}")
+
 async def start_pubsub_listener():
     """
     Start the Redis PubSub listener for inter-instance communication
@@ -160,78 +199,81 @@ async def start_pubsub_listener():
     retry_delay = 5  # seconds
     current_retry = 0
     
-    # Default channel subscriptions (all conversation channels)
-    DEFAULT_CHANNEL = "conversation:*"
+    # Always-subscribed per-instance channel: keeps the listener alive while no users are
+    # connected (listen() returns once nothing is subscribed)
+    instance_channel = f"instance:{instance_id}"
     
-    while True:
-        try:
-            redis_conn = await get_redis_connection()
-            pubsub = redis_conn.pubsub()
-            
-            # Register this instance with Redis
-            instance_channels_key = f"subscriptions:{instance_id}"
-            
-            # Get existing channel subscriptions
-            channels = await redis_conn.smembers(instance_channels_key)
+    # Bounded queues: when the workers fall behind, the listener waits instead of buffering
+    # without limit
+    queues = [asyncio.Queue(maxsize=PUBSUB_WORKER_QUEUE_SIZE) for _ in range(max(PUBSUB_WORKERS, 1))]
+    # The workers outlive reconnects below; they run as long as the listener itself and are
+    # cancelled with it
+    workers = [asyncio.create_task(_event_worker(queue, connection_manager)) for queue in queues]
+    
+    try:
+        while True:
+            try:
+                redis_conn = await get_redis_connection()
+                pubsub = redis_conn.pubsub()
             
-            # If no channels found, subscribe to the default pattern
-            if not channels:
-                logger.info(f"No specific channels found for instance {instance_id}. Using pattern subscription to {DEFAULT_CHANNEL}")
-                # Use pattern subscribe for wildcard support
-                await pubsub.psubscribe(DEFAULT_CHANNEL)
-                # Add the default channel to instance subscriptions
-                await redis_conn.sadd(instance_channels_key, DEFAULT_CHANNEL)
-            else:
-                # Subscribe to specific channels
-                for channel in channels:
-                    if '*' in channel:
-                        await pubsub.psubscribe(channel)
-                    else:
-                        await pubsub.subscribe(channel)
+                await pubsub.subscribe(instance_channel)
+                # Subscribe to the shard channels of users already connected to this instance;
+                # later connects and disconnects adjust the subscriptions (see app.redis.channels)
+                shard_count = await attach_pubsub(pubsub)
                 
-            logger.info(f"PubSub listener started for instance {instance_id} with {len(channels) or 1} channel patterns")
+                logger.info(f"PubSub listener started for instance {instance_id} with {shard_count} shard channel(s)")
             
-            # Reset retry counter on successful connection
-            current_retry = 0
+                # Reset retry counter on successful connection
+                current_retry = 0
             
-            # Listen for messages
-            async for message in pubsub.listen():
-                if message['type'] not in ('message', 'pmessage'):
-                    continue
+                # Listen for messages
+                async for message in pubsub.listen():
+                    if message['type'] not in ('message', 'pmessage'):
+                        continue
                 
-                try:
-                    channel = message['channel']
-                    data = json.loads(message['data'])
+                    try:
+                        channel = message['channel']
+                        data = orjson.loads(message['data'])
                     
-                    # Log message receipt
-                    event_type = data.get('event')
-                    logger.debug(f"Received {event_type} event on channel {channel}")
+                        # Log message receipt
+                        event_type = data.get('event')
+                        logger.debug(f"Received {event_type} event on channel {channel}")
                     
-                    # Extract event type and call the appropriate handler
-                    if event_type in event_handlers:
-                        await event_handlers[event_type](data, connection_manager)
-                    else:
-                        logger.warning(f"Unknown event type: {event_type}")
+                        # Extract event type and queue the appropriate handler; the shard limits
+                        # delivery to local users of that shard, so no one gets an event twice
+                        if event_type in event_handlers:
+                            order_key = data.get('conversationId') or data.get('userId') or ''
+                            await queues[hash(order_key) % len(queues)].put(
+                                (event_handlers[event_type], data, channel_shard(channel), message['data'])
+                            )
+                        else:
+                            logger.warning(f"Unknown event type: {event_type}")
                     
-                except json.JSONDecodeError:
-                    logger.error(f"Invalid JSON in Redis message: {message['data']}")
-                except Exception as e:
-                    logger.error(f"Error processing Redis message: {str(e)}")
+                    except orjson.JSONDecodeError:
+                        logger.error(f"Invalid JSON in Redis message: {message['data']}")
+                    except Exception as e:
+                        logger.error(f"Error processing Redis message: {str(e)}")
         
-        except Exception as e:
-            logger.error(f"PubSub listener error: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            except Exception as e:
+                detach_pubsub()
+                logger.error(f"PubSub listener error: {str(e)}")
+                import traceback
+                print(traceback.format_exc())
             
-            # Implement retry logic
-            current_retry += 1
-            if current_retry <= max_retries:
-                retry_wait = retry_delay * current_retry
-                logger.info(f"Retrying PubSub connection in {retry_wait} seconds (attempt {current_retry}/{max_retries})")
-                await asyncio.sleep(retry_wait)
-            else:
-                logger.critical(f"Failed to connect to Redis after {max_retries} attempts. PubSub listener stopped.")
-                # In production, you might want to implement a circuit breaker pattern here
-                # For now, we'll just reset and try again after a longer delay
-                current_retry = 0
-                await asyncio.sleep(60)  # Wait a minute before trying again
+                # Implement retry logic
+                current_retry += 1
+                if current_retry <= max_retries:
+                    retry_wait = retry_delay * current_retry
+                    logger.info(f"Retrying PubSub connection in {retry_wait} seconds (attempt {current_retry}/{max_retries})")
+                    await asyncio.sleep(retry_wait)
+                else:
+                    logger.critical(f"Failed to connect to Redis after {max_retries} attempts. PubSub listener stopped.")
+                    # In production, you might want to implement a circuit breaker pattern here
+                    # For now, we'll just reset and try again after a longer delay
+                    current_retry = 0
+                    await asyncio.sleep(60)  # Wait a minute before trying again
+    finally:
+        # Listener cancelled (shutdown): take its workers down with it
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -1,7 +1,7 @@
-import json
 import logging
 from typing import Dict, Any
 
+import orjson
 import redis
 
 from .connection import get_redis_config
@@ -62,8 +62,8 @@ class RedisClient:
             return False
         
         try:
-            # Convert dict to JSON string
-            json_data = json.dumps(data)
+            # Serialize to JSON bytes, which redis publishes as-is
+            json_data = orjson.dumps(data)
             
             # Publish to the channel
             result = self.redis.publish(channel, json_data)
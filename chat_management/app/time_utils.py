@@ -1,3 +0,0 @@
-def convert_timestamps(data):
-    """Convert Firestore timestamps to datetime objects"""
-    return data
\ No newline at end of file
@@ -1,3 +1,6 @@
+import asyncio
+from typing import Dict, Iterable
+
 from ..firebase import realtime_db
 
 DB_USER_PATH = "/User/"
@@ -8,4 +11,15 @@ def get_user_info(user_id: str) -> dict:
     """
     user_ref = realtime_db.reference(DB_USER_PATH + user_id)
     user_data = user_ref.get()
-    return user_data
\ No newline at end of file
+    return user_data
+
+async def get_users_info(user_ids: Iterable[str]) -> Dict[str, dict]:
+    """
+    Get user data for several users at once, keyed by user ID.
+
+    Each distinct ID is read once, and the blocking reads run concurrently off the event loop
+    instead of one after another. Users without a record are left out of the result.
+    """
+    unique_ids = list(dict.fromkeys(user_ids))
+    results = await asyncio.gather(*[asyncio.to_thread(get_user_info, user_id) for user_id in unique_ids])
+    return {user_id: user_data for user_id, user_data in zip(unique_ids, results) if user_data}
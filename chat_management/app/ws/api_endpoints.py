@@ -1,5 +1,3 @@
-import asyncio
-import json
 import logging
 import os
 import socket
@@ -8,9 +6,10 @@ import traceback
 
 from fastapi import APIRouter, HTTPException, Depends, status
 from pydantic import BaseModel, Field
+import orjson
 
 from ..dependencies import get_current_active_user
-from ..firebase import firestore_db
+from ..firebase import firestore_db, fs_run
 from ..redis.connection import get_redis_connection
 from ..ws.router import is_conversation_participant
 from ..ws.websocket_manager import get_connection_manager
@@ -19,6 +18,11 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Accepted user status values, plus the error text listing them, built once at import
+_STATUS_VALUES = ('available', 'away', 'busy', 'invisible', 'offline')
+_VALID_STATUSES = frozenset(_STATUS_VALUES)
+_INVALID_STATUS_DETAIL = f"Invalid status value. Must be one of: {', '.join(_STATUS_VALUES)}"
+
 # Request validation models
 class StatusUpdate(BaseModel):
     """Request model for status updates"""
@@ -53,11 +57,10 @@ async def update_user_status(status_data: StatusUpdate, current_user = Depends(g
     status_value = status_data.status
     
     # Validate status value
-    valid_statuses = ['available', 'away', 'busy', 'invisible', 'offline']
-    if status_value not in valid_statuses:
+    if status_value not in _VALID_STATUSES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid status value. Must be one of: {', '.join(valid_statuses)}"
+            detail=_INVALID_STATUS_DETAIL
         )
     
     try:
@@ -151,7 +154,7 @@ async def get_connection_info(current_user = Depends(get_current_active_user)):
         # Parse connection data
         connections_by_instance = {}
         for conn_id, conn_data in all_connections.items():
-            conn_info = json.loads(conn_data)
+            conn_info = orjson.loads(conn_data)
             instance_id = conn_info.get('instance_id')
             if instance_id not in connections_by_instance:
                 connections_by_instance[instance_id] = []
@@ -163,7 +166,7 @@ async def get_connection_info(current_user = Depends(get_current_active_user)):
         
         # Get user status from Firestore
         user_ref = firestore_db.collection('users').document(user_id)
-        user_data = await asyncio.to_thread(user_ref.get)
+        user_data = await fs_run(user_ref.get)
         user_status = user_data.to_dict().get('status', 'offline') if user_data.exists else 'offline'
         is_online = user_data.to_dict().get('isOnline', False) if user_data.exists else False
         last_active = user_data.to_dict().get('lastActive')
@@ -203,7 +206,7 @@ async def get_connection_stats(current_user = Depends(get_current_active_user)):
     # Check if user is an admin (example - adjust according to your auth system)
     user_id = current_user.phoneNumber
     user_ref = firestore_db.collection('users').document(user_id)
-    user_data = await asyncio.to_thread(user_ref.get)
+    user_data = await fs_run(user_ref.get, field_paths=['isAdmin'])
     
     # Verify user has admin role
     if not user_data.exists or not user_data.to_dict().get('isAdmin', False):
@@ -269,7 +272,7 @@ async def health_check():
     try:
         # Using a lightweight read operation for health check
         system_ref = firestore_db.collection('system').document('health')
-        await asyncio.to_thread(system_ref.get)
+        await fs_run(system_ref.get)
         health_status["services"]["firestore"] = {
             "status": "connected",
             "message": "Firestore connection successful"
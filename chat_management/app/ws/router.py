@@ -1,17 +1,16 @@
-import asyncio
-import json
 import logging
 from typing import Dict, Any, Optional
 
 from app.phone_utils import is_phone_number, format_phone_number
 from app.service_env import Environment
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from firebase_admin import auth
 from firebase_admin.auth import ExpiredIdTokenError, RevokedIdTokenError, InvalidIdTokenError, CertificateFetchError, \
     UserDisabledError
+import orjson
 
 # ConnectionManager is now imported through get_connection_manager
-from ..firebase import firestore_db
+from ..conversation_cache import get_cached_conversation
+from ..dependencies import verify_firebase_token
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +24,10 @@ from .websocket_manager import get_connection_manager
 # Get the global connection manager
 connection_manager = get_connection_manager()
 
+# Constant frames are serialized once at import
+_HEARTBEAT_ACK = orjson.dumps({'event': 'heartbeat_ack'}).decode()
+_MISSING_STATUS_ERROR = orjson.dumps({'event': 'error', 'message': 'Missing status parameter'}).decode()
+
 async def validate_token(websocket: WebSocket) -> Optional[Dict[str, Any]]:
   """
   Validates the token from WebSocket query parameters
@@ -55,7 +58,8 @@ async def validate_token(websocket: WebSocket) -> Optional[Dict[str, Any]]:
   
   # Production mode - verify Firebase token
   try:
-    decoded_token = auth.verify_id_token(token, check_revoked=True)
+    # Same off-loop verifier and token cache as the HTTP endpoints
+    decoded_token = await verify_firebase_token(token)
     return decoded_token
   except ValueError:
     logger.error("Invalid token format")
@@ -108,26 +112,28 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
     logger.warning(f"Rejected WebSocket connection due to user ID mismatch: {user_id} vs {token_user_id}")
     return
   
-  # Accept the connection and proceed
-  connection_id = await connection_manager.connect(websocket, token_user_id)
+  # Accept the connection and proceed; ?frames=binary opts in to binary broadcast frames
+  binary_frames = websocket.query_params.get('frames') == 'binary'
+  connection_id = await connection_manager.connect(websocket, token_user_id, binary_frames=binary_frames)
 
   try:
     # Process incoming messages
     while True:
       data = await websocket.receive_text()
+      connection_manager.touch(connection_id)
       try:
-        message = json.loads(data)
+        message = orjson.loads(data)
         event_type = message.get('event')
 
         if event_type == 'typing':
           # User is typing in a conversation
           conversation_id = message.get('conversationId')
           if conversation_id:
-            await connection_manager.handle_typing_notification(conversation_id, token_user_id)
+            await connection_manager.handle_typing_notification(conversation_id, token_user_id, relay=True)
           # Backward compatibility
           elif 'chatId' in message:
             chat_id = message.get('chatId')
-            await connection_manager.handle_typing_notification(chat_id, token_user_id)
+            await connection_manager.handle_typing_notification(chat_id, token_user_id, relay=True)
             logger.warning(f"Deprecated 'chatId' field used instead of 'conversationId' in typing event")
 
         elif event_type == 'message_read':
@@ -151,7 +157,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
           )
 
           # Send heartbeat acknowledgment
-          await websocket.send_text(json.dumps({'event': 'heartbeat_ack'}))
+          await websocket.send_text(_HEARTBEAT_ACK)
           
         elif event_type == 'status_change':
           # Handle user status change (available, away, busy, etc.)
@@ -163,18 +169,15 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
               metadata={'status': status}
             )
             # Acknowledge status change
-            await websocket.send_text(json.dumps({
+            await websocket.send_text(orjson.dumps({
               'event': 'status_change_ack',
               'status': status
-            }))
+            }).decode())
           else:
             logger.warning(f"Missing status in status_change event from user {token_user_id}")
-            await websocket.send_text(json.dumps({
-              'event': 'error',
-              'message': 'Missing status parameter'
-            }))
+            await websocket.send_text(_MISSING_STATUS_ERROR)
 
-      except json.JSONDecodeError:
+      except orjson.JSONDecodeError:
         logger.error(f"Invalid JSON received from client: {data}")
       except Exception as e:
         logger.error(f"Error processing WebSocket message: {str(e)}")
@@ -185,12 +188,13 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
 
     # If all user connections are closed, set offline status after grace period
     if all_connections_closed:
-      asyncio.create_task(connection_manager.set_offline_status(token_user_id))
+      connection_manager.schedule_offline(token_user_id)
 
   except Exception as e:
     logger.error(f"WebSocket error: {str(e)}")
     # Ensure connection is removed on any error
-    connection_manager.disconnect(token_user_id, connection_id)
+    if connection_manager.disconnect(token_user_id, connection_id):
+      connection_manager.schedule_offline(token_user_id)
 
 # The get_connection_manager function is now imported from websocket_manager
 
@@ -210,20 +214,16 @@ async def is_conversation_participant(conversation_id: str, user_id: str) -> boo
       Exception: If there's an error accessing Firestore
   """
   try:
-    # Get the conversation document from Firestore
-    conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-    conversation = await asyncio.to_thread(conversation_ref.get)
+    # Get the conversation document (cached briefly across requests)
+    conversation = await get_cached_conversation(conversation_id)
     
     # Check if conversation exists
-    if not conversation.exists:
+    if conversation is None:
       logger.warning(f"Conversation {conversation_id} not found when checking participation")
       return False
     
-    # Get the participants list and check if user is in it
-    conversation_data = conversation.to_dict()
-    participants = conversation_data.get('participants', [])
-    
-    return user_id in participants
+    # Check against the participant set precomputed by the cache
+    return user_id in conversation.participants
     
   except Exception as e:
     logger.error(f"Error checking conversation participation: {str(e)}")
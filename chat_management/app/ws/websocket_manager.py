@@ -1,18 +1,53 @@
 import asyncio
-import json
 import logging
+import os
 import time
 import uuid
-from typing import Dict, Optional, Set, Any
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Any
 
 from fastapi import WebSocket
 from firebase_admin import firestore
+import orjson
 
-from ..firebase import firestore_db
+from ..conversation_cache import get_cached_conversation
+from ..firebase import conversations_collection, firestore_db, fs_run, get_firestore_async_client
+from ..redis.channels import add_local_user, publish_conversation_event, publish_to_users, remove_local_user, \
+  user_shard
 from ..redis.connection import get_redis_connection
 
 logger = logging.getLogger(__name__)
 
+
+# Per-user cap: a new connection beyond it closes that user's oldest one
+MAX_CONNECTIONS_PER_USER = max(1, int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "10")))
+# Connections that send nothing (not even a heartbeat) for this long are closed by the sweeper
+IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT", "300"))
+SWEEP_INTERVAL_SECONDS = 60
+# A user whose last connection closes is marked offline only if they have not reconnected by then
+OFFLINE_GRACE_SECONDS = 60
+# Presence keys (connections:{user_id}) expire unless the sweeper refreshes them, so entries
+# left behind by a crashed instance disappear on their own
+PRESENCE_KEY_PREFIX = "connections:"
+PRESENCE_TTL_SECONDS = 3 * SWEEP_INTERVAL_SECONDS
+# A send that does not finish in time marks the client as stuck; it is closed instead of
+# holding up the rest of the broadcast
+SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT", "2"))
+# Heartbeats refresh a user's lastActive in Firestore at most this often
+LAST_ACTIVE_WRITE_INTERVAL_SECONDS = float(os.getenv("WS_LAST_ACTIVE_WRITE_INTERVAL", "30"))
+# Upper bound on sends in flight across all broadcasts, so a burst of large fan-outs
+# cannot queue unbounded frames in transport buffers
+MAX_CONCURRENT_SENDS = int(os.getenv("WS_MAX_CONCURRENT_SENDS", "256"))
+_send_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+
+async def _send_bounded(websocket: WebSocket, message_json: str, message_bytes: Optional[bytes] = None) -> None:
+  async with _send_slots:
+    if message_bytes is not None:
+      send = websocket.send_bytes(message_bytes)
+    else:
+      send = websocket.send_text(message_json)
+    await asyncio.wait_for(send, SEND_TIMEOUT_SECONDS)
+
 # Global connection manager instance
 connection_manager = None
 
@@ -27,32 +62,67 @@ class ConnectionManager:
   def __init__(self):
     self.active_connections: Dict[str, Dict[str, WebSocket]] = {}
     self.user_conversations: Dict[str, Set[str]] = {}  # Maps user IDs to their conversation IDs
+    self.last_seen: Dict[str, float] = {}  # Maps connection IDs to their last received frame (monotonic)
+    self.last_active_write: Dict[str, float] = {}  # Maps user IDs to their last lastActive write (monotonic)
+    self.offline_timers: Dict[str, asyncio.TimerHandle] = {}  # Maps user IDs to their pending offline write
+    self.binary_connections: Set[str] = set()  # Connection IDs that receive broadcasts as binary frames
     self.instance_id = uuid.uuid4().hex  # Generate a unique ID for this instance
 
-  async def connect(self, websocket: WebSocket, user_id: str):
+  async def connect(self, websocket: WebSocket, user_id: str, binary_frames: bool = False):
     """
     Connect a new WebSocket client
+
+    With binary_frames, broadcasts reach this connection as binary frames holding the
+    UTF-8 JSON, encoded once per broadcast rather than once per text frame sent.
     """
     await websocket.accept()
 
+    # Make room by closing the user's oldest connections (dicts keep insertion order).
+    # Done before taking the user's entry below: closing their last connection removes it
+    existing = self.active_connections.get(user_id)
+    while existing and len(existing) >= MAX_CONNECTIONS_PER_USER:
+      oldest_id = next(iter(existing))
+      logger.warning(f"User {user_id} exceeded {MAX_CONNECTIONS_PER_USER} connections, closing {oldest_id}")
+      await self._close_connection(user_id, oldest_id, code=1008, reason="Too many connections")
+      existing = self.active_connections.get(user_id)
+
+    # Reconnected within the grace period (or replaced their last connection just above):
+    # the user never goes offline
+    offline_timer = self.offline_timers.pop(user_id, None)
+    if offline_timer is not None:
+      offline_timer.cancel()
+
     # Initialize user's connections if not exists
     if user_id not in self.active_connections:
       self.active_connections[user_id] = {}
       self.user_conversations[user_id] = set()
+      # First local connection for this user: make sure this instance hears their shard
+      await add_local_user(user_id)
+    user_connections = self.active_connections.setdefault(user_id, {})
 
     # Generate a connection ID for this specific connection
     connection_id = str(uuid.uuid4())
-    self.active_connections[user_id][connection_id] = websocket
+    user_connections[connection_id] = websocket
+    self.last_seen[connection_id] = time.monotonic()
+    if binary_frames:
+      self.binary_connections.add(connection_id)
+    await self._register_presence(user_id, connection_id, websocket)
+
+    # Another local connection already marked this user online
+    if len(user_connections) > 1:
+      logger.info(f"User {user_id} connected with connection ID {connection_id}")
+      return connection_id
 
     # Update user status to online in Firestore
+    self.last_active_write[user_id] = time.monotonic()
     try:
-      user_ref = firestore_db.collection('users').document(user_id)
+      user_ref = get_firestore_async_client().collection('users').document(user_id)
       
       # Check if user document exists
-      user_doc = user_ref.get()
+      user_doc = await user_ref.get()
       if not user_doc.exists:
         # Create user document if it doesn't exist
-        user_ref.set({
+        await user_ref.set({
           'phoneNumber': user_id,
           'isOnline': True,
           'lastActive': firestore.SERVER_TIMESTAMP,
@@ -61,7 +131,7 @@ class ConnectionManager:
         logger.info(f"Created new user document for {user_id}")
       else:
         # Update existing user document
-        user_ref.update({
+        await user_ref.update({
           'isOnline': True,
           'lastActive': firestore.SERVER_TIMESTAMP
         })
@@ -76,8 +146,15 @@ class ConnectionManager:
     """
     Disconnect a WebSocket client
     """
+    self.last_seen.pop(connection_id, None)
+    self.binary_connections.discard(connection_id)
     if user_id in self.active_connections and connection_id in self.active_connections[user_id]:
       del self.active_connections[user_id][connection_id]
+      try:
+        asyncio.get_running_loop().create_task(self._unregister_presence(user_id, connection_id))
+      except RuntimeError:
+        # No running loop (e.g. interpreter shutdown); the key expires on its own
+        pass
       logger.info(f"User {user_id} disconnected connection ID {connection_id}")
 
       # If this was the last connection for this user, clean up
@@ -85,27 +162,133 @@ class ConnectionManager:
         del self.active_connections[user_id]
         if user_id in self.user_conversations:
           del self.user_conversations[user_id]
+        self.last_active_write.pop(user_id, None)
+        remove_local_user(user_id)
         logger.info(f"User {user_id} has no more active connections")
         return True  # All connections closed
 
     return False  # User still has other connections
 
-  async def set_offline_status(self, user_id: str):
+  async def _register_presence(self, user_id: str, connection_id: str, websocket: WebSocket):
     """
-    Set user status to offline with a delay
+    Record the connection in Redis, where any instance can tell whether the user is online
+    with one HLEN (or one pipelined round trip for a whole participant list)
     """
     try:
-      await asyncio.sleep(60)  # 60-second grace period
+      client = websocket.client
+      redis_conn = await get_redis_connection()
+      key = f"{PRESENCE_KEY_PREFIX}{user_id}"
+      async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hset(key, connection_id, orjson.dumps({
+          'instance_id': self.instance_id,
+          'created_at': time.time(),
+          'ip_address': client.host if client else None
+        }))
+        pipe.expire(key, PRESENCE_TTL_SECONDS)
+        await pipe.execute()
+    except Exception as e:
+      logger.error(f"Error registering presence for {user_id}: {str(e)}")
+
+  async def _unregister_presence(self, user_id: str, connection_id: str):
+    try:
+      redis_conn = await get_redis_connection()
+      await redis_conn.hdel(f"{PRESENCE_KEY_PREFIX}{user_id}", connection_id)
+    except Exception as e:
+      logger.error(f"Error removing presence for {user_id}: {str(e)}")
+
+  async def _refresh_presence(self):
+    """Extend the presence keys of every locally connected user in one pipelined round trip."""
+    if not self.active_connections:
+      return
+    redis_conn = await get_redis_connection()
+    async with redis_conn.pipeline(transaction=False) as pipe:
+      for user_id in self.active_connections:
+        pipe.expire(f"{PRESENCE_KEY_PREFIX}{user_id}", PRESENCE_TTL_SECONDS)
+      await pipe.execute()
+
+  def touch(self, connection_id: str):
+    """
+    Record activity on a connection so the idle sweeper keeps it open
+    """
+    if connection_id in self.last_seen:
+      self.last_seen[connection_id] = time.monotonic()
+
+  async def _close_connection(self, user_id: str, connection_id: str, code: int, reason: str):
+    """
+    Remove a connection from the manager and close its socket.
 
+    The connection's own receive loop then ends, and its disconnect call is a no-op,
+    so the offline grace period is started here when this was the user's last connection.
+    """
+    websocket = self.active_connections.get(user_id, {}).get(connection_id)
+    if websocket is None:
+      return
+    if self.disconnect(user_id, connection_id):
+      self.schedule_offline(user_id)
+    try:
+      await websocket.close(code=code, reason=reason)
+    except Exception as e:
+      # Already closed by the client or the transport
+      logger.debug(f"Error closing connection {connection_id}: {str(e)}")
+
+  async def sweep_idle_connections(self):
+    """
+    Periodically close connections that have been silent for longer than IDLE_TIMEOUT_SECONDS,
+    and keep the presence keys of the remaining ones from expiring.
+
+    Catches sockets whose disconnect was never observed (crashed clients, dropped networks),
+    which would otherwise stay in active_connections and keep receiving broadcasts.
+    """
+    while True:
+      await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+      try:
+        cutoff = time.monotonic() - IDLE_TIMEOUT_SECONDS
+        idle = [(user_id, connection_id)
+                for user_id, connections in self.active_connections.items()
+                for connection_id in connections
+                if self.last_seen.get(connection_id, 0) < cutoff]
+        for user_id, connection_id in idle:
+          await self._close_connection(user_id, connection_id, code=1001, reason="Idle timeout")
+        if idle:
+          logger.info(f"Closed {len(idle)} idle WebSocket connection(s), "
+                      f"{self.get_total_connections_count()} remaining")
+        await self._refresh_presence()
+      except Exception as e:
+        logger.error(f"Error sweeping idle connections: {str(e)}")
+
+  def schedule_offline(self, user_id: str):
+    """
+    Mark a user offline once OFFLINE_GRACE_SECONDS pass without them reconnecting
+
+    Call after the user's last connection closes. A single timer per user replaces any
+    earlier one, and connect() cancels it, so flapping connections leave nothing behind.
+    """
+    previous = self.offline_timers.pop(user_id, None)
+    if previous is not None:
+      previous.cancel()
+    self.offline_timers[user_id] = asyncio.get_running_loop().call_later(
+      OFFLINE_GRACE_SECONDS, self._offline_timer_fired, user_id
+    )
+
+  def _offline_timer_fired(self, user_id: str):
+    self.offline_timers.pop(user_id, None)
+    if user_id not in self.active_connections:
+      asyncio.create_task(self.set_offline_status(user_id))
+
+  async def set_offline_status(self, user_id: str):
+    """
+    Set user status to offline if they still have no connections (see schedule_offline)
+    """
+    try:
       # Check if the user still has no connections
       if user_id not in self.active_connections:
-        user_ref = firestore_db.collection('users').document(user_id)
+        user_ref = get_firestore_async_client().collection('users').document(user_id)
         
         # Check if user document exists
-        user_doc = user_ref.get()
+        user_doc = await user_ref.get()
         if not user_doc.exists:
           # Create user document if it doesn't exist
-          user_ref.set({
+          await user_ref.set({
             'phoneNumber': user_id,
             'isOnline': False,
             'lastActive': firestore.SERVER_TIMESTAMP,
@@ -114,7 +297,7 @@ class ConnectionManager:
           logger.info(f"Created new user document for {user_id} with offline status")
         else:
           # Update existing user document
-          user_ref.update({
+          await user_ref.update({
             'isOnline': False,
             'lastActive': firestore.SERVER_TIMESTAMP
           })
@@ -123,87 +306,147 @@ class ConnectionManager:
     except Exception as e:
       logger.error(f"Error updating offline status: {str(e)}")
 
+  async def _fan_out(self, targets: List[Tuple[str, str, WebSocket]], message_json: str):
+    """
+    Send one serialized payload to many connections concurrently, so a slow client
+    does not delay delivery to the ones after it, then drop the connections that failed.
+
+    Sends share a global concurrency bound and each has a timeout; a client that cannot
+    take a frame within SEND_TIMEOUT_SECONDS is closed rather than stalling the broadcast.
+
+    Args:
+        targets: (user_id, connection_id, websocket) for every connection to send to
+        message_json: The already-serialized message
+    """
+    if not targets:
+      return
+
+    # Encoded once and shared by every connection that asked for binary frames
+    binary = self.binary_connections
+    message_bytes = message_json.encode() if binary else None
+    results = await asyncio.gather(
+      *[_send_bounded(websocket, message_json, message_bytes if connection_id in binary else None)
+        for _, connection_id, websocket in targets],
+      return_exceptions=True
+    )
+
+    # Clean up disconnected or stuck websockets; closing happens in the background so a
+    # stalled transport cannot hold up this broadcast either
+    for (user_id, connection_id, _), result in zip(targets, results):
+      if isinstance(result, Exception):
+        if isinstance(result, asyncio.TimeoutError):
+          logger.warning(f"Send to {user_id} connection {connection_id} timed out, closing it")
+        else:
+          logger.error(f"Error sending to {user_id} connection {connection_id}: {str(result)}")
+        asyncio.create_task(self._close_connection(user_id, connection_id, code=1011, reason="Send failed"))
+
   async def send_personal_message(self, message: dict, user_id: str):
     """
     Send a message to a specific user's all connections
     """
     if user_id in self.active_connections:
-      disconnected = []
-      message_json = json.dumps(message)
-
-      for connection_id, websocket in self.active_connections[user_id].items():
-        try:
-          await websocket.send_text(message_json)
-        except Exception as e:
-          logger.error(f"Error sending message to {user_id} connection {connection_id}: {str(e)}")
-          disconnected.append((user_id, connection_id))
-
-      # Clean up any disconnected websockets
-      for user_id, connection_id in disconnected:
-        self.disconnect(user_id, connection_id)
-
-  async def broadcast_to_conversation(self, message: dict, conversation_id: str, skip_user_id: Optional[str] = None):
+      message_json = orjson.dumps(message).decode()
+      targets = [(user_id, connection_id, websocket)
+                 for connection_id, websocket in self.active_connections[user_id].items()]
+      await self._fan_out(targets, message_json)
+
+  async def broadcast_to_conversation(self, message: dict, conversation_id: str, skip_user_id: Optional[str] = None,
+                                      participants: Optional[Iterable[str]] = None, shard: Optional[int] = None,
+                                      message_json: Optional[str] = None):
     """
     Broadcast a message to all participants in a conversation
+
+    Callers that already hold the participant list can pass it to skip the lookup.
+    Events relayed from a pub/sub shard channel pass that shard, so only the local
+    participants in it are sent to (the other shards deliver to the rest), and pass the
+    frame as received in message_json so it is not serialized again.
     """
     try:
-      # Get conversation participants from Firestore
-      conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-      conversation = conversation_ref.get()
-
-      if not conversation.exists:
-        logger.error(f"Conversation {conversation_id} not found for broadcasting")
-        return
-
-      participants = conversation.to_dict().get('participants', [])
-      message_json = json.dumps(message)
-
-      # Track users to disconnect
-      disconnected = []
+      if participants is None:
+        # Get conversation participants (served from the short-lived conversation cache)
+        conversation = await get_cached_conversation(conversation_id)
+
+        if conversation is None:
+          logger.error(f"Conversation {conversation_id} not found for broadcasting")
+          return
+
+        participants = conversation.participants
+      if message_json is None:
+        message_json = orjson.dumps(message).decode()
+
+      # Intersect participants with locally connected users, walking whichever side is
+      # smaller: large groups usually have only a few members connected to this instance
+      local = self.active_connections
+      if not isinstance(participants, (set, frozenset)):
+        participants = frozenset(participants)
+      if len(local) < len(participants):
+        recipients = [user_id for user_id in local if user_id in participants]
+      else:
+        recipients = [participant for participant in participants if participant in local]
 
-      # Send to all connected participants except the sender
-      for participant in participants:
+      # Collect every connection of every connected participant except the sender
+      targets = []
+      for participant in recipients:
         if participant == skip_user_id:
           continue
+        if shard is not None and user_shard(participant) != shard:
+          continue
 
-        if participant in self.active_connections:
-          # Add conversation to user's conversation set
-          if participant in self.user_conversations:
-            self.user_conversations[participant].add(conversation_id)
+        # Add conversation to user's conversation set
+        if participant in self.user_conversations:
+          self.user_conversations[participant].add(conversation_id)
 
-          # Send to all connections for this user
-          for connection_id, websocket in self.active_connections[participant].items():
-            try:
-              await websocket.send_text(message_json)
-            except Exception as e:
-              logger.error(f"Error broadcasting to {participant} connection {connection_id}: {str(e)}")
-              disconnected.append((participant, connection_id))
+        targets.extend((participant, connection_id, websocket)
+                       for connection_id, websocket in local[participant].items())
 
-      # Clean up any disconnected websockets
-      for user_id, connection_id in disconnected:
-        self.disconnect(user_id, connection_id)
+      await self._fan_out(targets, message_json)
 
     except Exception as e:
       logger.error(f"Error in broadcast_to_conversation: {str(e)}")
 
-  async def handle_typing_notification(self, conversation_id: str, user_id: str):
+  async def relay_to_conversation(self, event: Dict[str, Any], conversation_id: str, skip_user_id: str = None):
+    """
+    Deliver an event to every participant's connections, whichever instance holds them
+
+    The event is published to the participants' shard channels, and each instance's
+    listener (this one included) delivers it to its local sockets. If Redis is
+    unavailable, only local connections receive it.
+
+    Args:
+        event: The event payload
+        conversation_id: The conversation the event belongs to
+        skip_user_id: Participant that should not receive the event (usually its author)
+    """
+    try:
+      redis_conn = await get_redis_connection()
+      await publish_conversation_event(redis_conn, conversation_id, event)
+    except Exception as e:
+      logger.error(f"Error publishing {event.get('event')} event, broadcasting locally: {str(e)}")
+      await self.broadcast_to_conversation(event, conversation_id, skip_user_id=skip_user_id)
+
+  async def handle_typing_notification(self, conversation_id: str, user_id: str, relay: bool = False):
     """
     Broadcast typing notification to conversation participants
     
     Args:
         conversation_id: The ID of the conversation where typing is occurring
         user_id: The ID of the user who is typing
+        relay: Publish through Redis so participants connected to other instances see it too;
+            False delivers to this instance's connections only (the HTTP endpoint's fallback)
     """
     typing_event = {
       'event': 'typing',
       'conversationId': conversation_id,
       'userId': user_id
     }
-    await self.broadcast_to_conversation(typing_event, conversation_id, skip_user_id=user_id)
+    if relay:
+      await self.relay_to_conversation(typing_event, conversation_id, skip_user_id=user_id)
+    else:
+      await self.broadcast_to_conversation(typing_event, conversation_id, skip_user_id=user_id)
 
   async def handle_read_receipt(self, conversation_id: str, message_id: str, user_id: str):
     """
-    Broadcast read receipt to conversation participants and update message status in database
+    Broadcast read receipt to conversation participants on every instance and update message status in database
     
     Args:
         conversation_id: The ID of the conversation containing the message
@@ -213,51 +456,42 @@ class ConnectionManager:
     # Update the message read status in Firestore
     try:
       # Get the message reference
-      message_ref = firestore_db.collection('conversations').document(conversation_id) \
+      message_ref = conversations_collection.document(conversation_id) \
                                .collection('messages').document(message_id)
       
-      # Update the read status in a transaction to ensure consistency
+      user_stats_ref = conversations_collection.document(conversation_id) \
+                                   .collection('user_stats').document(user_id)
+      
+      # Update the read status and unread count in one transaction to ensure consistency
       @firestore.transactional
-      def update_read_status(transaction, message_ref):
-        message = message_ref.get(transaction=transaction)
+      def update_read_status(transaction, message_ref, user_stats_ref):
+        # Both documents come back from a single get_all round trip
+        snapshots = {snap.reference.path: snap
+                     for snap in transaction.get_all([message_ref, user_stats_ref])}
+        message = snapshots[message_ref.path]
         if not message.exists:
           logger.error(f"Message {message_id} not found in conversation {conversation_id}")
           return False
         
-        message_data = message.to_dict()
-        read_by = message_data.get('readBy', [])
-        
         # Only update if the user hasn't already read the message
-        if user_id not in read_by:
-          read_by.append(user_id)
-          transaction.update(message_ref, {'readBy': read_by})
-          logger.info(f"Updated read status for message {message_id} by user {user_id}")
-          return True
-        return False
+        if user_id in message.to_dict().get('readBy', []):
+          return False
+        
+        # ArrayUnion appends server-side, so concurrent readers never overwrite each other
+        transaction.update(message_ref, {'readBy': firestore.ArrayUnion([user_id])})
+        
+        # Decrement the unread count in the same commit, never going below zero
+        user_stats = snapshots[user_stats_ref.path]
+        if user_stats.exists and user_stats.to_dict().get('unreadCount', 0) > 0:
+          transaction.update(user_stats_ref, {'unreadCount': firestore.Increment(-1)})
+        logger.info(f"Updated read status for message {message_id} by user {user_id}")
+        return True
       
-      # Execute the transaction
-      transaction = firestore_db.transaction()
-      was_updated = update_read_status(transaction, message_ref)
+      # Execute the transaction off the event loop
+      was_updated = await fs_run(update_read_status, firestore_db.transaction(), message_ref, user_stats_ref)
       
-      # Update unread count if message was marked as read
+      # Broadcast only if the message was newly read
       if was_updated:
-        # Update the unread count for the user in this conversation
-        try:
-          import asyncio
-          user_stats_ref = firestore_db.collection('conversations').document(conversation_id) \
-                                       .collection('user_stats').document(user_id)
-          
-          # Get current unread count
-          user_stats = await asyncio.to_thread(user_stats_ref.get)
-          if user_stats.exists:
-            unread_count = user_stats.to_dict().get('unreadCount', 0)
-            if unread_count > 0:  # Ensure we don't go below zero
-              await asyncio.to_thread(user_stats_ref.update, {'unreadCount': unread_count - 1})
-              logger.info(f"WebSocket: Decremented unread count for user {user_id} in conversation {conversation_id} to {unread_count - 1}")
-        except Exception as e:
-          logger.error(f"Error updating unread count in WebSocket handler: {str(e)}")
-          # Still continue with broadcasting the read receipt
-        
         # Broadcast read receipt to other participants
         read_event = {
           'event': 'message_read',
@@ -265,7 +499,7 @@ class ConnectionManager:
           'messageId': message_id,
           'userId': user_id
         }
-        await self.broadcast_to_conversation(read_event, conversation_id, skip_user_id=user_id)
+        await self.relay_to_conversation(read_event, conversation_id, skip_user_id=user_id)
       
     except Exception as e:
       logger.error(f"Error updating read receipt in database: {str(e)}")
@@ -276,7 +510,7 @@ class ConnectionManager:
         'messageId': message_id,
         'userId': user_id
       }
-      await self.broadcast_to_conversation(read_event, conversation_id, skip_user_id=user_id)
+      await self.relay_to_conversation(read_event, conversation_id, skip_user_id=user_id)
 
   def get_user_connection_count(self, user_id: str) -> int:
     """
@@ -319,6 +553,13 @@ class ConnectionManager:
     if not metadata:
       metadata = {}
     
+    # Heartbeats only refresh lastActive; skip the write if it was refreshed recently
+    if activity_type == 'heartbeat':
+      now = time.monotonic()
+      if now - self.last_active_write.get(user_id, 0) < LAST_ACTIVE_WRITE_INTERVAL_SECONDS:
+        return
+      self.last_active_write[user_id] = now
+
     logger.info(f"Handling user activity: {activity_type} for user {user_id}")
     
     try:
@@ -326,7 +567,7 @@ class ConnectionManager:
       user_ref = firestore_db.collection('users').document(user_id)
       
       # Check if user document exists
-      user_doc = await asyncio.to_thread(user_ref.get)
+      user_doc = await fs_run(user_ref.get)
       
       update_data = {
         'lastActive': firestore.SERVER_TIMESTAMP,
@@ -346,11 +587,11 @@ class ConnectionManager:
           'createdAt': firestore.SERVER_TIMESTAMP,
           **update_data
         }
-        await asyncio.to_thread(user_ref.set, create_data)
+        await fs_run(user_ref.set, create_data)
         logger.info(f"Created new user document for {user_id} during activity handling")
       else:
         # Update existing user
-        await asyncio.to_thread(user_ref.update, update_data)
+        await fs_run(user_ref.update, update_data)
       
       # If this is a status change, broadcast to relevant conversations
       if activity_type == 'status_change' and 'status' in metadata:
@@ -366,10 +607,13 @@ class ConnectionManager:
         # Get Redis connection for publishing
         redis_conn = await get_redis_connection()
         
-        # Broadcast status change to all conversations
-        for conversation_id in conversations:
-          channel = f"conversation:{conversation_id}"
-          await redis_conn.publish(channel, json.dumps(status_event))
+        # Publish once to the shards of everyone who shares a conversation with this user;
+        # receivers fan it out per conversation in broadcast_user_status
+        audience = set()
+        for conversation in await asyncio.gather(*[get_cached_conversation(c) for c in conversations]):
+          if conversation is not None:
+            audience.update(conversation.participants)
+        await publish_to_users(redis_conn, status_event, audience)
           
         logger.info(f"Broadcast status change for user {user_id} to {len(conversations)} conversations")
           
@@ -395,11 +639,11 @@ class ConnectionManager:
       conversations = set()
       
       # Query conversations where user is a participant
-      conversations_ref = firestore_db.collection('conversations')
+      conversations_ref = conversations_collection
       query = conversations_ref.where('participants', 'array_contains', user_id)
       
       # Execute query
-      conversation_docs = await asyncio.to_thread(query.get)
+      conversation_docs = await fs_run(query.get)
       
       # Extract conversation IDs
       for doc in conversation_docs:
@@ -415,7 +659,7 @@ class ConnectionManager:
       logger.error(f"Error getting user conversations: {str(e)}")
       return set()
   
-  async def broadcast_user_status(self, user_id: str, status: str):
+  async def broadcast_user_status(self, user_id: str, status: str, shard: Optional[int] = None):
     """
     Broadcast a user's status change to relevant local connections
     
@@ -425,6 +669,7 @@ class ConnectionManager:
     Args:
         user_id: The ID of the user whose status changed
         status: The new status value
+        shard: Pub/sub shard the event arrived on; only local users in it are sent to
     """
     try:
       # Get all conversations this user participates in
@@ -432,14 +677,13 @@ class ConnectionManager:
       
       # For each conversation, deliver status update to other participants
       for conversation_id in conversations:
-        # Get conversation participants
-        conversation_ref = firestore_db.collection('conversations').document(conversation_id)
-        conversation = await asyncio.to_thread(conversation_ref.get)
+        # Get conversation participants (served from the short-lived conversation cache)
+        conversation = await get_cached_conversation(conversation_id)
         
-        if not conversation.exists:
+        if conversation is None:
           continue
           
-        participants = conversation.to_dict().get('participants', [])
+        participants = conversation.participants
         
         # Prepare status change message
         message = {
@@ -448,29 +692,22 @@ class ConnectionManager:
           'status': status,
           'conversationId': conversation_id
         }
-        message_json = json.dumps(message)
-        
-        # Track disconnections
-        disconnected = []
+        message_json = orjson.dumps(message).decode()
         
         # Send to all local participants (except the user whose status changed)
+        targets = []
         for participant in participants:
           if participant == user_id:
             continue
+          if shard is not None and user_shard(participant) != shard:
+            continue
             
           if participant in self.active_connections:
-            # Send to all connections for this participant
-            for connection_id, websocket in self.active_connections[participant].items():
-              try:
-                await websocket.send_text(message_json)
-                logger.debug(f"Sent status update about {user_id} to {participant}")
-              except Exception as e:
-                logger.error(f"Error sending status update to {participant}: {str(e)}")
-                disconnected.append((participant, connection_id))
+            targets.extend((participant, connection_id, websocket)
+                           for connection_id, websocket in self.active_connections[participant].items())
         
-        # Clean up disconnected connections
-        for user_id, connection_id in disconnected:
-          self.disconnect(user_id, connection_id)
+        await self._fan_out(targets, message_json)
+        logger.debug(f"Sent status update about {user_id} to {len(targets)} connection(s) in {conversation_id}")
           
     except Exception as e:
       logger.error(f"Error broadcasting user status: {str(e)}")
@@ -491,7 +728,7 @@ class ConnectionManager:
       redis_conn = await get_redis_connection()
       
       # Get all user keys
-      all_user_keys = await redis_conn.keys("connections:*")
+      all_user_keys = await redis_conn.keys(f"{PRESENCE_KEY_PREFIX}*")
       global_users = len(all_user_keys)
       
       # Count all connections across instances
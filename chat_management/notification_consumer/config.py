@@ -26,6 +26,8 @@ class Settings(BaseSettings):
     sqs_max_messages: int = 10
     sqs_visibility_timeout: int = 60  # seconds
     sqs_wait_time: int = 20  # seconds
+    sqs_consumer_pool_size: int = 4  # concurrent long-polling receivers on the main queue
+    sqs_max_in_flight: int = 100  # received messages being handled at once, across all pollers
     
     # Retry settings
     max_retry_attempts: int = 5
@@ -41,6 +43,11 @@ class Settings(BaseSettings):
     
     # Notification processing settings
     max_notification_content_length: int = 100  # max length for notification content
+    
+    # In-process caches of rarely changing Firestore reads
+    cache_max_entries: int = 50_000  # per cache; the oldest entry is evicted beyond this
+    user_name_cache_ttl_seconds: int = 60
+    preferences_cache_ttl_seconds: int = 300
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -1,8 +1,9 @@
-import json
 import logging
 import uuid
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import orjson
 
 from config import settings
 from firebase_client import FirebaseClient
@@ -10,6 +11,21 @@ from sqs_client import SQSClient
 
 logger = logging.getLogger(__name__)
 
+# Outcomes of process_event. The consumer deletes processed messages, and the ones it
+# managed to re-queue, from the queue they came from in one batch per receive; failed
+# ones are left on the queue and become visible again after the visibility timeout
+PROCESSED = 'processed'
+RETRY = 'retry'
+FAILED = 'failed'
+
+
+class EventOutcome(NamedTuple):
+    """Result of processing one SQS message"""
+    status: str
+    # For RETRY: the event to re-queue and the attempt number to re-queue it as
+    event_data: Optional[Dict] = None
+    attempt: int = 0
+
 
 class EventProcessor:
     """Processes notification events from SQS queue."""
@@ -24,17 +40,28 @@ class EventProcessor:
         """
         self.firebase = firebase_client
         self.sqs = sqs_client
+        
+        # Event type to handler map, built once instead of comparing strings per message
+        self._handlers: Dict[str, Callable[[Dict], bool]] = {
+            'new_message': self._process_new_message,
+            'group_invitation': self._process_group_invitation,
+            'friend_request': self._process_friend_request,
+        }
         logger.info("Event processor initialized")
     
-    def process_event(self, message: Dict) -> bool:
+    def process_event(self, message: Dict) -> EventOutcome:
         """
         Process an SQS message containing a notification event.
         
+        The message is neither deleted nor re-queued here; the caller does both for a
+        whole received batch at once, on the queue it was received from.
+        
         Args:
             message: SQS message dictionary
             
         Returns:
-            True if processing was successful, False otherwise
+            PROCESSED on success, RETRY with the event to send to the retry queue,
+            FAILED if the message should stay on its queue
         """
         try:
             # Extract message body
@@ -42,16 +69,16 @@ class EventProcessor:
             
             if not receipt_handle:
                 logger.error("Missing receipt handle in SQS message")
-                return False
+                return EventOutcome(FAILED)
             
             body = message.get('Body', '{}')
             
             # Parse message body
             try:
-                event_data = json.loads(body)
-            except json.JSONDecodeError as e:
+                event_data = orjson.loads(body)
+            except orjson.JSONDecodeError as e:
                 logger.error(f"Invalid JSON in message body: {str(e)}")
-                return False
+                return EventOutcome(FAILED)
             
             # Extract event metadata
             event_id = event_data.get('messageId') or event_data.get('eventId')
@@ -63,7 +90,7 @@ class EventProcessor:
             
             if not event_type:
                 logger.error("Missing event type in message")
-                return False
+                return EventOutcome(FAILED)
             
             # Check for retry attempt information
             retry_data = event_data.get('_retry', {})
@@ -73,33 +100,34 @@ class EventProcessor:
             logger.info(f"Processing {event_type} event (ID: {event_id}, attempt: {current_attempt})")
             
             # Route to appropriate handler
-            success = False
-            if event_type == 'new_message':
-                success = self._process_new_message(event_data)
-            elif event_type == 'group_invitation':
-                success = self._process_group_invitation(event_data)
-            elif event_type == 'friend_request':
-                success = self._process_friend_request(event_data)
-            else:
+            handler = self._handlers.get(event_type)
+            if handler is None:
                 logger.warning(f"Unknown event type: {event_type}")
-                return False
+                return EventOutcome(FAILED)
+            success = handler(event_data)
             
             # Handle success/failure
             if success:
-                # Delete message from queue on success
                 logger.info(f"Successfully processed {event_type} event (ID: {event_id})")
-                self.sqs.delete_message(settings.main_queue_url, receipt_handle)
-                return True
+                return EventOutcome(PROCESSED)
             else:
-                # Send to retry queue on failure
+                # Hand back for the retry queue on failure
                 logger.warning(f"Failed to process {event_type} event (ID: {event_id})")
-                self.sqs.send_to_retry_queue(event_data, current_attempt + 1)
-                self.sqs.delete_message(settings.main_queue_url, receipt_handle)
-                return False
+                return EventOutcome(RETRY, event_data, current_attempt + 1)
                 
         except Exception as e:
             logger.error(f"Error processing event: {str(e)}")
-            return False
+            return EventOutcome(FAILED)
+    
+    def _is_online(self, user_id: str, user_data: Dict) -> bool:
+        """
+        Check presence against the listener's online set, falling back to the isOnline
+        field already read with the user's document while the listener is down.
+        """
+        online_users = self.firebase.get_online_users()
+        if online_users is None:
+            return user_data.get('isOnline', False)
+        return user_id in online_users
     
     def _process_new_message(self, event_data: Dict) -> bool:
         """
@@ -126,74 +154,78 @@ class EventProcessor:
             
             logger.info(f"Processing new message notification for conversation {conversation_id}")
             
-            # Get sender info from Firestore
-            sender_ref = self.firebase.firestore_db.collection('users').document(sender_id)
-            sender = sender_ref.get()
-            sender_name = sender_id  # Default to ID if name not found
+            recipients = [participant_id for participant_id in participants if participant_id != sender_id]
             
-            if sender.exists:
-                sender_data = sender.to_dict()
-                sender_name = sender_data.get('name', sender_id)
+            # The conversation and every recipient's presence in one get_all read
+            users = self.firebase.firestore_db.collection('users')
+            conversation_ref = self.firebase.firestore_db.collection('conversations').document(conversation_id)
+            recipient_refs = [users.document(participant_id) for participant_id in recipients]
+            docs = self.firebase.get_documents(
+                [conversation_ref, *recipient_refs],
+                field_paths=['isOnline']
+            )
             
-            # Track overall success
-            overall_success = True
+            if conversation_ref.path not in docs:
+                logger.warning(f"Conversation {conversation_id} no longer exists, skipping notifications")
+                return True
             
-            # Process each recipient
-            for participant_id in participants:
-                if participant_id == sender_id:
-                    continue  # Skip the sender
-                
-                # Check if user is online
-                is_online = self.firebase.is_user_online(participant_id)
-                
-                # If user is offline, consider sending notification
-                if not is_online:
-                    # Generate unique notification ID
-                    notification_id = str(uuid.uuid4())
-                    
-                    # Store notification in Firestore
-                    notification_data = {
-                        'conversationId': conversation_id,
-                        'messageId': message_id,
-                        'senderId': sender_id
-                    }
-                    
-                    # Truncate content if needed
-                    display_content = content
-                    if len(display_content) > settings.max_notification_content_length:
-                        display_content = content[:settings.max_notification_content_length] + '...'
-                    
-                    # Store in Firestore
-                    storage_success = self.firebase.store_notification(
-                        notification_id,
-                        participant_id,
-                        'message',
-                        sender_name,
-                        display_content,
-                        notification_data
-                    )
-                    
-                    # Check notification preferences for push delivery
-                    preferences = self.firebase.get_user_preferences(participant_id)
-                    should_notify = preferences.get('pushEnabled', True) and preferences.get('messageNotifications', True)
-                    
-                    # Send push notification if enabled
-                    if should_notify:
-                        push_result = self.firebase.send_fcm_notification(
-                            participant_id,
-                            sender_name,
-                            display_content,
-                            notification_data
-                        )
-                        
-                        # Update overall success
-                        if not push_result.get('success'):
-                            if push_result.get('status') != 'NO_TOKENS':
-                                logger.warning(f"Push notification failed for user {participant_id}")
-                                overall_success = overall_success and False
-                    
-                    # Update overall success based on storage
-                    overall_success = overall_success and storage_success
+            # Default to ID if name not found
+            sender_name = self.firebase.get_user_name(sender_id) or sender_id
+            
+            # Phase 1: classify recipients. Online users are skipped, offline users get a
+            # stored notification, and those with message push enabled get a push as well.
+            # Recipients without a user document are treated as offline
+            to_store = [
+                participant_id for participant_id, participant_ref in zip(recipients, recipient_refs)
+                if not self._is_online(participant_id, docs.get(participant_ref.path, {}))
+            ]
+            
+            if not to_store:
+                return True
+            
+            preferences = self.firebase.get_users_preferences(to_store)
+            to_push = [
+                participant_id for participant_id in to_store
+                if preferences[participant_id].get('pushEnabled', True)
+                and preferences[participant_id].get('messageNotifications', True)
+            ]
+            
+            notification_data = {
+                'conversationId': conversation_id,
+                'messageId': message_id,
+                'senderId': sender_id
+            }
+            
+            # Truncate content if needed
+            display_content = content
+            if len(display_content) > settings.max_notification_content_length:
+                display_content = content[:settings.max_notification_content_length] + '...'
+            
+            # Phase 2: store every notification in batched writes, bumping the unread count
+            # of recipients that have a user document, then send the pushes
+            overall_success = self.firebase.store_notifications(
+                to_store,
+                'message',
+                sender_name,
+                display_content,
+                notification_data,
+                counted_user_ids=[participant_id for participant_id, ref in zip(recipients, recipient_refs)
+                                  if ref.path in docs]
+            )
+            
+            # One set of multicast requests for every recipient's devices
+            push_results = self.firebase.send_fcm_notifications(
+                to_push,
+                sender_name,
+                display_content,
+                notification_data
+            ) if to_push else {}
+            
+            for participant_id, push_result in push_results.items():
+                # Update overall success
+                if not push_result.get('success') and push_result.get('status') != 'NO_TOKENS':
+                    logger.warning(f"Push notification failed for user {participant_id}")
+                    overall_success = False
             
             return overall_success
             
@@ -216,7 +248,7 @@ class EventProcessor:
             conversation_id = event_data.get('conversationId')
             sender_id = event_data.get('senderId')
             invitee_id = event_data.get('inviteeId')
-            group_name = event_data.get('groupName', 'a group')
+            group_name = event_data.get('groupName')
             
             # Validate required fields
             if not all([conversation_id, sender_id, invitee_id]):
@@ -225,17 +257,22 @@ class EventProcessor:
             
             logger.info(f"Processing group invitation notification for {invitee_id}")
             
-            # Get sender info from Firestore
-            sender_ref = self.firebase.firestore_db.collection('users').document(sender_id)
-            sender = sender_ref.get()
-            sender_name = sender_id  # Default to ID if name not found
+            # Invitee presence and the conversation in one get_all read
+            invitee_ref = self.firebase.firestore_db.collection('users').document(invitee_id)
+            conversation_ref = self.firebase.firestore_db.collection('conversations').document(conversation_id)
+            docs = self.firebase.get_documents(
+                [invitee_ref, conversation_ref],
+                field_paths=['name', 'isOnline']
+            )
             
-            if sender.exists:
-                sender_data = sender.to_dict()
-                sender_name = sender_data.get('name', sender_id)
+            if conversation_ref.path not in docs:
+                logger.warning(f"Conversation {conversation_id} no longer exists, skipping invitation")
+                return True
             
-            # Check if invitee is online
-            is_online = self.firebase.is_user_online(invitee_id)
+            # Default to ID if name not found
+            sender_name = self.firebase.get_user_name(sender_id) or sender_id
+            group_name = group_name or docs[conversation_ref.path].get('name') or 'a group'
+            is_online = self._is_online(invitee_id, docs.get(invitee_ref.path, {}))
             
             # Prepare notification content
             title = f"{sender_name}"
@@ -246,17 +283,14 @@ class EventProcessor:
                 'type': 'group_invitation'
             }
             
-            # Generate unique notification ID
-            notification_id = str(uuid.uuid4())
-            
-            # Store notification in Firestore
-            storage_success = self.firebase.store_notification(
-                notification_id,
-                invitee_id,
+            # Store the notification and bump the unread count in one batched write
+            storage_success = self.firebase.store_notifications(
+                [invitee_id],
                 'group_invitation',
                 title,
                 body,
-                notification_data
+                notification_data,
+                counted_user_ids=[invitee_id] if invitee_ref.path in docs else ()
             )
             
             # If user is offline, consider sending push notification
@@ -302,17 +336,13 @@ class EventProcessor:
             
             logger.info(f"Processing friend request notification from {sender_id} to {recipient_id}")
             
-            # Get sender info from Firestore
-            sender_ref = self.firebase.firestore_db.collection('users').document(sender_id)
-            sender = sender_ref.get()
-            sender_name = sender_id  # Default to ID if name not found
-            
-            if sender.exists:
-                sender_data = sender.to_dict()
-                sender_name = sender_data.get('name', sender_id)
+            # Recipient presence
+            recipient_ref = self.firebase.firestore_db.collection('users').document(recipient_id)
+            docs = self.firebase.get_documents([recipient_ref], field_paths=['isOnline'])
             
-            # Check if recipient is online
-            is_online = self.firebase.is_user_online(recipient_id)
+            # Default to ID if name not found
+            sender_name = self.firebase.get_user_name(sender_id) or sender_id
+            is_online = self._is_online(recipient_id, docs.get(recipient_ref.path, {}))
             
             # Prepare notification content
             title = f"{sender_name}"
@@ -322,17 +352,14 @@ class EventProcessor:
                 'type': 'friend_request'
             }
             
-            # Generate unique notification ID
-            notification_id = str(uuid.uuid4())
-            
-            # Store notification in Firestore
-            storage_success = self.firebase.store_notification(
-                notification_id,
-                recipient_id,
+            # Store the notification and bump the unread count in one batched write
+            storage_success = self.firebase.store_notifications(
+                [recipient_id],
                 'friend_request',
                 title,
                 body,
-                notification_data
+                notification_data,
+                counted_user_ids=[recipient_id] if recipient_ref.path in docs else ()
             )
             
             # If user is offline, consider sending push notification
@@ -1,9 +1,12 @@
-import json
 import logging
 import os
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import firebase_admin
+import orjson
 from firebase_admin import credentials, firestore, messaging
 from firebase_admin.exceptions import FirebaseError
 
@@ -12,6 +15,82 @@ from config import settings
 logger = logging.getLogger(__name__)
 
 
+class TTLCache:
+    """
+    Bounded in-process cache whose entries expire a fixed time after they were loaded.
+    
+    Safe to share between the consumer's handler threads. Concurrent misses for the
+    same key share one load: the thread that misses first loads it, and the others
+    wait for it and then read its result.
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        # key -> (expiry, value); kept in load order, so the first entry is the oldest
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        # key -> event set once the load in progress for that key has finished
+        self._loading: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+    
+    def get_many(self, keys: Iterable[str], load: Callable[[List[str]], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Get the values of several keys, loading the missing ones with a single call.
+        
+        Args:
+            keys: The keys to look up
+            load: Called with the keys that are neither cached nor being loaded by
+                another thread; returns a value for each of them, or raises
+            
+        Returns:
+            Dict mapping each key to its value
+        """
+        values = {}
+        pending = list(dict.fromkeys(keys))
+        while pending:
+            to_load, waiting = [], []
+            with self._lock:
+                now = time.monotonic()
+                for key in pending:
+                    entry = self._entries.get(key)
+                    if entry is not None and entry[0] > now:
+                        values[key] = entry[1]
+                    elif key in self._loading:
+                        waiting.append((key, self._loading[key]))
+                    else:
+                        self._loading[key] = threading.Event()
+                        to_load.append(key)
+            
+            if to_load:
+                try:
+                    loaded = load(to_load)
+                    with self._lock:
+                        expiry = time.monotonic() + self._ttl
+                        for key in to_load:
+                            self._put(key, expiry, loaded[key])
+                    values.update((key, loaded[key]) for key in to_load)
+                finally:
+                    with self._lock:
+                        for key in to_load:
+                            self._loading.pop(key).set()
+            
+            # Look the keys other threads were loading up again once they are done; a
+            # failed load leaves its keys uncached, so a waiter loads them instead
+            for _, loading in waiting:
+                loading.wait()
+            pending = [key for key, _ in waiting]
+        
+        return values
+    
+    def _put(self, key: str, expiry: float, value: Any) -> None:
+        # Called with the lock held. Re-inserting moves the key to the end, so the
+        # first entry stays the oldest and is the one evicted when the cache is full
+        self._entries.pop(key, None)
+        if len(self._entries) >= self._max_entries:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = (expiry, value)
+
+
 class FirebaseClient:
     """Firebase client for the Notification Consumer Service."""
     
@@ -22,11 +101,35 @@ class FirebaseClient:
         "invalid-registration-token",
     ]
     
+    # Firestore rejects a WriteBatch with more writes than this
+    MAX_BATCH_WRITES = 500
+    
+    # Firestore 'in' filters accept at most this many values
+    MAX_IN_FILTER_VALUES = 30
+    
+    # Preferences of users that have not set any; shared, so treat as read-only
+    DEFAULT_PREFERENCES = {
+        'pushEnabled': True,
+        'messageNotifications': True,
+        'groupNotifications': True, 
+        'friendRequestNotifications': True,
+        'systemNotifications': True
+    }
+    
     def __init__(self):
         """Initialize Firebase client with Firestore and FCM capabilities."""
         self.app = None
         self.firestore_db = None
         self.initialized = False
+        # Display names and notification preferences change rarely, while one sender's
+        # events and one recipient's notifications arrive in bursts
+        self._user_names = TTLCache(settings.cache_max_entries, settings.user_name_cache_ttl_seconds)
+        self._preferences = TTLCache(settings.cache_max_entries, settings.preferences_cache_ttl_seconds)
+        # IDs of online users, kept current by the presence listener; replaced as a whole
+        # on each snapshot, so readers on other threads always see a complete set
+        self._online_users: frozenset = frozenset()
+        self._presence_watch = None
+        self._presence_synced = False
         self.initialize()
         
     def initialize(self) -> None:
@@ -42,9 +145,9 @@ class FirebaseClient:
                 raise ValueError("Firebase secret not configured")
                 
             # Parse credentials JSON
-            cert_dict = json.loads(cert_json)
+            cert_dict = orjson.loads(cert_json)
             if isinstance(cert_dict, str):
-                cert_dict = json.loads(cert_dict)
+                cert_dict = orjson.loads(cert_dict)
                 
             # Initialize Firebase app
             cred = credentials.Certificate(cert_dict)
@@ -62,9 +165,58 @@ class FirebaseClient:
             logger.error(f"Failed to initialize Firebase: {str(e)}")
             raise
     
+    def start_presence_listener(self) -> None:
+        """Listen to the users that are online, so presence checks need no Firestore read."""
+        if self._presence_watch is not None:
+            return
+        try:
+            query = self.firestore_db.collection('users').where('isOnline', '==', True)
+            self._presence_watch = query.on_snapshot(self._on_presence_snapshot)
+            logger.info("Presence listener started")
+        except Exception as e:
+            # Presence checks keep reading the users' documents
+            logger.error(f"Failed to start presence listener: {str(e)}")
+    
+    def stop_presence_listener(self) -> None:
+        """Stop the presence listener; presence checks fall back to the users' documents."""
+        if self._presence_watch is None:
+            return
+        self._presence_watch.unsubscribe()
+        self._presence_watch = None
+        self._presence_synced = False
+    
+    def _on_presence_snapshot(self, docs, changes, read_time) -> None:
+        # Runs on the listener's thread; docs is the full current result set
+        self._online_users = frozenset(doc.id for doc in docs)
+        self._presence_synced = True
+    
+    def get_online_users(self) -> Optional[frozenset]:
+        """
+        Get the IDs of the online users from the presence listener.
+        
+        Returns:
+            The set of online user IDs, or None if the listener has not received a
+            snapshot yet or is disconnected, in which case callers read isOnline from
+            the users' documents instead
+        """
+        watch = self._presence_watch
+        if watch is None or not self._presence_synced or not watch.is_active:
+            return None
+        return self._online_users
+    
+    def _load_preferences(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """Read the notification preferences of users with one get_all read."""
+        pref_refs = [self.firestore_db.collection('notification_preferences').document(user_id)
+                     for user_id in user_ids]
+        preferences = {user_id: self.DEFAULT_PREFERENCES for user_id in user_ids}
+        for pref in self.firestore_db.get_all(pref_refs):
+            if pref.exists:
+                preferences[pref.id] = pref.to_dict()
+        return preferences
+    
     def get_user_preferences(self, user_id: str) -> Dict:
         """
-        Get user notification preferences from Firestore.
+        Get user notification preferences, cached for preferences_cache_ttl_seconds.
         
         Args:
             user_id: The user's ID
@@ -73,30 +225,69 @@ class FirebaseClient:
             Dict containing user preferences
         """
         try:
-            pref_ref = self.firestore_db.collection('notification_preferences').document(user_id)
-            pref = pref_ref.get()
-            
-            if pref.exists:
-                return pref.to_dict()
-            
-            return {
-                'pushEnabled': True,
-                'messageNotifications': True,
-                'groupNotifications': True, 
-                'friendRequestNotifications': True,
-                'systemNotifications': True
-            }
+            return self._preferences.get_many([user_id], self._load_preferences)[user_id]
         
         except Exception as e:
             logger.error(f"Error fetching user preferences for {user_id}: {str(e)}")
-            # Default to enabling all notifications on error
-            return {
-                'pushEnabled': True,
-                'messageNotifications': True,
-                'groupNotifications': True, 
-                'friendRequestNotifications': True,
-                'systemNotifications': True
-            }
+            # Default to enabling all notifications on error, without caching the defaults
+            return self.DEFAULT_PREFERENCES
+    
+    def get_users_preferences(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Get the notification preferences of several users, cached like get_user_preferences.
+        The users missing from the cache are read together with one get_all read.
+        
+        Args:
+            user_ids: The users' IDs
+            
+        Returns:
+            Dict mapping each user ID to its preferences (defaults when it has none)
+        """
+        try:
+            return self._preferences.get_many(user_ids, self._load_preferences)
+        
+        except Exception as e:
+            logger.error(f"Error fetching preferences for {len(user_ids)} users: {str(e)}")
+            # Default to enabling all notifications on error, without caching the defaults
+            return {user_id: self.DEFAULT_PREFERENCES for user_id in user_ids}
+    
+    def _load_user_names(self, user_ids: List[str]) -> Dict[str, Optional[str]]:
+        """Read the display names of users with one get_all read of the name field."""
+        user_refs = [self.firestore_db.collection('users').document(user_id) for user_id in user_ids]
+        names = dict.fromkeys(user_ids)
+        for user in self.firestore_db.get_all(user_refs, field_paths=['name']):
+            if user.exists:
+                names[user.id] = user.to_dict().get('name')
+        return names
+    
+    def get_user_name(self, user_id: str) -> Optional[str]:
+        """
+        Get a user's display name, cached for user_name_cache_ttl_seconds.
+        
+        Args:
+            user_id: The user's ID
+            
+        Returns:
+            The name, or None if the user has no document or no name
+        """
+        return self._user_names.get_many([user_id], self._load_user_names)[user_id]
+    
+    def get_documents(self, refs: List, field_paths: Optional[List[str]] = None) -> Dict[str, Dict]:
+        """
+        Read several documents, from any collections, with one get_all read.
+        
+        Args:
+            refs: Document references to read
+            field_paths: Optional fields to return, applied to every document
+            
+        Returns:
+            Dict mapping the path of each document that exists to its data
+        """
+        return {
+            doc.reference.path: doc.to_dict()
+            for doc in self.firestore_db.get_all(refs, field_paths=field_paths)
+            if doc.exists
+        }
     
     def get_user_device_tokens(self, user_id: str) -> Dict[str, List[Tuple[str, str]]]:
         """
@@ -131,6 +322,38 @@ class FirebaseClient:
             logger.error(f"Error fetching device tokens for user {user_id}: {str(e)}")
             return {}
     
+    def get_users_device_tokens(self, user_ids: List[str]) -> Dict[str, Dict[str, List[Tuple[str, str]]]]:
+        """
+        Get the device tokens of several users with one 'in' query per 30 users.
+        
+        Args:
+            user_ids: The users' IDs
+            
+        Returns:
+            Dict mapping each user ID with tokens to a dict of device types to lists
+            of (token, doc_id) tuples
+        """
+        device_tokens = {}
+        tokens_ref = self.firestore_db.collection('device_tokens')
+        
+        for i in range(0, len(user_ids), self.MAX_IN_FILTER_VALUES):
+            chunk = user_ids[i:i + self.MAX_IN_FILTER_VALUES]
+            try:
+                for token_doc in tokens_ref.where('userId', 'in', chunk).stream():
+                    token_data = token_doc.to_dict()
+                    user_id = token_data.get('userId')
+                    device_type = token_data.get('deviceType')
+                    token = token_data.get('token')
+                    
+                    if user_id and device_type and token:
+                        device_tokens.setdefault(user_id, {}).setdefault(device_type, []) \
+                            .append((token, token_doc.id))
+                        
+            except Exception as e:
+                logger.error(f"Error fetching device tokens for {len(chunk)} users: {str(e)}")
+        
+        return device_tokens
+    
     def invalidate_token(self, token_doc_id: str) -> bool:
         """
         Remove an invalid device token from Firestore.
@@ -149,23 +372,24 @@ class FirebaseClient:
             logger.error(f"Error removing invalid token {token_doc_id}: {str(e)}")
             return False
     
-    def store_notification(self, 
-                          notification_id: str,
-                          user_id: str,
-                          notification_type: str,
-                          title: str,
-                          body: str,
-                          data: Optional[Dict] = None) -> bool:
+    def store_notifications(self,
+                            user_ids: List[str],
+                            notification_type: str,
+                            title: str,
+                            body: str,
+                            data: Optional[Dict] = None,
+                            counted_user_ids: Iterable[str] = ()) -> bool:
         """
-        Store a notification in Firestore.
+        Store the same notification for several users in WriteBatch commits.
         
         Args:
-            notification_id: Unique ID for the notification
-            user_id: The recipient's user ID
+            user_ids: The recipients' user IDs
             notification_type: Type of notification (message, group_invitation, etc.)
             title: Notification title
             body: Notification body/content
             data: Additional notification data
+            counted_user_ids: Recipients with a user document, whose unread notification
+                count is incremented in the same batch
             
         Returns:
             True if successful, False otherwise
@@ -173,41 +397,45 @@ class FirebaseClient:
         try:
             from datetime import datetime, timezone
             
-            notification_data = {
-                'notificationId': notification_id,
-                'userId': user_id,
-                'type': notification_type,
-                'title': title,
-                'body': body,
-                'data': data or {},
-                'isRead': False,
-                'createdAt': datetime.now(timezone.utc)
-            }
-            
-            # Store in Firestore
-            self.firestore_db.collection('notifications').document(notification_id).set(notification_data)
-            
-            # Update user's unread notification count
-            user_ref = self.firestore_db.collection('users').document(user_id)
-            user = user_ref.get()
+            counted = set(counted_user_ids)
+            now = datetime.now(timezone.utc)
+            batch = self.firestore_db.batch()
+            writes = 0
             
-            if user.exists:
-                transaction = self.firestore_db.transaction()
-                
-                @firestore.transactional
-                def update_unread_count(transaction, user_ref):
-                    user_doc = user_ref.get(transaction=transaction)
-                    user_data = user_doc.to_dict()
-                    unread_count = user_data.get('unreadNotifications', 0)
-                    transaction.update(user_ref, {'unreadNotifications': unread_count + 1})
+            for user_id in user_ids:
+                # Keep a recipient's two writes in the same batch
+                if writes + 2 > self.MAX_BATCH_WRITES:
+                    batch.commit()
+                    batch = self.firestore_db.batch()
+                    writes = 0
                 
-                update_unread_count(transaction, user_ref)
+                notification_id = str(uuid.uuid4())
+                batch.set(self.firestore_db.collection('notifications').document(notification_id), {
+                    'notificationId': notification_id,
+                    'userId': user_id,
+                    'type': notification_type,
+                    'title': title,
+                    'body': body,
+                    'data': data or {},
+                    'isRead': False,
+                    'createdAt': now
+                })
+                writes += 1
                 
-            logger.info(f"Stored notification {notification_id} for user {user_id}")
+                # Increment server-side instead of a read-modify-write transaction per user
+                if user_id in counted:
+                    batch.update(self.firestore_db.collection('users').document(user_id),
+                                 {'unreadNotifications': firestore.Increment(1)})
+                    writes += 1
+            
+            if writes:
+                batch.commit()
+            
+            logger.info(f"Stored {notification_type} notification for {len(user_ids)} users")
             return True
             
         except Exception as e:
-            logger.error(f"Error storing notification for user {user_id}: {str(e)}")
+            logger.error(f"Error storing notifications for {len(user_ids)} users: {str(e)}")
             return False
     
     def send_fcm_notification(self, 
@@ -318,6 +546,83 @@ class FirebaseClient:
             results['error'] = str(e)
             return results
     
+    def send_fcm_notifications(self,
+                               user_ids: List[str],
+                               title: str,
+                               body: str,
+                               data: Optional[Dict] = None) -> Dict[str, Dict]:
+        """
+        Send the same FCM notification to the devices of several users, packing the
+        tokens of all of them into multicast requests of up to fcm_batch_size tokens.
+        
+        Args:
+            user_ids: The recipients' user IDs
+            title: Notification title
+            body: Notification body/content
+            data: Additional notification data
+            
+        Returns:
+            Dict mapping each user ID to its status information: 'success' when at
+            least one of their devices was reached, and status 'NO_TOKENS' when they
+            have no devices
+        """
+        results = {
+            user_id: {'success': False, 'tokens_succeeded': 0, 'tokens_failed': 0}
+            for user_id in user_ids
+        }
+        
+        device_tokens = self.get_users_device_tokens(user_ids)
+        for user_id in user_ids:
+            if user_id not in device_tokens:
+                results[user_id]['status'] = 'NO_TOKENS'
+        
+        # Flatten the tokens of every recipient per platform, remembering whose each one is
+        by_platform = {}
+        for user_id, platforms in device_tokens.items():
+            for platform, tokens in platforms.items():
+                by_platform.setdefault(platform, []).extend(
+                    (user_id, token, doc_id) for token, doc_id in tokens
+                )
+        
+        # FCM for iOS and Android
+        for platform in ['ios', 'android']:
+            targets = by_platform.get(platform, [])
+            
+            # Batch tokens (max 500 per request)
+            for i in range(0, len(targets), settings.fcm_batch_size):
+                batch = targets[i:i + settings.fcm_batch_size]
+                
+                try:
+                    message = messaging.MulticastMessage(
+                        notification=messaging.Notification(
+                            title=title,
+                            body=body
+                        ),
+                        data=data or {},
+                        tokens=[token for _, token, _ in batch]
+                    )
+                    batch_response = messaging.send_multicast(message)
+                    responses = batch_response.responses
+                    
+                except FirebaseError as e:
+                    logger.error(f"Firebase error sending to {platform}: {str(e)}")
+                    responses = [None] * len(batch)
+                
+                # Responses come back in token order: map each one back to its user
+                for (user_id, _, doc_id), resp in zip(batch, responses):
+                    if resp is not None and resp.success:
+                        results[user_id]['tokens_succeeded'] += 1
+                        results[user_id]['success'] = True
+                        continue
+                    
+                    results[user_id]['tokens_failed'] += 1
+                    error = resp.exception if resp is not None else None
+                    if error and hasattr(error, 'code') and error.code in self.INVALID_TOKEN_CODES:
+                        # Invalid token - remove it
+                        self.invalidate_token(doc_id)
+        
+        return results
+    
     def is_user_online(self, user_id: str) -> bool:
         """
         Check if a user is currently online.
@@ -1,17 +1,18 @@
-import json
 import logging
 import logging.config
 import os
+import queue
 import signal
 import sys
+import threading
 import time
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
-import tenacity
 from pythonjsonlogger import jsonlogger
 
 from config import settings
-from event_processor import EventProcessor
+from event_processor import EventOutcome, EventProcessor, PROCESSED, RETRY
 from firebase_client import FirebaseClient
 from sqs_client import SQSClient
 
@@ -51,6 +52,10 @@ def setup_logging():
 # Create logger
 logger = logging.getLogger(__name__)
 
+# Handled messages are acknowledged after waiting at most this long for others to share
+# the batch request with
+ACK_LINGER_SECONDS = 0.2
+
 # Handle graceful shutdown
 running = True
 
@@ -70,97 +75,149 @@ class NotificationConsumer:
         """Initialize the notification consumer service."""
         self.sqs_client = SQSClient()
         self.firebase_client = FirebaseClient()
+        self.firebase_client.start_presence_listener()
         self.event_processor = EventProcessor(
             firebase_client=self.firebase_client,
             sqs_client=self.sqs_client
         )
+        # Received messages are handled by this pool, apart from the pollers, so a slow
+        # event never delays the next receive. At most sqs_max_in_flight messages are held
+        # at once; a poller reserves room for a full batch before it receives one
+        self._max_in_flight = max(settings.sqs_max_in_flight, settings.sqs_max_messages)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._max_in_flight,
+            thread_name_prefix="event"
+        )
+        self._in_flight = threading.BoundedSemaphore(self._max_in_flight)
+        # One poller reserves at a time, so pollers cannot each hold part of the capacity
+        self._reserve_lock = threading.Lock()
+        # (queue_url, message, outcome) of handled messages, acknowledged in batches
+        self._acks: queue.Queue = queue.Queue()
         logger.info("Notification Consumer Service initialized")
     
-    def process_messages(self, max_messages: int = None) -> int:
+    def _acknowledge(self, queue_url: str, messages: List[Dict], outcomes: List[EventOutcome]) -> None:
         """
-        Process a batch of messages from the queue.
-        
-        Args:
-            max_messages: Maximum number of messages to process (1-10)
-            
-        Returns:
-            Number of messages processed successfully
+        Re-queue the events to retry and delete the handled messages from the queue
+        they were received from, each in batch requests.
         """
-        # Use default if not specified
-        max_messages = max_messages or settings.sqs_max_messages
-        
-        # Receive messages
-        messages = self.sqs_client.receive_messages(
-            queue_url=settings.main_queue_url,
-            max_messages=max_messages
-        )
-        
-        if not messages:
-            return 0
+        done = [message['ReceiptHandle'] for message, outcome in zip(messages, outcomes)
+                if outcome.status == PROCESSED]
         
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if self.event_processor.process_event(message):
-                success_count += 1
+        # Re-queue the failed events in one batch; a message is acknowledged only once its
+        # retry copy was accepted, otherwise SQS redelivers the original
+        retries = [(message, outcome) for message, outcome in zip(messages, outcomes)
+                   if outcome.status == RETRY]
+        if retries:
+            sent = self.sqs_client.send_to_retry_queue_batch(
+                [(outcome.event_data, outcome.attempt) for _, outcome in retries]
+            )
+            done.extend(message['ReceiptHandle'] for (message, _), accepted in zip(retries, sent) if accepted)
         
-        logger.info(f"Processed {len(messages)} messages, {success_count} successful")
-        return success_count
+        # Acknowledge the handled messages together; failed ones stay on the queue
+        self.sqs_client.delete_message_batch(queue_url, done)
     
-    def process_retry_messages(self, max_messages: int = None) -> int:
-        """
-        Process a batch of messages from the retry queue.
-        
-        Args:
-            max_messages: Maximum number of messages to process (1-10)
+    def _handle(self, queue_url: str, message: Dict) -> None:
+        """Process one received message and pass it on to be acknowledged."""
+        try:
+            outcome = self.event_processor.process_event(message)
+            self._acks.put((queue_url, message, outcome))
+        finally:
+            self._in_flight.release()
+    
+    def _poll_loop(self, queue_url: str) -> None:
+        """Receive batches from one queue and hand their messages to the pool until shutdown."""
+        max_messages = settings.sqs_max_messages
+        while running:
+            # Wait for room for a full batch before receiving, so received messages never
+            # sit waiting while their visibility timeout runs out
+            with self._reserve_lock:
+                for _ in range(max_messages):
+                    self._in_flight.acquire()
             
-        Returns:
-            Number of messages processed successfully
+            messages = []
+            if not running:
+                # Shutdown arrived while waiting for room
+                for _ in range(max_messages):
+                    self._in_flight.release()
+                break
+            try:
+                messages = self.sqs_client.receive_messages(
+                    queue_url=queue_url,
+                    max_messages=max_messages
+                )
+                for message in messages:
+                    self._executor.submit(self._handle, queue_url, message)
+            except Exception as e:
+                logger.error(f"Error in message processing loop for {queue_url}: {str(e)}")
+                time.sleep(5)  # Sleep before retrying after error
+            finally:
+                # Give back the room the batch did not use
+                for _ in range(max_messages - len(messages)):
+                    self._in_flight.release()
+    
+    def _ack_loop(self) -> None:
         """
-        # Use default if not specified
-        max_messages = max_messages or settings.sqs_max_messages
-        
-        # Receive messages
-        messages = self.sqs_client.receive_messages(
-            queue_url=settings.retry_queue_url,
-            max_messages=max_messages
-        )
-        
-        if not messages:
-            return 0
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if self.event_processor.process_event(message):
-                success_count += 1
-        
-        logger.info(f"Processed {len(messages)} retry messages, {success_count} successful")
-        return success_count
+        Acknowledge handled messages in batches of up to 10 per queue, until a None
+        sentinel arrives after every handler has finished.
+        """
+        stopping = False
+        while not stopping:
+            batch = [self._acks.get()]
+            # Linger briefly so messages handled around the same time share a request
+            deadline = time.monotonic() + ACK_LINGER_SECONDS
+            while len(batch) < settings.sqs_max_messages:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._acks.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            
+            by_queue: Dict[str, Tuple[List[Dict], List[EventOutcome]]] = {}
+            for queue_url, message, outcome in batch:
+                messages, outcomes = by_queue.setdefault(queue_url, ([], []))
+                messages.append(message)
+                outcomes.append(outcome)
+            for queue_url, (messages, outcomes) in by_queue.items():
+                try:
+                    self._acknowledge(queue_url, messages, outcomes)
+                except Exception as e:
+                    logger.error(f"Error acknowledging {len(messages)} messages on {queue_url}: {str(e)}")
     
     def run(self):
-        """Run the consumer service in an infinite loop."""
+        """Run the consumer service until a shutdown signal is received."""
         logger.info("Starting Notification Consumer Service")
         
         try:
-            # Main processing loop
-            while running:
-                try:
-                    # Process messages from main queue
-                    main_count = self.process_messages()
-                    
-                    # Process messages from retry queue if no main messages
-                    if main_count == 0:
-                        retry_count = self.process_retry_messages()
-                        
-                        # If no messages from either queue, briefly sleep to avoid hammering SQS
-                        if retry_count == 0:
-                            time.sleep(1)
-                    
-                except Exception as e:
-                    logger.error(f"Error in message processing loop: {str(e)}")
-                    time.sleep(5)  # Sleep before retrying after error
+            acker = threading.Thread(target=self._ack_loop, name="acker")
+            acker.start()
+            
+            # A pool of pollers on the main queue and one on the retry queue. Each long poll
+            # already waits up to sqs_wait_time for messages, so idle pollers need no sleep
+            pollers = [
+                threading.Thread(target=self._poll_loop, args=(settings.main_queue_url,),
+                                 name=f"main-poller-{i}")
+                for i in range(settings.sqs_consumer_pool_size)
+            ]
+            pollers.append(threading.Thread(target=self._poll_loop, args=(settings.retry_queue_url,),
+                                            name="retry-poller"))
+            for poller in pollers:
+                poller.start()
+            
+            # Each poller exits after its current receive once running is cleared; the
+            # messages already received are still handled and acknowledged
+            for poller in pollers:
+                poller.join()
+            self._executor.shutdown(wait=True)
+            self._acks.put(None)
+            acker.join()
             
+            self.firebase_client.stop_presence_listener()
             logger.info("Notification Consumer Service shutdown gracefully")
             
         except Exception as e:
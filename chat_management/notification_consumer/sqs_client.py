@@ -1,14 +1,18 @@
-import json
 import logging
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import boto3
+import orjson
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+# SQS batch requests (SendMessageBatch, DeleteMessageBatch) accept at most 10 entries
+SQS_MAX_BATCH_SIZE = 10
+
 
 class SQSClient:
     """SQS client for the Notification Consumer Service."""
@@ -19,7 +23,11 @@ class SQSClient:
             'sqs',
             region_name=settings.aws_region,
             aws_access_key_id=settings.aws_access_key_id,
-            aws_secret_access_key=settings.aws_secret_access_key
+            aws_secret_access_key=settings.aws_secret_access_key,
+            # One connection per main-queue poller, plus the retry poller and the acker. A poller
+            # holds its connection for the whole long poll, so with botocore's default pool of
+            # 10, a larger poller pool would queue its receives behind each other
+            config=Config(max_pool_connections=settings.sqs_consumer_pool_size + 2)
         )
         logger.info("SQS client initialized")
     
@@ -95,6 +103,86 @@ class SQSClient:
             logger.error(f"Unexpected error deleting message: {str(e)}")
             return False
     
+    def _call_batch(self, operation, queue_url: str, entries: List[Dict]) -> Set[str]:
+        """
+        Make one batch request (at most 10 entries, each with an 'Id') and return the Ids
+        that succeeded.
+        
+        Entries that failed through no fault of the request (throttling, SQS internal
+        errors) are retried once, together in a single follow-up request; sender faults
+        are logged and not retried.
+        """
+        response = operation(QueueUrl=queue_url, Entries=entries)
+        successful = {result['Id'] for result in response.get('Successful', [])}
+        failed = response.get('Failed', [])
+        retryable = {failure['Id'] for failure in failed if not failure.get('SenderFault')}
+        if len(retryable) < len(failed):
+            logger.error(f"Batch entries rejected by {queue_url}: "
+                         f"{[failure for failure in failed if failure.get('SenderFault')]}")
+        
+        if retryable:
+            response = operation(QueueUrl=queue_url,
+                                 Entries=[entry for entry in entries if entry['Id'] in retryable])
+            successful.update(result['Id'] for result in response.get('Successful', []))
+            if response.get('Failed'):
+                logger.error(f"Batch entries failed again on {queue_url}: {response['Failed']}")
+        return successful
+    
+    def delete_message_batch(self, queue_url: str, receipt_handles: List[str]) -> int:
+        """
+        Delete received messages from an SQS queue with DeleteMessageBatch requests of
+        up to 10 messages each.
+        
+        Args:
+            queue_url: The SQS queue URL the messages were received from
+            receipt_handles: Receipt handles of the messages to delete
+            
+        Returns:
+            Number of messages deleted
+        """
+        deleted = 0
+        for start in range(0, len(receipt_handles), SQS_MAX_BATCH_SIZE):
+            chunk = receipt_handles[start:start + SQS_MAX_BATCH_SIZE]
+            try:
+                entries = [{'Id': str(i), 'ReceiptHandle': handle} for i, handle in enumerate(chunk)]
+                logger.debug(f"Deleting batch of {len(entries)} messages from {queue_url}")
+                deleted += len(self._call_batch(self.sqs.delete_message_batch, queue_url, entries))
+                
+            except ClientError as e:
+                logger.error(f"Error deleting message batch: {str(e)}")
+            except Exception as e:
+                logger.error(f"Unexpected error deleting message batch: {str(e)}")
+        return deleted
+    
+    def send_batch_to_queue(self, queue_url: str, entries: List[Dict]) -> List[bool]:
+        """
+        Send messages to an SQS queue with SendMessageBatch requests of up to 10 messages each.
+        
+        Args:
+            queue_url: The SQS queue URL
+            entries: SendMessageBatch entries without 'Id' (MessageBody, DelaySeconds, ...)
+            
+        Returns:
+            Whether each entry was accepted, in the order given
+        """
+        sent = [False] * len(entries)
+        for start in range(0, len(entries), SQS_MAX_BATCH_SIZE):
+            chunk = entries[start:start + SQS_MAX_BATCH_SIZE]
+            try:
+                batch = [dict(entry, Id=str(i)) for i, entry in enumerate(chunk)]
+                logger.debug(f"Sending batch of {len(batch)} messages to {queue_url}")
+                successful = self._call_batch(self.sqs.send_message_batch, queue_url, batch)
+                for i in range(len(chunk)):
+                    sent[start + i] = str(i) in successful
+                    
+            except ClientError as e:
+                logger.error(f"Error sending message batch to {queue_url}: {str(e)}")
+            except Exception as e:
+                logger.error(f"Unexpected error sending message batch: {str(e)}")
+        
+        logger.info(f"Sent {sum(sent)} of {len(entries)} messages to {queue_url}")
+        return sent
+    
     def send_to_queue(self, 
                      queue_url: str, 
                      message_body: Union[str, Dict], 
@@ -117,7 +205,7 @@ class SQSClient:
         try:
             # Convert dict to JSON string if necessary
             if isinstance(message_body, dict):
-                message_body = json.dumps(message_body)
+                message_body = orjson.dumps(message_body).decode()
             
             # Prepare send parameters
             params = {
@@ -134,12 +222,12 @@ class SQSClient:
             if message_group_id:
                 # Extract message ID from body for deduplication
                 try:
-                    body_dict = json.loads(message_body)
+                    body_dict = orjson.loads(message_body)
                     message_deduplication_id = body_dict.get('messageId', f"{message_group_id}-{hash(message_body)}")
                     
                     params['MessageGroupId'] = message_group_id
                     params['MessageDeduplicationId'] = message_deduplication_id
-                except (json.JSONDecodeError, TypeError):
+                except (orjson.JSONDecodeError, TypeError):
                     # If message_body isn't valid JSON, use a hash of the body
                     params['MessageGroupId'] = message_group_id
                     params['MessageDeduplicationId'] = f"{message_group_id}-{hash(message_body)}"
@@ -159,6 +247,36 @@ class SQSClient:
             logger.error(f"Unexpected error sending message: {str(e)}")
             return None
     
+    def _with_retry_metadata(self, 
+                             message_body: Union[str, Dict], 
+                             attempt: int,
+                             max_attempts: int) -> Union[str, Dict]:
+        """Record the retry attempt in the message body."""
+        if isinstance(message_body, str):
+            try:
+                message_dict = orjson.loads(message_body)
+                message_dict['_retry'] = {
+                    'attempt': attempt,
+                    'maxAttempts': max_attempts
+                }
+                message_body = orjson.dumps(message_dict).decode()
+            except orjson.JSONDecodeError:
+                # If not JSON, pass through as-is
+                pass
+        elif isinstance(message_body, dict):
+            message_body['_retry'] = {
+                'attempt': attempt,
+                'maxAttempts': max_attempts
+            }
+        return message_body
+    
+    def _retry_delay(self, attempt: int) -> int:
+        """Exponential backoff delay for a retry attempt."""
+        return int(min(
+            settings.initial_backoff_seconds * (settings.backoff_factor ** (attempt - 1)),
+            900  # SQS maximum delay is 15 minutes (900 seconds)
+        ))
+    
     def send_to_retry_queue(self, 
                           message_body: Union[str, Dict], 
                           attempt: int,
@@ -182,37 +300,58 @@ class SQSClient:
             return self.send_to_dlq(message_body)
         
         # Calculate exponential backoff delay
-        delay = min(
-            settings.initial_backoff_seconds * (settings.backoff_factor ** (attempt - 1)),
-            900  # SQS maximum delay is 15 minutes (900 seconds)
-        )
+        delay = self._retry_delay(attempt)
         
         # Update retry metadata in message
-        if isinstance(message_body, str):
-            try:
-                message_dict = json.loads(message_body)
-                message_dict['_retry'] = {
-                    'attempt': attempt,
-                    'maxAttempts': max_attempts
-                }
-                message_body = json.dumps(message_dict)
-            except json.JSONDecodeError:
-                # If not JSON, pass through as-is
-                pass
-        elif isinstance(message_body, dict):
-            message_body['_retry'] = {
-                'attempt': attempt,
-                'maxAttempts': max_attempts
-            }
+        message_body = self._with_retry_metadata(message_body, attempt, max_attempts)
         
         # Send to retry queue
         logger.info(f"Sending message to retry queue with delay {delay}s (attempt {attempt}/{max_attempts})")
         return self.send_to_queue(
             queue_url=settings.retry_queue_url,
             message_body=message_body,
-            delay_seconds=int(delay)
+            delay_seconds=delay
         )
     
+    def send_to_retry_queue_batch(self, 
+                                  messages: List[Tuple[Union[str, Dict], int]],
+                                  max_attempts: int = None) -> List[bool]:
+        """
+        Send several failed messages to the retry queue (or the DLQ, once out of attempts)
+        in SendMessageBatch requests, each with its own backoff delay.
+        
+        Args:
+            messages: (message body, retry attempt number) pairs
+            max_attempts: Maximum number of retry attempts
+            
+        Returns:
+            Whether each message was accepted, in the order given
+        """
+        max_attempts = max_attempts or settings.max_retry_attempts
+        
+        retry_positions, retry_entries = [], []
+        dlq_positions, dlq_entries = [], []
+        for position, (message_body, attempt) in enumerate(messages):
+            if attempt >= max_attempts:
+                logger.warning(f"Max retry attempts ({max_attempts}) exceeded, sending to DLQ")
+                body = message_body
+                positions, entries, delay = dlq_positions, dlq_entries, 0
+            else:
+                body = self._with_retry_metadata(message_body, attempt, max_attempts)
+                positions, entries, delay = retry_positions, retry_entries, self._retry_delay(attempt)
+            if isinstance(body, dict):
+                body = orjson.dumps(body).decode()
+            positions.append(position)
+            entries.append({'MessageBody': body, 'DelaySeconds': delay})
+        
+        sent = [False] * len(messages)
+        for queue_url, positions, entries in ((settings.retry_queue_url, retry_positions, retry_entries),
+                                              (settings.dlq_url, dlq_positions, dlq_entries)):
+            if entries:
+                for position, accepted in zip(positions, self.send_batch_to_queue(queue_url, entries)):
+                    sent[position] = accepted
+        return sent
+    
     def send_to_dlq(self, message_body: Union[str, Dict]) -> Optional[str]:
         """
         Send a message to the dead letter queue.